@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+"""Microbenchmarks of db.py public functions at realistic data sizes, with EXPLAIN QUERY PLAN of every query.
+
+    python benchmark_db.py --db bench.sqlite3 --output before.json      # generate history once, reuse the file later
+    python benchmark_db.py --db bench.sqlite3 --output after.json
+    python benchmark_db.py --compare before.json after.json
+    python benchmark_db.py --scale 0.02                                # quick run on a temporary database
+
+--db may also be a copy of a real database (never the working one: write functions are benchmarked too).
+Timings are per call in microseconds. A query plan step is marked full_scan when a table is scanned without an index.
+"""
+
+import sys
+import json
+import time
+import random
+import sqlite3
+import argparse
+import datetime
+import platform
+import tempfile
+import statistics
+from collections import defaultdict
+from typing import Callable, Dict, List, NamedTuple, Optional
+from loguru import logger
+import db
+
+
+class Benchmark(NamedTuple):
+    name: str
+    func: Callable
+    make_args: Callable[[random.Random], tuple]  # arguments of one call
+    iterations: float = 1.0  # share of --iterations
+    setup: Optional[Callable] = None  # called with the same arguments before each call, not timed
+    teardown: Optional[Callable] = None  # called with the same arguments after each call, not timed
+
+
+def populate(filename: str, chats: int, events: int, participations: int, members: int, seed: int):
+    """Generate chats with `members` users each, history of fixed events (one open event per chat), penalties"""
+    rng = random.Random(seed)
+    db.use_database(filename)
+    db.migrate()
+    db.close_connections()
+    conn = sqlite3.connect(filename)
+    conn.execute('PRAGMA synchronous = OFF;')
+    events_per_chat = max(1, events // chats)
+    per_event = min(members, max(1, participations // (chats * events_per_chat)))
+    now = datetime.datetime.now().replace(microsecond=0)
+    first_event = now - datetime.timedelta(days=7 * (events_per_chat - 1) - 1)
+    chat_ids = [-1000000 - n for n in range(chats)]
+    with conn:
+        conn.executemany('INSERT INTO Users(user_id, first_name, last_name, username) VALUES (?, ?, ?, ?);',
+                         ((user_id, f'Player{user_id}', 'Bench' if user_id % 2 else '', f'user{user_id}' if user_id % 3 else '')
+                          for user_id in range(1, chats * members + 1)))
+        conn.executemany('INSERT INTO Chats(chat_id, lang, latest_bot_message_id, latest_bot_message_text) VALUES (?, ?, ?, ?);',
+                         ((chat_id, 'en', 1, '') for chat_id in chat_ids))
+    event_id = 0
+    for n, chat_id in enumerate(chat_ids):
+        member_ids = range(n * members + 1, (n + 1) * members + 1)
+        event_rows, participant_rows, revoked_rows, penalty_rows = [], [], [], []
+        for number in range(events_per_chat):
+            event_id += 1
+            when = first_event + datetime.timedelta(days=7 * number)
+            status = 'Open' if number == events_per_chat - 1 else 'Fixed'
+            event_rows.append((event_id, chat_id, status, f'Futsal #{number} max 12', str(when), 12))
+            players = rng.sample(member_ids, per_event)
+            for position, user_id in enumerate(players):
+                participant_rows.append((event_id, user_id, str(when - datetime.timedelta(days=2, minutes=-position))))
+            if per_event < members and rng.random() < 0.3:
+                revoked_user = rng.choice([user_id for user_id in member_ids if user_id not in players])
+                revoked_rows.append((event_id, revoked_user, str(when - datetime.timedelta(days=1))))
+            if rng.random() < 0.05:
+                penalty_rows.append((chat_id, rng.choice(players), str(when), member_ids[0]))
+        with conn:
+            conn.executemany('INSERT INTO Events(event_id, chat_id, status, description, datetime, players_limit) VALUES (?, ?, ?, ?, ?, ?);', event_rows)
+            conn.executemany('INSERT INTO Participants(event_id, user_id, operation_datetime) VALUES (?, ?, ?);', participant_rows)
+            conn.executemany('INSERT INTO Revoked(event_id, user_id, operation_datetime) VALUES (?, ?, ?);', revoked_rows)
+            conn.executemany('INSERT INTO Penalties(chat_id, user_id, operation_datetime, operator_id) VALUES (?, ?, ?, ?);', penalty_rows)
+    with conn:
+        conn.execute('INSERT INTO ChatMemberStats(chat_id, user_id, registrations, penalties) ' + db.CHAT_MEMBER_STATS_FROM_HISTORY_SQL + ';')
+    conn.close()
+
+
+def table_sizes(filename: str) -> Dict[str, int]:
+    conn = sqlite3.connect(filename)
+    try:
+        return {table: conn.execute(f'SELECT COUNT(*) FROM {table};').fetchone()[0]
+                for table in ('Users', 'Chats', 'Events', 'Participants', 'Revoked', 'Penalties', 'ChatMemberStats')}
+    finally:
+        conn.close()
+
+
+def has_history(filename: str) -> bool:
+    try:
+        return table_sizes(filename)['Events'] > 0
+    except sqlite3.OperationalError:  # new file, no tables yet
+        return False
+
+
+def load_members(filename: str) -> Dict[int, List[int]]:
+    """chat_id -> users who ever registered in the chat"""
+    conn = sqlite3.connect(filename)
+    members: Dict[int, List[int]] = defaultdict(list)
+    try:
+        for chat_id, user_id in conn.execute('SELECT chat_id, user_id FROM ChatMemberStats;'):
+            members[chat_id].append(user_id)
+    finally:
+        conn.close()
+    return dict(members)
+
+
+def benchmarks(members: Dict[int, List[int]]) -> List[Benchmark]:
+    chat_ids = list(members)
+    new_chat_ids = iter(range(-2000000, -3000000, -1))
+
+    def chat(rng):
+        return (rng.choice(chat_ids),)
+
+    def chat_member(rng):
+        chat_id = rng.choice(chat_ids)
+        return chat_id, rng.choice(members[chat_id])
+
+    def member(rng):
+        return (rng.choice(members[rng.choice(chat_ids)]),)
+
+    def next_event(chat_id, *_args):
+        db.event_add(chat_id, 'Futsal max 12', datetime.datetime.now() + datetime.timedelta(days=1), 12, 1, '')
+
+    return [
+        Benchmark('get_event_text', db.get_event_text, chat),
+        Benchmark('get_event_limit', db.get_event_limit, chat),
+        Benchmark('get_event_datetime', db.get_event_datetime, chat),
+        Benchmark('get_latest_bot_message_id', db.get_latest_bot_message_id, chat),
+        Benchmark('get_latest_bot_message_text', db.get_latest_bot_message_text, chat),
+        Benchmark('get_chat_lang', db.get_chat_lang, chat),
+        Benchmark('get_event_users', db.get_event_users, chat),
+        Benchmark('get_event_revoked_users', db.get_event_revoked_users, chat),
+        Benchmark('get_event_snapshot', db.get_event_snapshot, chat),
+        Benchmark('get_only_chat_participants', db.get_only_chat_participants, chat),
+        Benchmark('get_chat_user_rp', db.get_chat_user_rp, chat_member),
+        Benchmark('get_user_cancellation_datetime', db.get_user_cancellation_datetime, chat_member),
+        Benchmark('compose_full_name', db.compose_full_name, member),
+        Benchmark('get_full_names', db.get_full_names, lambda rng: (members[rng.choice(chat_ids)],)),
+        Benchmark('get_all_chat_ids', db.get_all_chat_ids, lambda rng: (), iterations=0.01),
+        Benchmark('get_known_chat_index', db.get_known_chat_index, lambda rng: (), iterations=0.01),
+        Benchmark('get_countdown_events', db.get_countdown_events, lambda rng: (), iterations=0.01),
+        Benchmark('get_all_userids', db.get_all_userids, lambda rng: (), iterations=0.01),
+        Benchmark('add_or_update_user', db.add_or_update_user,
+                  lambda rng: (rng.choice(members[rng.choice(chat_ids)]), f'Player{rng.randrange(3)}', 'Bench', '')),
+        Benchmark('apply_for_participation_in_the_event', db.apply_for_participation_in_the_event, chat_member),
+        Benchmark('revoke_application_for_the_event', db.revoke_application_for_the_event, chat_member),
+        Benchmark('save_latest_bot_message', db.save_latest_bot_message, lambda rng: (rng.choice(chat_ids), rng.randrange(1, 10**6), 'text')),
+        Benchmark('set_players_limit', db.set_players_limit, lambda rng: (rng.choice(chat_ids), rng.randrange(10, 15))),
+        Benchmark('set_event_datetime', db.set_event_datetime,
+                  lambda rng: (rng.choice(chat_ids), datetime.datetime.now() + datetime.timedelta(hours=rng.randrange(1, 48)))),
+        Benchmark('update_event_text', db.update_event_text, lambda rng: (rng.choice(chat_ids), f'Futsal {rng.randrange(100)} max 12')),
+        Benchmark('set_chat_lang', db.set_chat_lang, lambda rng: (rng.choice(chat_ids), rng.choice(('en', 'ru', 'uk')))),
+        Benchmark('register_new_chat_id', db.register_new_chat_id, lambda rng: (next(new_chat_ids), 'en'), iterations=0.1),
+        Benchmark('penalty_for_user_in_chat', db.penalty_for_user_in_chat, lambda rng: chat_member(rng) + (members[chat_ids[0]][0],), iterations=0.1),
+        Benchmark('fix_event', db.fix_event, chat, iterations=0.1, teardown=next_event),
+        Benchmark('close_all_open_events_for_chat', db.close_all_open_events_for_chat, chat, iterations=0.1, teardown=next_event),
+        Benchmark('event_add', db.event_add,
+                  lambda rng: (rng.choice(chat_ids), 'Futsal max 12', datetime.datetime.now() + datetime.timedelta(days=1), 12, 1, ''),
+                  iterations=0.1, setup=lambda chat_id, *_args: db.close_all_open_events_for_chat(chat_id)),
+        Benchmark('check_chat_member_stats', db.check_chat_member_stats, lambda rng: (), iterations=0.001),
+    ]
+
+
+def capture_statements(benchmark: Benchmark, rng: random.Random) -> List[str]:
+    """SQL statements (parameters expanded) executed by one call"""
+    statements: List[str] = []
+    db.MANAGER.on_connect = lambda conn: conn.set_trace_callback(statements.append)
+    db.MANAGER.close_all()
+    try:
+        args = benchmark.make_args(rng)
+        if benchmark.setup:
+            benchmark.setup(*args)
+        statements.clear()
+        benchmark.func(*args)
+        captured = list(statements)
+        if benchmark.teardown:
+            benchmark.teardown(*args)
+    finally:
+        db.MANAGER.on_connect = None
+        db.MANAGER.close_all()
+    return captured
+
+
+def query_plan(filename: str, statement: str) -> Dict:
+    conn = sqlite3.connect(filename)
+    try:
+        rows = conn.execute('EXPLAIN QUERY PLAN ' + statement).fetchall()
+    except sqlite3.Error as e:
+        return {'sql': statement, 'error': str(e)}
+    finally:
+        conn.close()
+    plan = [row[-1] for row in rows]
+    # SCAN of a table without index; scans of subqueries, CTEs and constant rows are not table scans
+    virtual = {step.split()[1] for step in plan if step.startswith(('CO-ROUTINE ', 'MATERIALIZE '))}
+    full_scan = any(step.startswith('SCAN ') and 'INDEX' not in step and step.split()[1] not in virtual
+                    and not step.startswith(('SCAN CONSTANT ROW', 'SCAN (subquery')) for step in plan)
+    return {'sql': statement, 'plan': plan, 'full_scan': full_scan}
+
+
+def is_query(statement: str) -> bool:
+    return statement.lstrip().split(None, 1)[0].upper() in ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'REPLACE')
+
+
+def run_benchmark(benchmark: Benchmark, iterations: int, rng: random.Random, filename: str) -> Dict:
+    queries = [query_plan(filename, statement) for statement in capture_statements(benchmark, rng) if is_query(statement)]
+    samples = []
+    for _ in range(max(1, int(iterations * benchmark.iterations))):
+        args = benchmark.make_args(rng)
+        if benchmark.setup:
+            benchmark.setup(*args)
+        started = time.perf_counter()
+        benchmark.func(*args)
+        samples.append(time.perf_counter() - started)
+        if benchmark.teardown:
+            benchmark.teardown(*args)
+    cuts = statistics.quantiles(samples * 2 if len(samples) < 2 else samples, n=100, method='inclusive')
+    return {'calls': len(samples), 'mean_us': statistics.fmean(samples) * 1e6, 'p50_us': cuts[49] * 1e6, 'p95_us': cuts[94] * 1e6,
+            'p99_us': cuts[98] * 1e6, 'ops_per_sec': len(samples) / sum(samples), 'queries': queries,
+            'full_scans': sum(1 for query in queries if query.get('full_scan'))}
+
+
+def run(args, filename: str) -> Dict:
+    if not has_history(filename):
+        started = time.perf_counter()
+        populate(filename, int(args.chats * args.scale), int(args.events * args.scale), int(args.participations * args.scale), args.members, args.seed)
+        logger.warning(f'Generated {filename} in {time.perf_counter() - started:.1f}s')
+    db.use_database(filename)
+    db.migrate()
+    if args.no_cache:
+        for cache in db.CACHES:
+            cache.maxsize = 0
+    members = load_members(filename)
+    rng = random.Random(args.seed)
+    result = {'meta': {'sizes': table_sizes(filename), 'iterations': args.iterations, 'cache': not args.no_cache, 'seed': args.seed,
+                       'sqlite': sqlite3.sqlite_version, 'python': platform.python_version(), 'time': datetime.datetime.now().isoformat()},
+              'functions': {}}
+    for benchmark in benchmarks(members):
+        if args.only and benchmark.name not in args.only:
+            continue
+        result['functions'][benchmark.name] = run_benchmark(benchmark, args.iterations, rng, filename)
+    db.close_connections()
+    return result
+
+
+def print_report(result: Dict):
+    print(f"Database: {result['meta']['sizes']}, cache: {result['meta']['cache']}")
+    print(f"{'function':<40}{'calls':>7}{'mean us':>10}{'p50 us':>10}{'p95 us':>10}{'p99 us':>10}{'ops/s':>10}  full scans")
+    for name, stats in result['functions'].items():
+        print(f"{name:<40}{stats['calls']:>7}{stats['mean_us']:>10.1f}{stats['p50_us']:>10.1f}{stats['p95_us']:>10.1f}{stats['p99_us']:>10.1f}"
+              f"{stats['ops_per_sec']:>10.0f}  {stats['full_scans'] or ''}")
+    for name, stats in result['functions'].items():
+        for query in stats['queries']:
+            if query.get('full_scan'):
+                print(f"\nFULL SCAN in {name}: {' '.join(query['sql'].split())}\n    " + '\n    '.join(query['plan']))
+
+
+def compare(before_file: str, after_file: str):
+    with open(before_file, encoding='utf-8') as f:
+        before = json.load(f)['functions']
+    with open(after_file, encoding='utf-8') as f:
+        after = json.load(f)['functions']
+    print(f"{'function':<40}{'p50 before':>12}{'p50 after':>12}{'ratio':>8}{'scans':>8}")
+    for name in after:
+        if name not in before:
+            continue
+        old, new = before[name], after[name]
+        print(f"{name:<40}{old['p50_us']:>12.1f}{new['p50_us']:>12.1f}{new['p50_us'] / old['p50_us']:>8.2f}"
+              f"{old['full_scans']:>4}->{new['full_scans']}")
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Benchmark db.py functions on a generated (or copied) database')
+    arg_parser.add_argument('--db', default='', help='database file, generated if empty/missing and kept; default - temporary')
+    arg_parser.add_argument('--chats', type=int, default=5000)
+    arg_parser.add_argument('--events', type=int, default=200000, help='events in total (one open event per chat)')
+    arg_parser.add_argument('--participations', type=int, default=3000000, help='Participants rows in total')
+    arg_parser.add_argument('--members', type=int, default=40, help='users per chat')
+    arg_parser.add_argument('--scale', type=float, default=1.0, help='multiply --chats, --events and --participations')
+    arg_parser.add_argument('--iterations', type=int, default=1000, help='calls per function (fewer for heavy ones)')
+    arg_parser.add_argument('--only', nargs='*', help='benchmark only these functions')
+    arg_parser.add_argument('--no-cache', action='store_true', help='disable db.py caches (measure SQL only)')
+    arg_parser.add_argument('--seed', type=int, default=1)
+    arg_parser.add_argument('--output', default='', help='write JSON results to this file')
+    arg_parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='compare two JSON results and exit')
+    args = arg_parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level='WARNING')
+
+    if args.compare:
+        compare(*args.compare)
+        sys.exit()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        result = run(args, args.db or f'{tmp_dir}/benchmark.sqlite3')
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2)
+    print_report(result)
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""In-memory caches in front of sqlite3 database (see db.py). Thread-safe, bounded, LRU.
+
+Cached values are immutable (NamedTuples/tuples): writers replace them, readers never see half-updated state.
+Caches assume that this process is the only writer of the database; use maxsize=0 to disable a cache.
+"""
+
+import bisect
+import threading
+from array import array
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Iterable, NamedTuple, Optional, Set, Tuple
+
+
+class LRUCache:
+    """Bounded mapping with least-recently-used eviction and hit/miss counters"""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: 'OrderedDict[Hashable, Any]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._put(key, value)
+
+    def _put(self, key: Hashable, value: Any):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def update(self, key: Hashable, func: Callable[[Any], Any]):
+        """Replace cached value with func(value). Does nothing on miss (next read loads it from the database)."""
+        with self._lock:
+            if key in self._data:
+                self._data[key] = func(self._data[key])
+
+    def invalidate(self, key: Hashable):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {'size': len(self._data), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+class CachedUser(NamedTuple):
+    first_name: str
+    last_name: str
+    username: str
+    full_name: str  # composed printable name, see db.format_full_name()
+
+
+class CachedEvent(NamedTuple):
+    event_id: int
+    description: str
+    datetime: str
+    players_limit: int
+    participants: Tuple[Tuple[int, str], ...]  # (user_id, operation_datetime) ordered by operation_datetime
+    revoked: Tuple[Tuple[int, str], ...]  # (user_id, operation_datetime) ordered by operation_datetime
+
+
+class CachedChat(NamedTuple):
+    event: Optional[CachedEvent]  # None - no open event in this chat
+    latest_bot_message_id: int
+    latest_bot_message_text: str
+
+
+def _without_user(operations: Tuple[Tuple[int, str], ...], user_id: int) -> Tuple[Tuple[int, str], ...]:
+    return tuple(op for op in operations if op[0] != user_id)
+
+
+class OpenEventCache(LRUCache):
+    """chat_id -> CachedChat: open event row, ordered participants and revoked users, latest bot message.
+
+    Kept up to date by every write function in db.py once its transaction is committed (db.after_commit()), loaded from database on miss.
+    """
+
+    def set_event(self, chat_id: int, event: Optional[CachedEvent]):
+        self.update(chat_id, lambda chat: chat._replace(event=event))
+
+    def update_event(self, chat_id: int, **fields):
+        self.update(chat_id, lambda chat: chat._replace(event=chat.event._replace(**fields)) if chat.event else chat)
+
+    def set_latest_bot_message(self, chat_id: int, message_id: int, message_text: str):
+        self.update(chat_id, lambda chat: chat._replace(latest_bot_message_id=message_id, latest_bot_message_text=message_text))
+
+    def apply(self, chat_id: int, user_id: int, operation_datetime: str):
+        """Same as INSERT OR REPLACE INTO Participants + DELETE FROM Revoked: user goes to the end of the list"""
+        self.update_event_with(chat_id, lambda event: event._replace(
+            participants=_without_user(event.participants, user_id) + ((user_id, operation_datetime),),
+            revoked=_without_user(event.revoked, user_id)))
+
+    def revoke(self, chat_id: int, user_id: int, operation_datetime: str):
+        """Same as INSERT OR REPLACE INTO Revoked + DELETE FROM Participants"""
+        self.update_event_with(chat_id, lambda event: event._replace(
+            participants=_without_user(event.participants, user_id),
+            revoked=_without_user(event.revoked, user_id) + ((user_id, operation_datetime),)))
+
+    def update_event_with(self, chat_id: int, func: Callable[[CachedEvent], CachedEvent]):
+        self.update(chat_id, lambda chat: chat._replace(event=func(chat.event)) if chat.event else chat)
+
+
+class ChatIdIndex:
+    """Compact membership index of registered chat_ids: 8 bytes per chat instead of a Python set of ints.
+
+    Sorted array('q') searched with bisect (O(log n)) plus a small set of chats added since the last merge.
+    A miss is only a hint that the chat may be new: the caller registers it with INSERT ... ON CONFLICT DO NOTHING,
+    so chats registered meanwhile by other processes sharing the database are handled, and then add()s it.
+    """
+
+    def __init__(self, sorted_chat_ids: Iterable[int] = (), merge_at: int = 1024):
+        self._sorted = array('q', sorted_chat_ids)  # ascending, replaced (not modified) on merge: readers need no lock
+        self._recent: Set[int] = set()
+        self.merge_at = merge_at
+        self._lock = threading.Lock()
+
+    def __contains__(self, chat_id: int) -> bool:
+        if chat_id in self._recent:
+            return True
+        ids = self._sorted
+        i = bisect.bisect_left(ids, chat_id)
+        return i < len(ids) and ids[i] == chat_id
+
+    def __len__(self) -> int:
+        return len(self._sorted) + len(self._recent)
+
+    def extend_sorted(self, chat_ids: Iterable[int]):
+        """Append chat_ids greater than all indexed ones, in ascending order (bulk load)"""
+        with self._lock:
+            self._sorted.extend(chat_ids)
+
+    def add(self, chat_id: int):
+        with self._lock:
+            if chat_id in self:
+                return
+            self._recent.add(chat_id)
+            if len(self._recent) >= self.merge_at:
+                self._sorted = array('q', sorted(self._sorted.tolist() + list(self._recent)))
+                self._recent = set()
+
+    @property
+    def nbytes(self) -> int:
+        """Approximate memory of the sorted part (the set of recent chats is bounded by merge_at)"""
+        return self._sorted.buffer_info()[1] * self._sorted.itemsize
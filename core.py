@@ -0,0 +1,463 @@
+# -*- coding: utf-8 -*-
+"""Telegram-independent part of the bot: translations, parsing of user input and texts of bot messages.
+
+Shared by the threaded (sport_event_bot.py, python-telegram-bot v13) and asyncio
+(sport_event_bot_async.py, python-telegram-bot v20) engines.
+Functions here call db.py directly (blocking), the asyncio engine runs them in its DB executor.
+"""
+
+from typing import Any, Callable, Dict, Mapping, NamedTuple, Optional, Tuple
+from types import MappingProxyType
+from functools import wraps
+import inspect
+import gettext
+import datetime
+import math
+import time
+import re
+import threading
+from loguru import logger
+import db
+from cache import LRUCache
+from dateparse import DATE_PARSER
+
+
+def _(text) -> int:
+    """Keep text in English"""
+    return text
+
+
+CATALOGS = {  # Telegram language_code -> gettext domain in locale/ ('en': no translation)
+    'uk': 'ua',
+    'pt-br': 'pt',
+    'ru': 'ru',
+}
+EVENT_POST_TEXTS = (  # translated once per language, see LanguageBundle.texts; _() marks them for pygettext
+    _('Players limit'), _('Event date and time'), _('Event time out'), _('Time left'), _('days'), _('and'), _('hours'), _('Players list'),
+    _('Reserve'), _('Revoked applications'), _('No applications yet'), _('Played'), _('from'),
+)
+
+
+class LanguageBundle(NamedTuple):
+    """Everything a handler needs in one language, built once (see load_language_bundles) and never changed"""
+    lang: str  # Telegram language_code, '' - English
+    gettext: Callable[[str], str]
+    locale_id: str  # parsedatetime locale
+    texts: Mapping[str, str]  # EVENT_POST_TEXTS -> translation
+    keyboard: Any  # buttons of the event post (telegram InlineKeyboardMarkup, built by the engine)
+
+
+BUNDLES: Dict[str, LanguageBundle] = {}  # Telegram language_code -> bundle, '' - English; replaced as a whole
+_BUNDLES_LOCK = threading.Lock()
+
+
+def load_language_bundles(keyboard: Callable[[Callable[[str], str]], Any] = lambda _gettext: None) -> Dict[str, LanguageBundle]:
+    """Build bundles of English and all CATALOGS from locale/, keyboard(gettext) makes the event post buttons"""
+    global BUNDLES  # pylint: disable=W0603
+    started = time.perf_counter()
+    bundles = {}
+    for lang, domain in [('', None)] + list(CATALOGS.items()):
+        translate = _ if domain is None else gettext.translation(domain, localedir='locale', languages=[domain]).gettext
+        bundles[lang] = LanguageBundle(lang, translate, translate('en_US'), MappingProxyType({text: translate(text) for text in EVENT_POST_TEXTS}),
+                                       keyboard(translate))
+    BUNDLES = bundles
+    logger.info(f'Language bundles loaded: {", ".join(sorted(lang or "en" for lang in bundles))} in {(time.perf_counter() - started) * 1000:.1f} ms')
+    return bundles
+
+
+def get_bundle(lang: Optional[str]) -> LanguageBundle:
+    """Bundle of Telegram language_code, English if not supported. Loads bundles (without keyboards) if the engine did not."""
+    bundles = BUNDLES
+    if not bundles:
+        with _BUNDLES_LOCK:
+            bundles = BUNDLES or load_language_bundles()
+    return bundles.get(lang) or bundles['']
+
+
+def get_translator(lang: Optional[str]) -> Callable[[str], str]:
+    """gettext function for Telegram language_code, English (no translation) if not supported"""
+    return get_bundle(lang).gettext
+
+
+def with_language(func: Callable) -> Callable:
+    """Handler decorator (sync or async): context.lang = bundle of the user who sent the update"""
+    def set_language(update, context):
+        user = update.effective_user
+        context.lang = get_bundle(user.language_code if user else None)
+
+    if inspect.iscoroutinefunction(func):
+        @wraps(func)
+        async def wrapped_async(update, context):
+            set_language(update, context)
+            return await func(update, context)
+        return wrapped_async
+
+    @wraps(func)
+    def wrapped(update, context):
+        set_language(update, context)
+        return func(update, context)
+    return wrapped
+
+
+KNOWN_CHATS: Optional[db.ChatIdIndex] = None  # chats registered in database, see warm_up_known_chats()
+_KNOWN_CHATS_LOCK = threading.Lock()
+
+
+def warm_up_known_chats() -> db.ChatIdIndex:
+    """Load chat_ids registered in database (once). Called in background at startup or by the first update."""
+    global KNOWN_CHATS  # pylint: disable=W0603
+    with _KNOWN_CHATS_LOCK:
+        if KNOWN_CHATS is None:
+            started = time.perf_counter()
+            KNOWN_CHATS = db.get_known_chat_index()
+            logger.info(f'Known chats loaded: {len(KNOWN_CHATS)} ({KNOWN_CHATS.nbytes} bytes) in {(time.perf_counter() - started) * 1000:.1f} ms')
+        return KNOWN_CHATS
+
+
+def new_chat_id_memoization(chat_id: int, lang: str):
+    """Save every new unique CHAT_ID in database. Create new record in 'Chats'. Also save LANG."""
+    known_chats = KNOWN_CHATS if KNOWN_CHATS is not None else warm_up_known_chats()
+    if chat_id not in known_chats:
+        # not in the index of this process; another process sharing the database may have registered it already
+        if db.register_new_chat_id(chat_id, lang):
+            logger.info(f'New chat_id: {chat_id}. Known chats: {len(known_chats) + 1}')
+        known_chats.add(chat_id)
+
+
+@logger.catch
+def parse_datetime(str_datetime_in_free_form: str, locale_id: str = 'en_US') -> Optional[datetime.datetime]:
+    """Parse text for DATETIME in free form with RECURRENT library. locale_id: parsedatetime locale, e.g. _('en_US')"""
+    # cached by dateparse.DATE_PARSER, parsed in its worker processes; the DELTA checks below use the current time on every call
+    try:
+        found_date = DATE_PARSER.parse(str_datetime_in_free_form, locale_id, datetime.datetime.now())
+        if not found_date:
+            # logger.debug("Date in event name not found")
+            return None
+        # logger.debug(f"found date: {found_date}")
+        # Drop any suspicious results
+        delta = found_date - datetime.datetime.now()
+        if delta.days < 0:
+            logger.info(f"Time DELTA.days < 0 !!!  {delta.days}. ??? skipping...")
+            return None
+        if delta.days > 31:
+            logger.info(f"Time DELTA.days = {delta.days}. Suspicious, skipping...")
+            return None
+        logger.info(f"Delta: {delta.days}, {delta.seconds}")
+        return found_date
+    except TimeoutError as e:
+        logger.warning(f'Date parsing stopped ({e}), skipping: {str_datetime_in_free_form[:100]!r}')
+    except Exception as e:
+        logger.exception(e)
+    return None
+
+
+def parse_event_limit(event_text: str, default: int = 12) -> int:
+    """Find players LIMIT in event text"""
+    # this is our personal use-case, can be deleted or updated for real regex parsing LIMIT value (for fun?):
+    txt = event_text.lower()
+    limit_markers = ['maximum', 'max', 'limit', 'максимум', 'максимальн', 'макс', 'лимит', 'ограничени']
+    event_limit = default
+    for marker in limit_markers:
+        if marker in txt:
+            try:
+                number = re.search(marker + r'[\s\S]*?(\d+)', txt).group(1)
+                event_limit = int(number)
+            except:
+                continue
+    return event_limit
+
+
+@logger.catch
+def parse_cmd_arg(update, _context) -> str:
+    """Parse command with argument and return argument only"""
+    user_input = update.message.text
+    space_index = user_input.find(' ')
+    cmd_arg = user_input[space_index+1:].strip()
+    if space_index < 0 or not cmd_arg:
+        # show_help(update, _context)  # to show help or not?
+        return ''
+    cmd_arg = cmd_arg.replace('@zp_futsal_bot', '')
+    return cmd_arg
+
+
+RENDER_CACHE_SIZE = 2000  # chats whose rendered event post lines are kept, least recently used are evicted
+COUNTDOWN_MARK = '⏳'  # starts the countdown / time out line of the event post
+
+
+def countdown(event_datetime: datetime.datetime, now: datetime.datetime) -> Optional[Tuple[int, int]]:
+    """(days, hours) left as shown in the event post, None if the event time is out"""
+    if event_datetime < now:
+        return None
+    delta = event_datetime - now
+    return delta.days, round(delta.seconds / 60 / 60)
+
+
+def next_countdown_change(event_datetime: datetime.datetime, now: datetime.datetime) -> Optional[datetime.datetime]:
+    """First moment after now when countdown() changes, None if it never changes again (event time is out)"""
+    shown = countdown(event_datetime, now)
+    if shown is None:
+        return None
+    # days change at whole days left, rounded hours at half hours left: only multiples of 30 minutes left can change it
+    half_hours = math.ceil((event_datetime - now).total_seconds() / 1800) - 1
+    while True:
+        for late in (0, 1):  # seconds are truncated and x.5 hours rounded to even: the change is at the boundary or a second later
+            moment = event_datetime - datetime.timedelta(seconds=half_hours * 1800 - late)
+            if countdown(event_datetime, moment) != shown:  # always true a second after the time out
+                return moment
+        half_hours -= 1
+
+
+def player_name_with_cards(games_registered: int, penalties: int, full_name: str, texts: Mapping[str, str]) -> str:
+    """Add warning card to players names if needed"""
+    printable_name = full_name
+    games_played = games_registered - penalties
+    if games_registered < 5:
+        return printable_name
+    if not penalties:
+        return printable_name
+    printable_name_with_cards = printable_name
+    txt_played = texts['Played']
+    txt_from = texts['from']
+    if games_registered and penalties and games_played/games_registered < 0.9:
+        printable_name_with_cards = f'{printable_name}🟨 ({txt_played} {games_played} {txt_from} {games_registered})'
+    if games_registered and penalties and games_played/games_registered < 0.8:
+        printable_name_with_cards = f'{printable_name}🟨🟨 ({txt_played} {games_played} {txt_from} {games_registered})'
+    if games_registered and penalties and games_played/games_registered < 0.7:
+        printable_name_with_cards = f'{printable_name}🟨🟨🟨({txt_played} {games_played} {txt_from} {games_registered})'  # 🟥
+    return printable_name_with_cards
+
+
+class RenderedPost(NamedTuple):
+    """Event post of a chat as last rendered by EventPostRenderer, never changed after rendering"""
+    lang: str
+    lines: Dict[tuple, str]  # line key (everything the line depends on) -> line
+    players: Dict[int, Tuple[db.SnapshotPlayer, str]]  # user_id -> (player, name with cards and newline), without the number
+    canceled: Dict[int, Tuple[db.SnapshotRevoked, str]]  # user_id -> (revoked user, line)
+
+
+class EventPostRenderer:
+    """Event post texts rendered line by line: lines whose key is unchanged since the previous render of the chat are reused.
+
+    Also remembers a hash of the text posted in every chat (posted()), so unchanged posts are not edited.
+    """
+
+    def __init__(self, cache_size: int = RENDER_CACHE_SIZE):
+        self.posts = LRUCache(cache_size)  # chat_id -> RenderedPost
+        self.posted_hashes = LRUCache(cache_size)  # chat_id -> (message_id, hash of its text)
+        self.lines_reused = 0
+        self.lines_rendered = 0
+
+    def render(self, chat_id: int, event: db.EventSnapshot, bundle: LanguageBundle, now: datetime.datetime) -> str:
+        """Text of the event post, same as it always was: only the lines are cached, never the whole text"""
+        previous = self.posts.get(chat_id)
+        if previous is None or previous.lang != bundle.lang:
+            previous = RenderedPost(bundle.lang, {}, {}, {})
+        old = previous.lines
+        lines: Dict[tuple, str] = {}
+        players: Dict[int, Tuple[db.SnapshotPlayer, str]] = {}
+        canceled_lines: Dict[int, Tuple[db.SnapshotRevoked, str]] = {}
+        reused = 0
+        texts = bundle.texts
+
+        def line(key: tuple, make: Callable[..., str], *args) -> str:
+            nonlocal reused
+            text = old.get(key)
+            if text is None:
+                text = make(*args)
+            else:
+                reused += 1
+            lines[key] = text
+            return text
+
+        def user_line(rendered: dict, old_rendered: dict, item, make: Callable[..., str]) -> str:
+            # keyed by user_id, so a click moves or renders only the clicked user's line
+            nonlocal reused
+            cached = old_rendered.get(item.user_id)
+            if cached is not None and (cached[0] is item or cached[0] == item):
+                reused += 1
+                text = cached[1]
+            else:
+                text = make(item)
+            rendered[item.user_id] = (item, text)
+            return text
+
+        def player_name(player: db.SnapshotPlayer) -> str:
+            return player_name_with_cards(player.registrations, player.penalties, player.full_name, texts) + '\n'
+
+        def canceled_line(canceled: db.SnapshotRevoked) -> str:
+            # ~ 2022-06-04 02:11:54.377618 -> 2022-06-04 02:11
+            return f'      <s>{canceled.full_name} - {canceled.operation_datetime[:canceled.operation_datetime.rfind(":", 2)]}</s>\n'
+
+        parts = [line(('title', event.description), lambda: '⚽️"<b>' + event.description + '</b>"⚽️\n')]
+        players_limit = event.players_limit
+        if players_limit:
+            parts.append(line(('limit', players_limit), lambda: texts['Players limit'] + f': {players_limit}\n'))
+        if event.datetime:
+            event_datetime = datetime.datetime.fromisoformat(event.datetime)
+            parts.append(line(('datetime', event.datetime),
+                              lambda: '📅  ' + texts['Event date and time'] + f": {event_datetime.strftime('%Y-%m-%d, %H:%M')}\n"))
+            left = countdown(event_datetime, now)
+            parts.append(line(('countdown', left), lambda: '⏳ ' + texts['Event time out'] + '.\n' if left is None else
+                              '⏳ ' + texts['Time left'] + f': {left[0]} ' + texts['days'] + ' ' + texts['and'] + f' {left[1]} ' + texts['hours'] + '\n'))
+        parts.append(line(('players',), lambda: texts['Players list'] + ':\n\n'))
+
+        for n, player in enumerate(event.players, start=1):
+            if players_limit and n == players_limit + 1:
+                parts.append(line(('reserve',), lambda: '\t\t\n' + texts['Reserve'] + ':\n'))
+            in_reserve = bool(players_limit) and n >= players_limit + 1
+            # the number and the reserve indent depend on the position: added here, not kept in the cached line
+            parts += ('      ' if in_reserve else '👟', str(n), '. ', user_line(players, previous.players, player, player_name))
+
+        if event.revoked:
+            parts.append(line(('revoked',), lambda: '\n' + texts['Revoked applications'] + ':\n'))
+            for canceled in event.revoked:
+                parts.append(user_line(canceled_lines, previous.canceled, canceled, canceled_line))
+        elif not event.players:
+            parts.append(line(('empty',), lambda: '\n' + texts['No applications yet']))
+        else:
+            parts.append('\n')
+
+        self.lines_reused += reused
+        self.lines_rendered += len(lines) + len(players) + len(canceled_lines) - reused
+        self.posts.put(chat_id, RenderedPost(bundle.lang, lines, players, canceled_lines))
+        return ''.join(parts)
+
+    def posted(self, chat_id: int, message_id: int, text: str):
+        """text is now the text of the event post message_id"""
+        self.posted_hashes.put(chat_id, (message_id, hash(text)))
+
+    def changed(self, chat_id: int, message_id: int, text: str) -> bool:
+        """text differs from the posted one: compared by hash when posted() saw message_id, else with the latest text in database"""
+        posted = self.posted_hashes.get(chat_id)
+        if posted is not None and posted[0] == message_id:
+            return posted[1] != hash(text)
+        return text != db.get_latest_bot_message_text(chat_id)
+
+    def stats(self) -> Dict[str, int]:
+        return {'chats': len(self.posts), 'lines_reused': self.lines_reused, 'lines_rendered': self.lines_rendered}
+
+
+RENDERER = EventPostRenderer()
+
+
+@logger.catch
+def create_event_full_text(this_chat_id: int) -> str:
+    """Compose full text for telegram message for the event. Using LANG from chat_id (set by event creator)"""
+    event = db.get_event_snapshot(this_chat_id) or db.EMPTY_EVENT_SNAPSHOT
+    return RENDERER.render(this_chat_id, event, get_bundle(db.get_chat_lang(this_chat_id)), datetime.datetime.now())
+
+
+def changed_event_post(chat_id: int, message_id: int) -> Optional[str]:
+    """Current text of the event post message_id, None if it is the same as posted
+    or if it is not the latest post of the chat any more (its buttons were removed, a late edit would put them back)"""
+    if message_id != db.get_latest_bot_message_id(chat_id):
+        return None
+    text = create_event_full_text(chat_id)
+    return text if text is not None and RENDERER.changed(chat_id, message_id, text) else None
+
+
+def refreshed_event_post(chat_id: int) -> Optional[Tuple[int, str]]:
+    """(message_id, text) of the latest event post of the chat if it shows a countdown and its text changed, see countdown.py"""
+    message_id = db.get_latest_bot_message_id(chat_id)
+    if not message_id or not db.get_event_datetime(chat_id) or COUNTDOWN_MARK not in db.get_latest_bot_message_text(chat_id):
+        return None  # no open event with date/time, or the latest post is not a full event post (e.g. "New event created")
+    text = changed_event_post(chat_id, message_id)
+    return (message_id, text) if text else None
+
+
+def save_event_post(chat_id: int, message_id: int, text: str):
+    """Remember the event post sent or edited to text (database and RENDERER)"""
+    db.save_latest_bot_message(chat_id, message_id, text)
+    RENDERER.posted(chat_id, message_id, text)
+
+
+def new_event_text(event_text: str, _: Callable[[str], str]) -> str:
+    """Text of the message announcing new event (before anybody applied)"""
+    return _("New event created") + ":\n\n⚽️<b> " + event_text + " </b>⚽️"
+
+
+def squad_text(this_chat_id: int, _: Callable[[str], str]) -> str:
+    """Main list of the open event with counters as they will be after fixing the event"""
+    text = _('Current statistics for this chat room members:') +'\n<code>'
+    players_limit = db.get_event_limit(this_chat_id)
+    for position, userid in enumerate(db.get_event_users(this_chat_id), start=1):
+        if not players_limit or position <= players_limit:
+            try:
+                full_name = db.compose_full_name(userid)
+                games, penalties = db.get_chat_user_rp(this_chat_id, userid)
+                games = games + 1
+                text = text + f"{full_name} {games}/{penalties}\n"
+
+            except Exception as e:
+                logger.exception(e)
+    text = text + "</code>"
+    return text
+
+
+def stat_text(this_chat_id: int, _: Callable[[str], str]) -> str:
+    """Registrations / penalties of all chat members, '' if nobody ever applied"""
+    all_userids = db.get_only_chat_participants(this_chat_id)
+    if not all_userids:
+        return ''
+    text = _('Current statistics for this chat room members:') + '\n'
+    text = text + '<tg-spoiler>' + _('Registrations / Penalties') + '</tg-spoiler>\n'
+    text = text + '<code>'
+    # all_userids = fbotdb.get_all_userids()  # global stats, not used
+    for userid in all_userids:
+        printable_name = db.compose_full_name(userid)
+        registered, penalties = db.get_chat_user_rp(this_chat_id, userid)
+        text = text + "ID:{}, {:>2}/{}, Full Name: {}\n".format(userid, registered, penalties, printable_name)
+    text = text + '</code>'
+    return text
+
+
+def help_text(_: Callable[[str], str]) -> str:
+    return _("""
+Available BOT commands:
+
+/event_add TEXT
+Register new event
+
+/event_remove
+Remove open event
+
+/event_update TEXT
+Change event description
+
+/limit XX
+Set players limit
+
+/event_datetime DATE TIME
+Set event date and time in any format. It will parsed automatically.
+Example 1: 2023-01-30, 18:00
+Example2: tomorrow, 14:30
+
+/info
+Show event details
+
+/add
+Register yourself to the event
+
+/remove
+Revoke your application
+
+/fix
+Fix event statistics (increment participants counters)
+
+/penalty USERID
+Increase someone's PENALTY counter for  unreasonable skipping of the event without notification others.
+You can find USERID by command /stat
+
+/stat
+This group members statistics (registrations and penalties)
+""")
+
+
+def build_menu(buttons, n_cols, header_buttons=None, footer_buttons=None):
+    """Build menu from buttons for telegram message"""
+    menu = [buttons[i:i + n_cols] for i in range(0, len(buttons), n_cols)]
+    if header_buttons:
+        menu.insert(0, [header_buttons])
+    if footer_buttons:
+        menu.append([footer_buttons])
+    return menu
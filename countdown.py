@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""Countdown of event posts ("⏳ Time left: X days and Y hours") kept current without clicks.
+
+CountdownRefresher keeps a min-heap of chats whose open event has a date/time, keyed by the moment
+the countdown line of the post changes next (core.next_countdown_change: about once an hour, then "Event time out").
+Its thread sleeps until the earliest one and hands the chat to due(chat_id), which checks the post in this thread
+and queues an edit keyed by its message_id (SENDER in sport_event_bot.py, EDITS in sport_event_bot_async.py),
+so it is rate limited at the lowest priority and merged with clicks on the same post, and is sent only if the text changed. Nothing polls the Events table: events with a countdown are read
+once at start, handlers report new, re-dated and closed events with track() and forget().
+"""
+
+import heapq
+import datetime
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+from loguru import logger
+from core import next_countdown_change
+
+
+class CountdownRefresher:
+    """Timer heap of countdown changes, due chats are handed to due(chat_id) from the refresher thread"""
+
+    def __init__(self, due: Callable[[int], None]):
+        self.due = due
+        self._events: Dict[int, datetime.datetime] = {}  # chat_id -> date/time of its open event
+        self._wake: Dict[int, float] = {}  # chat_id -> time.time() of the next change
+        self._heap: List[Tuple[float, int]] = []  # (wake, chat_id), entries not matching _wake are stale
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._thread: Optional[threading.Thread] = None
+        self.refreshes = 0
+
+    def start(self, load: Callable[[], Iterable[Tuple[int, str]]] = lambda: ()):
+        """Start the thread; it tracks (chat_id, datetime) returned by load() first (db.get_countdown_events)
+        and refreshes their posts at once: countdowns may have changed while the bot was down"""
+        self._thread = threading.Thread(target=self._run, args=(load,), name='countdown', daemon=True)
+        self._thread.start()
+
+    def track(self, chat_id: int, event_datetime: Union[datetime.datetime, str, None], refresh: bool = False):
+        """The open event of the chat got this date/time (None or '' - no date/time, same as forget).
+        refresh: hand the chat to due() at once, not at the next change"""
+        if isinstance(event_datetime, str):
+            event_datetime = datetime.datetime.fromisoformat(event_datetime) if event_datetime else None
+        with self._cond:
+            if event_datetime is None:
+                self._forget(chat_id)
+                return
+            self._events[chat_id] = event_datetime
+            if refresh:
+                self._push(chat_id, time.time())
+            else:
+                self._schedule(chat_id, datetime.datetime.now())
+
+    def forget(self, chat_id: int):
+        """The chat has no open event any more"""
+        with self._cond:
+            self._forget(chat_id)
+
+    def stats(self) -> Dict[str, int]:
+        return {'tracked': len(self._wake), 'refreshes': self.refreshes}
+
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread:
+            self._thread.join()
+
+    def _forget(self, chat_id: int):
+        self._events.pop(chat_id, None)
+        self._wake.pop(chat_id, None)
+
+    def _schedule(self, chat_id: int, now: datetime.datetime):
+        moment = next_countdown_change(self._events[chat_id], now)
+        if moment is None:  # time is out, the text does not change any more
+            self._forget(chat_id)
+        else:
+            self._push(chat_id, moment.timestamp())
+
+    def _push(self, chat_id: int, wake: float):
+        self._wake[chat_id] = wake
+        heapq.heappush(self._heap, (wake, chat_id))
+        self._cond.notify()
+
+    def _run(self, load: Callable[[], Iterable[Tuple[int, str]]]):
+        try:
+            for chat_id, event_datetime in load():
+                self.track(chat_id, event_datetime, refresh=True)
+        except Exception as e:  # pylint: disable=W0703
+            logger.exception(e)
+        logger.info(f'Countdown refresher: {len(self._wake)} event posts with a countdown')
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopping:
+                        return
+                    now = time.time()
+                    if self._heap and self._wake.get(self._heap[0][1]) != self._heap[0][0]:
+                        heapq.heappop(self._heap)  # stale
+                        continue
+                    if self._heap and self._heap[0][0] <= now:
+                        break
+                    self._cond.wait(self._heap[0][0] - now if self._heap else None)
+                wake, chat_id = heapq.heappop(self._heap)
+                del self._wake[chat_id]
+                self._schedule(chat_id, datetime.datetime.fromtimestamp(max(now, wake)))
+                self.refreshes += 1
+            try:
+                self.due(chat_id)
+            except Exception as e:  # pylint: disable=W0703
+                logger.exception(e)
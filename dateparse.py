@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+"""Free-form date parsing (recurrent + parsedatetime) for core.parse_datetime: parsers built once, results cached.
+
+parsedatetime.Constants are built once per locale and shared (read only); RecurringEvent keeps state while parsing,
+so every thread gets its own instance per locale, with now_date set before each parse.
+
+Results are cached by (normalized text, locale, reference day): "tomorrow 19:00" gives the same date all day long.
+Phrases depending on the time of day ("in 2 hours") are detected on the first parse, by parsing again at another
+time of the same day, and are never cached.
+
+Text is cut to PARSE_MAX_LENGTH characters. Cache misses are parsed by ParserPool worker processes (--date-workers):
+waiting for a ready worker and for its result share one PARSE_TIMEOUT deadline, then TimeoutError is raised
+(the event gets no date/time), so a pasted wall of text can not hold a handler thread. A worker that timed out is killed
+and replaced by a spare started in advance, so the next parse does not wait for python to start and import the parsers.
+Without a pool, text is parsed in the calling thread.
+"""
+
+import time
+import queue
+import signal
+import argparse
+import datetime
+import threading
+import multiprocessing
+from typing import Any, Dict, Optional, Set, Tuple
+from cache import LRUCache
+
+
+DATE_CACHE_SIZE = 5000  # parsed phrases, least recently used are evicted. 0 - disabled
+PARSE_MAX_LENGTH = 200  # characters given to the parser, the rest of the text is ignored
+PARSE_WORKERS = 2  # worker processes of ParserPool, 0 - parse in the calling thread
+PARSE_TIMEOUT = 1.0  # seconds: waiting for a free worker and for the parse, together
+PARSE_SPARE_WORKERS = 1  # started workers kept aside, one replaces a worker killed on timeout at once
+WORKER_START_TIMEOUT = 30.0  # seconds: starting python and importing the parsers in a new worker, then it is replaced
+UNCACHEABLE = object()  # cached marker: the result depends on the time of day
+
+
+class DateParser:
+    """Per-locale parser registry with an LRU cache of results, thread-safe"""
+
+    def __init__(self, cache_size: int = DATE_CACHE_SIZE, max_length: int = PARSE_MAX_LENGTH):
+        self.cache = LRUCache(cache_size)  # (text, locale_id, date) -> (result,) or UNCACHEABLE
+        self.max_length = max_length
+        self.pool: Optional[ParserPool] = None
+        self.truncated = 0
+        self.uncacheable = 0  # phrases depending on the time of day
+        self.reparsed = 0  # their lookups: found in cache, parsed anyway
+        self._constants: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def constants(self, locale_id: str):
+        """parsedatetime.Constants of locale_id (24-hour clock), built once"""
+        consts = self._constants.get(locale_id)
+        if consts is None:
+            import parsedatetime  # pylint: disable=C0415  # imported on first use: slow import, see startup.py
+            with self._lock:
+                consts = self._constants.get(locale_id)
+                if consts is None:
+                    consts = parsedatetime.Constants(localeID=locale_id, usePyICU=False)
+                    consts.use24 = True
+                    self._constants[locale_id] = consts
+        return consts
+
+    def parser(self, locale_id: str):
+        """RecurringEvent of this thread for locale_id"""
+        parsers = getattr(self._local, 'parsers', None)
+        if parsers is None:
+            parsers = self._local.parsers = {}
+        parser = parsers.get(locale_id)
+        if parser is None:
+            from recurrent.event_parser import RecurringEvent  # pylint: disable=C0415
+            parser = parsers[locale_id] = RecurringEvent(parse_constants=self.constants(locale_id))
+        return parser
+
+    def parse_uncached(self, text: str, locale_id: str, now: datetime.datetime) -> Any:
+        """RecurringEvent.parse result: datetime, RRULE string for recurring events, or None"""
+        parser = self.parser(locale_id)
+        parser.now_date = now
+        return parser.parse(text)
+
+    def parse_new(self, text: str, locale_id: str, now: datetime.datetime) -> Tuple[Any, bool]:
+        """parse_uncached() result and whether it can be cached for the day (same result at another time of the day)"""
+        result = self.parse_uncached(text, locale_id, now)
+        return result, result == self.parse_uncached(text, locale_id, self._other_time_of_day(now))
+
+    def parse(self, text: str, locale_id: str, now: datetime.datetime) -> Any:
+        """parse_uncached() of the first max_length characters through the cache and the pool. TimeoutError from the pool"""
+        if len(text) > self.max_length:
+            self.truncated += 1
+            head = text[:self.max_length]
+            text = head if text[self.max_length].isspace() else head.rpartition(' ')[0] or head  # without the cut word
+        key = (' '.join(text.lower().split()), locale_id, now.date())
+        cached = self.cache.get(key)
+        if cached is UNCACHEABLE:
+            self.reparsed += 1
+            return self._run('parse_uncached', text, locale_id, now)
+        if cached is not None:
+            return cached[0]
+        result, cacheable = self._run('parse_new', text, locale_id, now)
+        if cacheable:
+            self.cache.put(key, (result,))
+        else:
+            self.uncacheable += 1
+            self.cache.put(key, UNCACHEABLE)
+        return result
+
+    def _run(self, method: str, *args) -> Any:
+        pool = self.pool
+        return getattr(self, method)(*args) if pool is None else pool.run(method, *args)
+
+    @staticmethod
+    def _other_time_of_day(now: datetime.datetime) -> datetime.datetime:
+        """A reference time one hour away from now, on the same day"""
+        shift = datetime.timedelta(hours=1)
+        return now - shift if (now + shift).date() != now.date() else now + shift
+
+    @property
+    def hits(self) -> int:
+        return self.cache.hits - self.reparsed
+
+    @property
+    def misses(self) -> int:
+        return self.cache.misses + self.reparsed
+
+    @property
+    def timeouts(self) -> int:
+        return self.pool.timeouts if self.pool else 0
+
+    def stats(self) -> Dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses, 'uncacheable': self.uncacheable, 'size': len(self.cache),
+                'truncated': self.truncated, 'timeouts': self.timeouts}
+
+    def stop(self):
+        """Stop the pool, parse in the calling thread from now on"""
+        pool, self.pool = self.pool, None
+        if pool:
+            pool.stop()
+
+
+def _worker_main(conn):
+    """ParserWorker process: runs DateParser methods received from conn"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C stops the bot, the bot stops its workers
+    parser = DateParser(cache_size=0)
+    parser.parser('en_US')  # imports
+    try:
+        conn.send('ready')
+        while True:
+            method, args = conn.recv()
+            try:
+                result = ('ok', getattr(parser, method)(*args))
+            except Exception as e:  # pylint: disable=W0703
+                result = ('error', e)
+            conn.send(result)
+    except (EOFError, OSError):  # pool stopped
+        return
+
+
+class ParserWorker:
+    """One worker process and its end of the pipe"""
+
+    def __init__(self, context):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn,), name='date-parser', daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.started = time.monotonic()
+        self.ready = False
+
+    def is_ready(self, timeout: float = 0.0) -> bool:
+        """Whether the worker has imported the parsers, waiting for it up to timeout seconds"""
+        if not self.ready:
+            try:
+                if self.conn.poll(timeout):
+                    self.conn.recv()
+                    self.ready = True
+            except (EOFError, OSError):  # died while starting
+                return False
+        return self.ready
+
+    def failed_to_start(self) -> bool:
+        return not self.ready and (not self.process.is_alive() or time.monotonic() - self.started > WORKER_START_TIMEOUT)
+
+    def kill(self):
+        """Kill the process without waiting for it, multiprocessing reaps it later"""
+        self.process.kill()
+        self.conn.close()
+
+
+class ParserPool:
+    """Worker processes parsing dates; a worker exceeding the timeout is killed and replaced"""
+
+    def __init__(self, workers: int = PARSE_WORKERS, timeout: float = PARSE_TIMEOUT, spares: int = PARSE_SPARE_WORKERS):
+        self.size = workers
+        self.timeout = timeout
+        self.spares = spares
+        self.timeouts = 0
+        self._context = multiprocessing.get_context('spawn')  # no fork of a process running threads
+        self._idle: 'queue.Queue[ParserWorker]' = queue.Queue()
+        self._spare: 'queue.Queue[ParserWorker]' = queue.Queue()  # started, not used until a worker is replaced
+        self._workers: Set[ParserWorker] = set()
+        self._lock = threading.Lock()
+        self._stopped = False
+
+    def start(self) -> 'ParserPool':
+        """Start workers; they get ready in the background"""
+        for _ in range(self.size):
+            self._idle.put(self._spawn())
+        for _ in range(self.spares):
+            self._spare.put(self._spawn())
+        return self
+
+    def run(self, method: str, *args) -> Any:
+        """DateParser.method(*args) in a worker. TimeoutError: no ready worker or no result within timeout (one deadline)"""
+        deadline = time.monotonic() + self.timeout
+        try:
+            worker = self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            self._count_timeout()
+            raise TimeoutError(f'all {self.size} date parser workers are busy') from None
+        if not worker.is_ready(max(0.0, deadline - time.monotonic())):  # still importing: waited for within the deadline
+            if worker.failed_to_start():
+                self._replace(worker)
+            else:
+                self._idle.put(worker)
+            self._count_timeout()
+            raise TimeoutError(f'date parser worker did not get ready within {self.timeout}s')
+        try:
+            worker.conn.send((method, args))
+            if not worker.conn.poll(max(0.0, deadline - time.monotonic())):
+                raise TimeoutError(f'date parsing took longer than {self.timeout}s')
+            status, value = worker.conn.recv()
+        except (TimeoutError, EOFError, OSError):
+            self._replace(worker)
+            self._count_timeout()
+            raise
+        self._idle.put(worker)
+        if status == 'error':
+            raise value
+        return value
+
+    def stop(self):
+        """Close all workers (idle ones exit, busy ones are killed)"""
+        with self._lock:
+            workers, self._workers = self._workers, set()
+            self._stopped = True
+        for worker in workers:
+            worker.conn.close()
+        for worker in workers:
+            worker.process.join(1)
+            if worker.process.is_alive():
+                worker.kill()
+
+    def _spawn(self) -> ParserWorker:
+        worker = ParserWorker(self._context)
+        with self._lock:
+            self._workers.add(worker)
+        return worker
+
+    def _replace(self, worker: ParserWorker):
+        """Kill the worker and put a spare in its place; the new spare is started in the background"""
+        with self._lock:
+            self._workers.discard(worker)
+            stopped = self._stopped
+        worker.kill()
+        if stopped:
+            return
+        try:
+            self._idle.put(self._spare.get_nowait())
+        except queue.Empty:  # spares are still starting (several timeouts in a row, or spares=0)
+            self._idle.put(self._spawn())
+            return
+        threading.Thread(target=self._add_spare, name='date-parser-spawn', daemon=True).start()
+
+    def _add_spare(self):
+        worker = self._spawn()
+        with self._lock:
+            stopped = self._stopped
+        if stopped:
+            worker.kill()
+        else:
+            self._spare.put(worker)
+
+    def _count_timeout(self):
+        with self._lock:
+            self.timeouts += 1
+
+
+DATE_PARSER = DateParser()
+
+
+def add_date_parser_arguments(arg_parser: argparse.ArgumentParser):
+    """Command line options of date parsing, shared by both engines"""
+    group = arg_parser.add_argument_group('date parsing')
+    group.add_argument('--date-workers', type=int, default=PARSE_WORKERS, help='date parser processes, 0 - parse in handler threads (no timeout)')
+    group.add_argument('--date-timeout', type=float, default=PARSE_TIMEOUT, help='seconds; a slower parse is stopped, the event has no date/time')
+
+
+def start_date_parser(args) -> DateParser:
+    """Start the DATE_PARSER pool configured by add_date_parser_arguments()"""
+    if args.date_workers > 0:
+        DATE_PARSER.pool = ParserPool(args.date_workers, args.date_timeout).start()
+    return DATE_PARSER
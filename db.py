@@ -1,12 +1,24 @@
 # -*- coding: utf-8 -*-
-"""This module works with sqlite3 database with 3 tables: Users, Chats, Events
+"""This module works with sqlite3 database with tables: Users, Chats, Events, Participants, Revoked, Penalties, ChatMemberStats
 """
 
 import sys
+import time
+import queue
+import bisect
+import inspect
+import itertools
+import argparse
 import sqlite3
+import threading
 import datetime
-from typing import List, Set, Tuple
+from concurrent.futures import Future
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Callable, ContextManager, Dict, Iterator, List, NamedTuple, Optional, Set, Tuple
 from loguru import logger
+from cache import CachedChat, CachedEvent, CachedUser, ChatIdIndex, LRUCache, OpenEventCache
 
 #pylint: disable=C0116
 
@@ -17,18 +29,528 @@ logger.add("logs/logs.log", level="DEBUG")
 logger.add(sys.stderr, level="DEBUG")
 
 
-@logger.catch
-def reconnect():
-    # return sqlite3.connect(DB_FILENAME, check_same_thread = False, isolation_level=None)
-    conn = sqlite3.connect(DB_FILENAME)
-    # Enable foreign key constraints
-    conn.execute('PRAGMA foreign_keys = ON;')
-    return conn
+class StorageProfile(NamedTuple):
+    journal_mode: str = 'WAL'  # readers and the writer do not block each other
+    synchronous: str = 'NORMAL'  # durable in WAL mode except on power loss, fsync only on checkpoints
+    busy_timeout_ms: int = 5000  # wait for locks instead of raising 'database is locked'
+
+
+STORAGE_PROFILE = StorageProfile()
+
+
+TRACE_HANDLER: ContextVar[str] = ContextVar('TRACE_HANDLER', default='')  # name of the bot handler processing the current update
+TRACE_BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 1000)  # upper bounds of histogram buckets, last one is +Inf
+
+
+def traced_handler(func: Callable) -> Callable:
+    """Attribute SQL statements executed while func runs (also in DB threads of db_async) to handler func.__name__"""
+    if inspect.iscoroutinefunction(func):
+        @wraps(func)
+        async def wrapped_async(*args, **kwargs):
+            token = TRACE_HANDLER.set(func.__name__)
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                TRACE_HANDLER.reset(token)
+        return wrapped_async
+
+    @wraps(func)
+    def wrapped(*args, **kwargs):
+        token = TRACE_HANDLER.set(func.__name__)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            TRACE_HANDLER.reset(token)
+    return wrapped
+
+
+class FunctionHistogram:
+    """Durations of SQL statements of one db.py function"""
 
+    def __init__(self):
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.buckets = [0] * (len(TRACE_BUCKETS_MS) + 1)
 
-def create_table_users():
-    conn = reconnect()
-    conn.execute('''CREATE TABLE Users
+    def add(self, ms: float):
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+        self.buckets[bisect.bisect_left(TRACE_BUCKETS_MS, ms)] += 1
+
+    def as_dict(self) -> Dict[str, object]:
+        cumulative = list(itertools.accumulate(self.buckets))
+        bounds = [str(bound) for bound in TRACE_BUCKETS_MS] + ['+Inf']
+        return {'count': self.count, 'total_ms': self.total_ms, 'max_ms': self.max_ms, 'buckets': dict(zip(bounds, cumulative))}
+
+
+class QueryTracer:
+    """Collects durations of traced statements: histograms per calling db.py function, totals per handler, slow-query log.
+
+    A statement lasts from execute() to the end of the last fetch*() of its cursor.
+    Statements slower than slow_ms are logged with their EXPLAIN QUERY PLAN to slow_log. The plan of a statement
+    reported by a garbage collected cursor is explained later, on the reader connection of the next thread executing SQL.
+    """
+
+    def __init__(self, slow_ms: float = 50.0, slow_log: str = 'logs/slow_queries.log'):
+        self.slow_ms = slow_ms
+        self.slow_log = slow_log
+        self.slow = 0
+        self.functions: Dict[str, FunctionHistogram] = {}
+        self.handlers: Dict[str, List[float]] = {}  # handler -> [statements, total ms]
+        self._unexplained: List[tuple] = []  # slow statements of garbage collected cursors: (sql, parameters, function, handler, ms)
+        self._lock = threading.Lock()
+        self._local = threading.local()  # explaining: opening the reader runs traced statements too
+        self._sink_id: Optional[int] = None
+
+    def start(self):
+        if self.slow_log:
+            self._sink_id = logger.add(self.slow_log, level='WARNING', filter=lambda record: 'slow_query' in record['extra'])
+
+    def stop(self):
+        if self._sink_id is not None:
+            logger.remove(self._sink_id)
+            self._sink_id = None
+
+    def record(self, conn: Optional[sqlite3.Connection], sql: str, parameters, function: str, handler: str, seconds: float):
+        """conn: the connection of the statement, None from garbage collection (any thread, no lock held): not used then"""
+        ms = seconds * 1000
+        with self._lock:
+            histogram = self.functions.get(function)
+            if histogram is None:
+                histogram = self.functions[function] = FunctionHistogram()
+            histogram.add(ms)
+            totals = self.handlers.setdefault(handler or '-', [0, 0.0])
+            totals[0] += 1
+            totals[1] += ms
+            slow = ms >= self.slow_ms
+            if slow:
+                self.slow += 1
+                if conn is None:
+                    self._unexplained.append((sql, parameters, function, handler, ms))
+                    return
+        if slow:
+            self._log_slow(conn, sql, parameters, function, handler, ms)
+
+    def explain_pending(self):
+        """Log slow statements of garbage collected cursors with their plans (reader connection of this thread)"""
+        if not self._unexplained or getattr(self._local, 'explaining', False):
+            return
+        with self._lock:
+            unexplained, self._unexplained = self._unexplained, []
+        self._local.explaining = True
+        try:
+            for statement in unexplained:
+                self._log_slow(reader(), *statement)
+        finally:
+            self._local.explaining = False
+
+    @staticmethod
+    def _log_slow(conn: sqlite3.Connection, sql: str, parameters, function: str, handler: str, ms: float):
+        plan = '\n'.join(f'    {line}' for line in query_plan(conn, sql, parameters))
+        logger.bind(slow_query=True).warning(f"Slow query {ms:.1f} ms in {function} (handler {handler or '-'}): "
+                                             f"{' '.join(sql.split())} {parameters!r}\n{plan}")
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            return {'slow_ms': self.slow_ms, 'slow': self.slow,
+                    'functions': {name: histogram.as_dict() for name, histogram in self.functions.items()},
+                    'handlers': {name: {'statements': statements, 'total_ms': total_ms} for name, (statements, total_ms) in self.handlers.items()}}
+
+    def summary(self, top: int = 15) -> List[str]:
+        """Report lines: functions with the largest total time"""
+        self.explain_pending()
+        with self._lock:
+            functions = sorted(self.functions.items(), key=lambda item: item[1].total_ms, reverse=True)[:top]
+            lines = [f'{name}: {h.count} statement(s), {h.total_ms:.1f} ms total, {h.total_ms / h.count:.3f} ms avg, {h.max_ms:.1f} ms max'
+                     for name, h in functions]
+        return lines + [f'{self.slow} statement(s) slower than {self.slow_ms} ms']
+
+
+def query_plan(conn: sqlite3.Connection, sql: str, parameters) -> List[str]:
+    """EXPLAIN QUERY PLAN lines of a statement (untraced cursor, works inside the current transaction)"""
+    try:
+        rows = sqlite3.Cursor(conn).execute('EXPLAIN QUERY PLAN ' + sql, parameters).fetchall()
+    except (sqlite3.Error, ValueError) as e:
+        return [f'no plan: {e}']
+    return [detail for _id, _parent, _unused, detail in rows]
+
+
+def _traced_function(frame) -> str:
+    """Name of the nearest db.py function on the stack (module.function of the caller for SQL from other modules)"""
+    outside = ''
+    while frame is not None:
+        code = frame.f_code
+        if code not in _TRACE_WRAPPERS:
+            if frame.f_globals is _GLOBALS:
+                return code.co_name
+            if not outside:
+                outside = f"{frame.f_globals.get('__name__')}.{code.co_name}"
+        frame = frame.f_back
+    return outside or '?'
+
+
+class TracedCursor(sqlite3.Cursor):
+    """Cursor timing its statements for TRACER, see enable_tracing()"""
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self._statement: Optional[list] = None  # [sql, parameters, function, handler, seconds]
+
+    def execute(self, sql, parameters=()):
+        self._finish()
+        statement = [sql, parameters, _traced_function(sys._getframe(1)), TRACE_HANDLER.get(), 0.0]  #pylint: disable=W0212
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            statement[4] = time.perf_counter() - started
+            self._statement = statement
+
+    def executemany(self, sql, seq_of_parameters):
+        self._finish()
+        statement = [sql, (), _traced_function(sys._getframe(1)), TRACE_HANDLER.get(), 0.0]  #pylint: disable=W0212
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            statement[4] = time.perf_counter() - started
+            self._statement = statement
+
+    def fetchone(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            self._fetched(time.perf_counter() - started)
+
+    def fetchmany(self, *args):
+        started = time.perf_counter()
+        try:
+            return super().fetchmany(*args)
+        finally:
+            self._fetched(time.perf_counter() - started)
+
+    def fetchall(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            self._fetched(time.perf_counter() - started)
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def __del__(self):
+        self._finish(collected=True)
+
+    def _fetched(self, seconds: float):
+        if self._statement:
+            self._statement[4] += seconds
+
+    def _finish(self, collected: bool = False):
+        """Report the previous statement of this cursor (on next execute, close or garbage collection).
+        collected: the connection may be the writer used by another thread, the tracer must not run EXPLAIN on it"""
+        statement, self._statement = getattr(self, '_statement', None), None
+        tracer = TRACER
+        if tracer:
+            if statement:
+                tracer.record(None if collected else self.connection, *statement)
+            if not collected:
+                tracer.explain_pending()
+
+
+class TracedConnection(sqlite3.Connection):
+    """Connection factory of enable_tracing(): every cursor is a TracedCursor"""
+
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+_GLOBALS = globals()
+_TRACE_WRAPPERS = {func.__code__ for func in (TracedCursor.execute, TracedCursor.executemany, TracedConnection.execute,
+                                              TracedConnection.executemany)}
+TRACER: Optional[QueryTracer] = None  # None - tracing disabled, connections are plain sqlite3.Connection
+
+
+class ConnectionManager:
+    """Long-lived sqlite3 connections, opened once with PRAGMAs set once and reused by all queries.
+
+    All writes go through one writer connection serialized by a lock,
+    reads use a read-only (query_only) connection per thread.
+    """
+
+    def __init__(self, filename: str, profile: StorageProfile = STORAGE_PROFILE):
+        self.filename = filename
+        self.profile = profile
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.write_lock = threading.RLock()
+        self._writer: Optional[sqlite3.Connection] = None
+        self._after_commit: Optional[List[Callable[[], None]]] = None  # of the open writer() transaction
+        self._connections: List[sqlite3.Connection] = []
+        self.on_connect: Optional[Callable[[sqlite3.Connection], None]] = None  # called for every new connection (instrumentation)
+
+    def _open(self, read_only: bool) -> sqlite3.Connection:
+        # check_same_thread=False: the writer is shared between threads (under _write_lock)
+        # and close_all() is called from the main thread on shutdown
+        conn = sqlite3.connect(self.filename, check_same_thread=False, timeout=self.profile.busy_timeout_ms / 1000,
+                               factory=TracedConnection if TRACER else sqlite3.Connection)
+        # Enable foreign key constraints
+        conn.execute('PRAGMA foreign_keys = ON;')
+        conn.execute(f'PRAGMA busy_timeout = {int(self.profile.busy_timeout_ms)};')
+        if read_only:
+            conn.execute('PRAGMA query_only = ON;')
+        else:
+            mode = conn.execute(f'PRAGMA journal_mode = {self.profile.journal_mode};').fetchone()[0]
+            if mode.upper() != self.profile.journal_mode.upper():
+                logger.warning(f"Can not switch {self.filename} to journal_mode={self.profile.journal_mode}, using {mode}")
+            conn.execute(f'PRAGMA synchronous = {self.profile.synchronous};')
+        if self.on_connect:
+            self.on_connect(conn)
+        with self._lock:
+            self._connections.append(conn)
+        return conn
+
+    def reader(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._open(read_only=True)
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def writer(self) -> Iterator[sqlite3.Connection]:
+        """Exclusive use of the writer connection inside a transaction (committed on exit, rolled back on error).
+
+        Functions passed to after_commit() inside it are called after the commit, still under the write lock.
+        """
+        with self.write_lock:
+            if self._writer is None:
+                self._writer = self._open(read_only=False)
+            if self._after_commit is not None:  # nested: the outer writer() commits and calls them
+                yield self._writer
+                return
+            self._after_commit = []
+            try:
+                with self._writer:
+                    yield self._writer
+                callbacks = self._after_commit
+            finally:
+                self._after_commit = None
+            for callback in callbacks:
+                callback()
+
+    def after_commit(self, func: Callable[[], None]):
+        """Call func when the writer() transaction of this thread is committed; never called if it is rolled back"""
+        if self._after_commit is None:
+            raise RuntimeError('after_commit() outside of writer()')
+        self._after_commit.append(func)
+
+    def after_commit_mark(self) -> int:
+        """Position to discard_after_commit() to, e.g. when rolling back to a savepoint"""
+        return len(self._after_commit or ())
+
+    def discard_after_commit(self, mark: int):
+        if self._after_commit is not None:
+            del self._after_commit[mark:]
+
+    def close_all(self):
+        with self.write_lock, self._lock:
+            connections, self._connections = self._connections, []
+            self._local = threading.local()  # every thread will reopen on next use
+            self._writer = None
+        for conn in connections:
+            try:
+                conn.close()
+            except sqlite3.Error as e:
+                logger.warning(f"Error while closing connection: {e}")
+        logger.info(f"Closed {len(connections)} database connection(s)")
+
+
+MANAGER = ConnectionManager(DB_FILENAME)
+
+
+def reader() -> sqlite3.Connection:
+    return MANAGER.reader()
+
+
+def writer() -> ContextManager[sqlite3.Connection]:
+    return MANAGER.writer()
+
+
+def after_commit(func: Callable[[], None]):
+    """Cache updates of a write: applied once the database has it, so readers never see a cache ahead of the database"""
+    MANAGER.after_commit(func)
+
+
+ParticipationWrite = Callable[[sqlite3.Connection, int, int, datetime.datetime], None]
+
+
+class GroupCommitQueue:
+    """Write-behind queue for participation changes (apply/revoke) during sign-up bursts.
+
+    Operations arriving within `window` seconds are committed in one writer transaction (one commit),
+    each inside its own SAVEPOINT so a failing one does not affect the others.
+    Futures are resolved when the transaction is committed: with STORAGE_PROFILE.synchronous = NORMAL
+    the write survives a crash of the bot, not a power loss (no fsync at commit, see StorageProfile).
+    operation_datetime is taken when an operation is queued and the queue is FIFO,
+    so main list / reserve order is exactly the order of arrival.
+    """
+
+    def __init__(self, window: float, max_batch: int = 500):
+        self.window = window
+        self.max_batch = max_batch
+        self._queue: 'queue.Queue[Optional[tuple]]' = queue.Queue()
+        self._submit_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='db-group-commit', daemon=True)
+        self.batches = 0
+        self.operations = 0
+        self._thread.start()
+
+    def submit(self, operation: ParticipationWrite, chat_id: int, user_id: int, wait: bool) -> Future:
+        future: Future = Future()
+        with self._submit_lock:  # timestamps are increasing in queue order
+            self._queue.put((operation, chat_id, user_id, datetime.datetime.now(), future))
+        if wait:
+            future.result()
+        return future
+
+    def stop(self):
+        """Commit everything queued so far and stop the thread"""
+        self._queue.put(None)
+        self._thread.join()
+        late = []  # submitted concurrently with stop()
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                late.append(item)
+        if late:
+            self._commit(late)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._commit(batch)
+
+    def _commit(self, batch: List[tuple]):
+        errors: Dict[int, Exception] = {}  # index in batch -> error of that operation, rolled back to its savepoint
+        failure: Optional[BaseException] = RuntimeError('group commit did not finish')  # of the whole batch
+        try:
+            with writer() as conn:
+                conn.execute('BEGIN;')
+                for index, (operation, chat_id, user_id, dtm, _future) in enumerate(batch):
+                    conn.execute('SAVEPOINT participation;')
+                    mark = MANAGER.after_commit_mark()
+                    try:
+                        operation(conn, chat_id, user_id, dtm)
+                        conn.execute('RELEASE participation;')
+                    except Exception as e:  # pylint: disable=W0703  # not only sqlite3.Error: e.g. OverflowError of a too large id
+                        conn.execute('ROLLBACK TO participation;')
+                        conn.execute('RELEASE participation;')
+                        MANAGER.discard_after_commit(mark)  # its cache updates
+                        errors[index] = e
+            failure = None
+            self.batches += 1
+            self.operations += len(batch)
+        except Exception as e:  # pylint: disable=W0703  # the thread must survive: later operations are still committed
+            logger.error(f"Group commit of {len(batch)} operation(s) failed: {e!r}")
+            failure = e
+        finally:
+            for index, (_, chat_id, _, _, future) in enumerate(batch):  # every caller waiting on a Future gets an answer
+                error = failure or errors.get(index)
+                if error:
+                    OPEN_EVENTS.invalidate(chat_id)
+                    future.set_exception(error)
+                else:
+                    future.set_result(None)
+
+
+GROUP_COMMIT: Optional[GroupCommitQueue] = None
+
+
+def enable_group_commit(window: float = 0.02):
+    """Batch apply/revoke writes arriving within `window` seconds into one transaction"""
+    global GROUP_COMMIT  #pylint: disable=W0603
+    disable_group_commit()
+    GROUP_COMMIT = GroupCommitQueue(window)
+    logger.info(f"Group commit enabled, window {window}s")
+
+
+def disable_group_commit():
+    """Flush queued writes and go back to one transaction per write"""
+    global GROUP_COMMIT  #pylint: disable=W0603
+    if GROUP_COMMIT:
+        group_commit, GROUP_COMMIT = GROUP_COMMIT, None
+        group_commit.stop()
+        logger.info(f"Group commit disabled: {group_commit.operations} operation(s) in {group_commit.batches} batch(es)")
+
+
+def close_connections():
+    """Flush group commit queue and close all pooled connections. Call it once the Updater has stopped."""
+    disable_group_commit()
+    MANAGER.close_all()
+
+
+def enable_tracing(slow_ms: float = 50.0, slow_log: str = 'logs/slow_queries.log') -> QueryTracer:
+    """Time every SQL statement (see QueryTracer). Open connections are closed, they are reopened traced on next use."""
+    global TRACER  #pylint: disable=W0603
+    disable_tracing()
+    tracer = QueryTracer(slow_ms, slow_log)
+    tracer.start()
+    with MANAGER.write_lock:
+        TRACER = tracer
+        MANAGER.close_all()
+    logger.info(f"SQL tracing enabled, slow query threshold {slow_ms} ms")
+    return tracer
+
+
+def disable_tracing():
+    """Go back to plain untraced connections"""
+    global TRACER  #pylint: disable=W0603
+    if TRACER:
+        with MANAGER.write_lock:
+            tracer, TRACER = TRACER, None
+            MANAGER.close_all()
+        tracer.stop()
+        logger.info("SQL tracing disabled")
+
+
+def use_database(filename: str):
+    """Switch to another database file (load tests, benchmarks): close connections, drop caches"""
+    close_connections()
+    MANAGER.filename = filename
+    for cache in CACHES:
+        cache.clear()
+
+
+def create_table_users(conn: sqlite3.Connection):
+    conn.execute('''CREATE TABLE IF NOT EXISTS Users
          (user_id  INTEGER PRIMARY KEY     NOT NULL,
          first_name TEXT DEFAULT "",
          last_name  TEXT DEFAULT "",
@@ -38,16 +560,10 @@ def create_table_users():
          facebook TEXT DEFAULT "",
          extra TEXT DEFAULT ""
          );''')
-    conn.commit()
-    conn.close()
 
 
-def create_table_events():
-    conn = reconnect()
-    conn.execute("PRAGMA foreign_keys = 1;")
-    conn.commit()
-    cur=conn.cursor()
-    cur.execute('''CREATE TABLE Events
+def create_table_events(conn: sqlite3.Connection):
+    conn.execute('''CREATE TABLE IF NOT EXISTS Events
          (event_id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
          chat_id INTEGER,
          status TEXT DEFAULT "Open",
@@ -59,13 +575,10 @@ def create_table_events():
          extra3 TEXT DEFAULT "",
          FOREIGN KEY(chat_id) REFERENCES Chats(chat_id)
          );''')
-    conn.commit()
-    conn.close()
 
 
-def create_table_chats():
-    conn = reconnect()
-    conn.execute('''CREATE TABLE Chats
+def create_table_chats(conn: sqlite3.Connection):
+    conn.execute('''CREATE TABLE IF NOT EXISTS Chats
          (chat_id INTEGER PRIMARY KEY NOT NULL,
          lang TEXT,
          priority_members TEXT DEFAULT "",
@@ -76,39 +589,30 @@ def create_table_chats():
          extra2 TEXT DEFAULT "",
          extra3 TEXT DEFAULT ""
          );''')
-    conn.commit()
-    conn.close()
 
 
-def create_table_participants():
-    conn = reconnect()
-    conn.execute('''CREATE TABLE Participants
+def create_table_participants(conn: sqlite3.Connection):
+    conn.execute('''CREATE TABLE IF NOT EXISTS Participants
          (event_id INT  NOT NULL,
          user_id INT,
          operation_datetime DATETIME NOT NULL,
          FOREIGN KEY(event_id) REFERENCES Events(event_id),
          UNIQUE(event_id, user_id)
          );''')
-    conn.commit()
-    conn.close()
 
 
-def create_table_revoked():
-    conn = reconnect()
-    conn.execute('''CREATE TABLE Revoked
+def create_table_revoked(conn: sqlite3.Connection):
+    conn.execute('''CREATE TABLE IF NOT EXISTS Revoked
          (event_id INT  NOT NULL,
          user_id INT,
          operation_datetime DATETIME NOT NULL,
          FOREIGN KEY(event_id) REFERENCES Events(event_id),
          UNIQUE(event_id, user_id)
          );''')
-    conn.commit()
-    conn.close()
 
 
-def create_table_chat_penalties():
-    conn = reconnect()
-    conn.execute('''CREATE TABLE Penalties
+def create_table_chat_penalties(conn: sqlite3.Connection):
+    conn.execute('''CREATE TABLE IF NOT EXISTS Penalties
         (chat_id INT,
         user_id INT,
         operation_datetime DATETIME NOT NULL,
@@ -117,8 +621,153 @@ def create_table_chat_penalties():
         FOREIGN KEY(user_id) REFERENCES Users(user_id),
         FOREIGN KEY(operator_id) REFERENCES Users(user_id)
         );''')
-    conn.commit()
-    conn.close()
+
+
+def create_table_chat_member_stats(conn: sqlite3.Connection):
+    # Maintained by write_participation(), write_revocation() and penalty_for_user_in_chat(), see check_chat_member_stats()
+    conn.execute('''CREATE TABLE IF NOT EXISTS ChatMemberStats
+        (chat_id INT NOT NULL,
+        user_id INT NOT NULL,
+        registrations INT NOT NULL DEFAULT 0,
+        penalties INT NOT NULL DEFAULT 0,
+        PRIMARY KEY(chat_id, user_id)
+        ) WITHOUT ROWID;''')
+
+
+# Registrations = Participants rows of all events of the chat (open, closed and fixed), penalties = Penalties rows
+CHAT_MEMBER_STATS_FROM_HISTORY_SQL = '''
+    SELECT chat_id, user_id, SUM(registrations), SUM(penalties)
+    FROM (
+        SELECT e.chat_id, p.user_id, 1 AS registrations, 0 AS penalties
+        FROM Participants AS p JOIN Events AS e ON e.event_id = p.event_id
+        WHERE e.chat_id IS NOT NULL AND p.user_id IS NOT NULL
+        UNION ALL
+        SELECT chat_id, user_id, 0, 1 FROM Penalties WHERE chat_id IS NOT NULL AND user_id IS NOT NULL
+    )
+    GROUP BY chat_id, user_id
+'''
+
+
+def create_hot_query_indexes(conn: sqlite3.Connection):
+    # get_event_* / get_event_snapshot / get_only_chat_participants: open (or any) events of a chat
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_events_chat_status ON Events(chat_id, status);''')
+    # get_event_users: participants of an event in operation_datetime order, covering
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_participants_event_datetime ON Participants(event_id, operation_datetime, user_id);''')
+    # get_chat_user_rp: registrations of one user, then filtered by the chat's events
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_participants_user_event ON Participants(user_id, event_id);''')
+    # get_event_revoked_users / get_user_cancellation_datetime, covering.
+    # Lookups by (event_id, user_id) alone are already served by the UNIQUE constraint index.
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_revoked_event_datetime ON Revoked(event_id, operation_datetime, user_id);''')
+    # get_chat_user_rp: penalties count
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_penalties_chat_user ON Penalties(chat_id, user_id);''')
+
+
+def migration_1_base_schema(conn: sqlite3.Connection):
+    # IF NOT EXISTS: databases created before migrations existed already have these tables
+    create_table_users(conn)
+    create_table_chats(conn)
+    create_table_events(conn)
+    create_table_participants(conn)
+    create_table_revoked(conn)
+    create_table_chat_penalties(conn)
+
+
+def migration_2_hot_query_indexes(conn: sqlite3.Connection):
+    create_hot_query_indexes(conn)
+
+
+def migration_3_chat_member_stats(conn: sqlite3.Connection):
+    create_table_chat_member_stats(conn)
+    conn.execute('DELETE FROM ChatMemberStats;')
+    conn.execute('INSERT INTO ChatMemberStats(chat_id, user_id, registrations, penalties) ' + CHAT_MEMBER_STATS_FROM_HISTORY_SQL + ';')
+
+
+def migration_4_countdown_events_index(conn: sqlite3.Connection):
+    # get_countdown_events: open events with a date/time still ahead, without a full scan of Events
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_events_status_datetime ON Events(status, datetime);''')
+
+
+# Schema version N is reached by applying MIGRATIONS[N-1]. Only append new migrations, never edit applied ones.
+MIGRATIONS = [
+    migration_1_base_schema,
+    migration_2_hot_query_indexes,
+    migration_3_chat_member_stats,
+    migration_4_countdown_events_index,
+]
+
+
+def get_schema_version(conn: sqlite3.Connection) -> int:
+    return conn.execute('PRAGMA user_version;').fetchone()[0]
+
+
+def migrate() -> int:
+    """Upgrade database schema in place to the latest version (tracked in PRAGMA user_version). Returns the version."""
+    with writer() as conn:
+        version = get_schema_version(conn)
+        if version > len(MIGRATIONS):
+            raise RuntimeError(f"Database {MANAGER.filename} schema version {version} is newer than this code ({len(MIGRATIONS)})")
+        for next_version, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            logger.info(f"Migrating database {MANAGER.filename} to schema version {next_version}: {migration.__name__}")
+            conn.execute('BEGIN;')  # DDL is not wrapped into transaction by sqlite3 module implicitly
+            try:
+                migration(conn)
+                conn.execute(f'PRAGMA user_version = {next_version};')
+                conn.commit()
+            except sqlite3.Error:
+                conn.rollback()
+                raise
+            version = next_version
+    return version
+
+
+OPEN_EVENT_CACHE_SIZE = 2000  # chats, least recently used are evicted. 0 - disabled (e.g. several processes share database)
+OPEN_EVENTS = OpenEventCache(OPEN_EVENT_CACHE_SIZE)
+USER_CACHE_SIZE = 20000  # users, least recently used are evicted. 0 - disabled
+USERS = LRUCache(USER_CACHE_SIZE)  # user_id -> CachedUser
+CHAT_LANG_CACHE_SIZE = 20000  # chats, least recently used are evicted. 0 - disabled
+CHAT_LANGS = LRUCache(CHAT_LANG_CACHE_SIZE)  # chat_id -> lang
+SNAPSHOTS = LRUCache(OPEN_EVENT_CACHE_SIZE)  # chat_id -> (CachedEvent, EventSnapshot built from it), see get_event_snapshot()
+CACHES = (OPEN_EVENTS, USERS, CHAT_LANGS, SNAPSHOTS)  # every cache of this module: use_database(), benchmark_db.py --no-cache
+
+
+def load_chat_state(chat_id: int) -> CachedChat:
+    """Read open event, its participants/revoked lists and latest bot message of a chat from database"""
+    conn = reader()
+    cur = conn.cursor()
+    cur.execute('''
+        SELECT c.latest_bot_message_id, c.latest_bot_message_text, e.event_id, e.description, e.datetime, e.players_limit
+        FROM (SELECT ? AS chat_id) AS q
+            LEFT JOIN Chats AS c ON c.chat_id = q.chat_id
+            LEFT JOIN Events AS e ON e.chat_id = q.chat_id AND e.status = 'Open';
+    ''', (chat_id,))
+    message_id, message_text, event_id, description, event_datetime, players_limit = cur.fetchone()
+    event = None
+    if event_id is not None:
+        # kind 0 - participants, kind 1 - revoked
+        cur.execute('''
+            SELECT 0 AS kind, user_id, operation_datetime FROM Participants WHERE event_id = ?
+            UNION ALL
+            SELECT 1 AS kind, user_id, operation_datetime FROM Revoked WHERE event_id = ?
+            ORDER BY kind, operation_datetime;
+        ''', (event_id, event_id))
+        operations: Tuple[list, list] = ([], [])
+        for kind, user_id, operation_datetime in cur.fetchall():
+            if user_id is not None:
+                operations[kind].append((user_id, str(operation_datetime)))
+        event = CachedEvent(event_id, description or '', event_datetime or '', int(players_limit or 0), tuple(operations[0]), tuple(operations[1]))
+    return CachedChat(event, int(message_id or 0), message_text or '')
+
+
+def get_chat_state(chat_id: int) -> CachedChat:
+    """Open event and latest bot message of a chat: from OPEN_EVENTS cache, loaded from database on miss"""
+    chat = OPEN_EVENTS.get(chat_id)
+    if chat is None:
+        # Writers commit and then update the cache (after_commit()) under the write lock: loading under it
+        # never caches a state that is older than a write already applied to the cache
+        with MANAGER.write_lock:
+            chat = load_chat_state(chat_id)
+            OPEN_EVENTS.put(chat_id, chat)
+    return chat
 
 
 @logger.catch
@@ -127,26 +776,25 @@ def close_all_open_events_for_chat(chat_id: int):
     if not isinstance(chat_id, int):
         raise ValueError("chat_id must be an integer")
         
-    conn = reconnect()
     try:
-        with conn:
+        with writer() as conn:
             conn.execute('''UPDATE Events SET status = 'Closed' WHERE chat_id = ? AND status = 'Open';''', (chat_id,))
+            after_commit(lambda: OPEN_EVENTS.set_event(chat_id, None))
     except sqlite3.Error as e:
+        OPEN_EVENTS.invalidate(chat_id)
         logger.error(f"Error in close_all_open_events_for_chat: {e}")
         raise
-    finally:
-        conn.close()
 
 
-def event_add(chat_id: int, text: str, dtm: datetime.datetime, players_limit: int, latest_bot_message_id: int, latest_bot_message_text: str):
-    """Add a new event with proper SQL parameterization"""
-    if not isinstance(chat_id, int) or not isinstance(players_limit, int) or not isinstance(latest_bot_message_id, int):
+def event_add(chat_id: int, text: str, dtm: datetime.datetime, players_limit: int, latest_bot_message_id: Optional[int], latest_bot_message_text: str):
+    """Add a new event with proper SQL parameterization.
+    latest_bot_message_id None: the post is not sent yet, the latest bot message is kept (its buttons are still to be removed)"""
+    if not isinstance(chat_id, int) or not isinstance(players_limit, int) or not isinstance(latest_bot_message_id, (int, type(None))):
         raise ValueError("Invalid parameter types")
         
     event_datetime = str(dtm) if dtm else ''
-    conn = reconnect()
     try:
-        with conn:
+        with writer() as conn:
             cur = conn.cursor()
             # Insert new event
             cur.execute('''
@@ -158,15 +806,19 @@ def event_add(chat_id: int, text: str, dtm: datetime.datetime, players_limit: in
             conn.execute('''
                 UPDATE Chats 
                 SET latest_event_id = ?, 
-                    latest_bot_message_id = ?, 
-                    latest_bot_message_text = ?
+                    latest_bot_message_id = COALESCE(?, latest_bot_message_id), 
+                    latest_bot_message_text = COALESCE(?, latest_bot_message_text)
                 WHERE chat_id = ?;
-            ''', (cur.lastrowid, latest_bot_message_id, latest_bot_message_text, chat_id))
+            ''', (cur.lastrowid, latest_bot_message_id, None if latest_bot_message_id is None else latest_bot_message_text, chat_id))
+            new_event = CachedEvent(cur.lastrowid, text, event_datetime, players_limit, (), ())
+            if latest_bot_message_id is None:
+                after_commit(lambda: OPEN_EVENTS.set_event(chat_id, new_event))
+            else:
+                after_commit(lambda: OPEN_EVENTS.update(chat_id, lambda _: CachedChat(new_event, latest_bot_message_id, latest_bot_message_text)))
     except sqlite3.Error as e:
+        OPEN_EVENTS.invalidate(chat_id)
         logger.error(f"Error in event_add: {e}")
         raise
-    finally:
-        conn.close()
 
 
 
@@ -176,42 +828,32 @@ def update_event_text(chat_id, new_text):
     if not isinstance(chat_id, int) or not isinstance(new_text, str):
         raise ValueError("Invalid parameter types")
         
-    conn = reconnect()
     try:
-        with conn:
+        with writer() as conn:
             conn.execute('''
                 UPDATE Events 
                 SET description = ?
                 WHERE status = 'Open' AND chat_id = ?;
             ''', (new_text, chat_id))
+            after_commit(lambda: OPEN_EVENTS.update_event(chat_id, description=new_text))
     except sqlite3.Error as e:
+        OPEN_EVENTS.invalidate(chat_id)
         logger.error(f"Error in update_event_text: {e}")
         raise
-    finally:
-        conn.close()
 
 
 @logger.catch
 def get_event_text(chat_id: int) -> str:
-    """Get event text with proper SQL parameterization"""
+    """Get event text (cached)"""
     if not isinstance(chat_id, int):
         raise ValueError("chat_id must be an integer")
         
-    conn = reconnect()
     try:
-        cur = conn.cursor()
-        cur.execute('''
-            SELECT description 
-            FROM Events 
-            WHERE STATUS = 'Open' AND chat_id = ?;
-        ''', (chat_id,))
-        row = cur.fetchone()
-        return row[0] if row else ''
+        event = get_chat_state(chat_id).event
+        return event.description if event else ''
     except sqlite3.Error as e:
         logger.error(f"Error in get_event_text: {e}")
         return ''
-    finally:
-        conn.close()
 
 
 @logger.catch
@@ -220,43 +862,33 @@ def set_players_limit(chat_id: int, players_limit: int):
     if not isinstance(chat_id, int) or not isinstance(players_limit, int):
         raise ValueError("chat_id and players_limit must be integers")
         
-    conn = reconnect()
     try:
-        with conn:
+        with writer() as conn:
             conn.execute('''
                 UPDATE Events 
                 SET players_limit = ?
                 WHERE status = 'Open' AND chat_id = ?;
             ''', (players_limit, chat_id))
+            after_commit(lambda: OPEN_EVENTS.update_event(chat_id, players_limit=players_limit))
     except sqlite3.Error as e:
+        OPEN_EVENTS.invalidate(chat_id)
         logger.error(f"Error in set_players_limit: {e}")
         raise
-    finally:
-        conn.close()
 
 
 
 @logger.catch
 def get_event_limit(chat_id: int) -> int:
-    """Get event player limit with proper SQL parameterization"""
+    """Get event player limit (cached)"""
     if not isinstance(chat_id, int):
         raise ValueError("chat_id must be an integer")
         
-    conn = reconnect()
     try:
-        cur = conn.cursor()
-        cur.execute('''
-            SELECT players_limit 
-            FROM Events 
-            WHERE status = 'Open' AND chat_id = ?;
-        ''', (chat_id,))
-        row = cur.fetchone()
-        return int(row[0]) if row and row[0] is not None else 0
+        event = get_chat_state(chat_id).event
+        return int(event.players_limit) if event and event.players_limit is not None else 0
     except (ValueError, sqlite3.Error) as e:
         logger.error(f"Error in get_event_limit: {e}")
         return 0
-    finally:
-        conn.close()
 
 
 @logger.catch
@@ -265,38 +897,32 @@ def set_event_datetime(chat_id: int, dtm: datetime.datetime):
     if not isinstance(chat_id, int) or not isinstance(dtm, datetime.datetime):
         raise ValueError("Invalid parameter types")
         
-    conn = reconnect()
     try:
-        with conn:
+        with writer() as conn:
             conn.execute('''
                 UPDATE Events 
                 SET datetime = ?
                 WHERE status = 'Open' AND chat_id = ?;
             ''', (dtm, chat_id))
+            after_commit(lambda: OPEN_EVENTS.update_event(chat_id, datetime=str(dtm)))
     except sqlite3.Error as e:
+        OPEN_EVENTS.invalidate(chat_id)
         logger.error(f"Error in set_event_datetime: {e}")
         raise
-    finally:
-        conn.close()
 
 
 @logger.catch
 def get_event_datetime(chat_id: int) -> str:
-    """Get event datetime with proper SQL parameterization"""
+    """Get event datetime (cached)"""
     if not isinstance(chat_id, int):
         raise ValueError("chat_id must be an integer")
         
-    conn = reconnect()
     try:
-        cur = conn.cursor()
-        cur.execute('''SELECT datetime FROM Events WHERE status="Open" AND chat_id = ? ;''', (chat_id,))
-        row = cur.fetchone()
-        return row[0] if row and row[0] else ''
+        event = get_chat_state(chat_id).event
+        return event.datetime if event and event.datetime else ''
     except sqlite3.Error as e:
         logger.error(f"Error in get_event_datetime: {e}")
         return ''
-    finally:
-        conn.close()
 
 
 @logger.catch
@@ -305,53 +931,40 @@ def fix_event(chat_id: int):
     if not isinstance(chat_id, int):
         raise ValueError("chat_id must be an integer")
         
-    conn = reconnect()
     try:
-        with conn:
+        with writer() as conn:
             conn.execute('''UPDATE Events SET status = 'Fixed' WHERE status = 'Open' AND chat_id = ? ;''', (chat_id,))
+            after_commit(lambda: OPEN_EVENTS.set_event(chat_id, None))
     except sqlite3.Error as e:
+        OPEN_EVENTS.invalidate(chat_id)
         logger.error(f"Error in fix_event: {e}")
         raise
-    finally:
-        conn.close()
 
 
 @logger.catch
 def get_latest_bot_message_id(chat_id: int) -> int:
-    """Get latest bot message ID with proper SQL parameterization"""
+    """Get latest bot message ID (cached)"""
     if not isinstance(chat_id, int):
         raise ValueError("chat_id must be an integer")
         
-    conn = reconnect()
     try:
-        cur = conn.cursor()
-        cur.execute('''SELECT latest_bot_message_id FROM Chats WHERE chat_id = ? ;''', (chat_id,))
-        row = cur.fetchone()
-        return int(row[0]) if row and row[0] is not None else 0
+        return int(get_chat_state(chat_id).latest_bot_message_id or 0)
     except (ValueError, sqlite3.Error) as e:
         logger.error(f"Error in get_latest_bot_message_id: {e}")
         return 0
-    finally:
-        conn.close()
 
 
 @logger.catch
 def get_latest_bot_message_text(chat_id: int) -> str:
-    """Get latest bot message text with proper SQL parameterization"""
+    """Get latest bot message text (cached)"""
     if not isinstance(chat_id, int):
         raise ValueError("chat_id must be an integer")
         
-    conn = reconnect()
     try:
-        cur = conn.cursor()
-        cur.execute('''SELECT latest_bot_message_text FROM Chats WHERE chat_id = ? ;''', (chat_id,))
-        row = cur.fetchone()
-        return row[0] if row and row[0] else ''
+        return get_chat_state(chat_id).latest_bot_message_text or ''
     except sqlite3.Error as e:
         logger.error(f"Error in get_latest_bot_message_text: {e}")
         return ''
-    finally:
-        conn.close()
 
 
 @logger.catch
@@ -360,15 +973,14 @@ def save_latest_bot_message(chat_id: int, message_id: int, message_text: str):
     if not all(isinstance(x, int) for x in (chat_id, message_id)) or not isinstance(message_text, str):
         raise ValueError("Invalid parameter types")
         
-    conn = reconnect()
     try:
-        with conn:
+        with writer() as conn:
             conn.execute('''UPDATE Chats SET latest_bot_message_id = ?, latest_bot_message_text = ? WHERE chat_id = ?;''', (message_id, message_text, chat_id))
+            after_commit(lambda: OPEN_EVENTS.set_latest_bot_message(chat_id, message_id, message_text))
     except sqlite3.Error as e:
+        OPEN_EVENTS.invalidate(chat_id)
         logger.error(f"Error in save_latest_bot_message: {e}")
         raise
-    finally:
-        conn.close()
 
 
 @logger.catch
@@ -381,21 +993,23 @@ def add_or_update_user(user_id: int, first_name: str = "", last_name: str = "",
         last_name: User's last name
         username: User's Telegram username (without @)
     """
+    # Clean input data (Telegram sends None for missing last_name / username)
+    first_name = first_name or ""
+    last_name = last_name or ""
+    username = username or ""
+
     # Input validation
     if not isinstance(user_id, int) or user_id <= 0:
         raise ValueError("user_id must be a positive integer")
     if not all(isinstance(x, str) for x in (first_name, last_name, username)):
         raise TypeError("first_name, last_name and username must be strings")
+
+    cached = USERS.get(user_id)
+    if cached and (cached.first_name, cached.last_name, cached.username) == (first_name, last_name, username):
+        return  # Telegram reports the same profile data, nothing to write
     
-    # Clean input data
-    first_name = first_name or ""
-    last_name = last_name or ""
-    username = username or ""
-    
-    conn = None
     try:
-        conn = reconnect()
-        with conn:
+        with writer() as conn:
             # Check if user exists
             cur = conn.cursor()
             cur.execute('''
@@ -422,51 +1036,74 @@ def add_or_update_user(user_id: int, first_name: str = "", last_name: str = "",
                         SET first_name = ?, last_name = ?, username = ? 
                         WHERE user_id = ?;
                     ''', (first_name, last_name, username, user_id))
+                    after_commit(SNAPSHOTS.clear)  # the name may be shown in any chat, renames are rare
                 else:
                     logger.debug(f'User {user_id} data has not changed')
+            user = CachedUser(first_name, last_name, username, format_full_name(user_id, first_name, last_name, username))
+            after_commit(lambda: USERS.put(user_id, user))
                     
     except sqlite3.Error as e:
+        USERS.invalidate(user_id)
         logger.error(f"Database error while updating user {user_id}: {e}")
         raise
-    finally:
-        if conn:
-            conn.close()
+
+
+def format_full_name(user_id: int, first_name: Optional[str], last_name: Optional[str], username: Optional[str]) -> str:
+    """Printable name from Users columns: 'First Last (username)', falls back to username or user_id"""
+    fnm = first_name if first_name else ''
+    lnm = last_name if last_name else ''
+    unm = username if username else ''
+
+    res = " ".join([fnm, lnm]).strip()
+    if res and unm:
+        res = f"{res} ({unm})"
+    elif not res and unm:
+        res = unm
+
+    return res if res else str(user_id)
+
+
+def get_full_names(user_ids: List[int]) -> Dict[int, str]:
+    """Printable names for users: from USERS cache, missing ones loaded from database with one query"""
+    names = {}
+    missing = []
+    for user_id in user_ids:
+        cached = USERS.get(user_id)
+        if cached:
+            names[user_id] = cached.full_name
+        else:
+            missing.append(user_id)
+    if not missing:
+        return names
+
+    # under the write lock: add_or_update_user() can not change rows between reading and caching them
+    with MANAGER.write_lock:
+        cur = reader().cursor()
+        cur.execute(f'''
+            SELECT user_id, first_name, last_name, username
+            FROM Users
+            WHERE user_id IN ({','.join('?' * len(missing))});
+        ''', missing)
+        for user_id, *row in cur.fetchall():
+            first_name, last_name, username = (x if x else '' for x in row)
+            names[user_id] = format_full_name(user_id, first_name, last_name, username)
+            USERS.put(user_id, CachedUser(first_name, last_name, username, names[user_id]))
+    for user_id in missing:
+        names.setdefault(user_id, 'USER_ID NOT FOUND!')
+    return names
 
 
 @logger.catch
 def compose_full_name(user_id: int) -> str:
-    """Compose user's full name with proper SQL parameterization"""
+    """Compose user's full name (cached)"""
     if not isinstance(user_id, int):
         raise ValueError("user_id must be an integer")
         
-    conn = reconnect()
     try:
-        cur = conn.cursor()
-        cur.execute('''
-            SELECT first_name, last_name, username 
-            FROM users 
-            WHERE user_id = ?;
-        ''', (user_id,))
-        row = cur.fetchone()
-        if not row:
-            return 'USER_ID NOT FOUND!'
-            
-        fnm = row[0] if row[0] else ''
-        lnm = row[1] if row[1] else ''
-        unm = row[2] if row[2] else ''
-        
-        res = " ".join([fnm, lnm]).strip()
-        if res and unm:
-            res = f"{res} ({unm})"
-        elif not res and unm:
-            res = unm
-            
-        return res if res else str(user_id)
+        return get_full_names([user_id])[user_id]
     except sqlite3.Error as e:
         logger.error(f"Error in compose_full_name: {e}")
         return str(user_id)
-    finally:
-        conn.close()
 
 
 def penalty_for_user_in_chat(chat_id: int, user_id: int, operator_id: int):
@@ -474,24 +1111,27 @@ def penalty_for_user_in_chat(chat_id: int, user_id: int, operator_id: int):
     if not all(isinstance(x, int) for x in (chat_id, user_id, operator_id)):
         raise ValueError("All IDs must be integers")
         
-    conn = reconnect()
     try:
-        with conn:
+        with writer() as conn:
             conn.execute('''
                 INSERT INTO Penalties(chat_id, user_id, operation_datetime, operator_id) 
                 VALUES (?, ?, ?, ?);
             ''', (chat_id, user_id, datetime.datetime.now(), operator_id))
+            conn.execute('''
+                INSERT INTO ChatMemberStats(chat_id, user_id, penalties)
+                VALUES (?, ?, 1)
+                ON CONFLICT(chat_id, user_id) DO UPDATE SET penalties = penalties + 1;
+            ''', (chat_id, user_id))
+            after_commit(lambda: SNAPSHOTS.invalidate(chat_id))
     except sqlite3.Error as e:
         logger.error(f"Error in penalty_for_user_in_chat: {e}")
         raise
-    finally:
-        conn.close()
 
 
 @logger.catch
 def get_all_userids() -> List[int]:
     """Get all user IDs with proper error handling"""
-    conn = reconnect()
+    conn = reader()
     try:
         cur = conn.cursor()
         cur.execute('''SELECT user_id FROM Users;''')
@@ -499,14 +1139,12 @@ def get_all_userids() -> List[int]:
     except (ValueError, sqlite3.Error) as e:
         logger.error(f"Error in get_all_userids: {e}")
         return []
-    finally:
-        conn.close()
 
 
 @logger.catch
 def get_all_chat_ids() -> Set[int]:
     """Get all chat IDs with proper error handling"""
-    conn = reconnect()
+    conn = reader()
     try:
         cur = conn.cursor()
         cur.execute('''SELECT chat_id FROM Chats;''')
@@ -514,31 +1152,58 @@ def get_all_chat_ids() -> Set[int]:
     except (ValueError, sqlite3.Error) as e:
         logger.error(f"Error in get_all_chat_ids: {e}")
         return set()
-    finally:
-        conn.close()
+
+
+def get_known_chat_index() -> ChatIdIndex:
+    """Index of all registered chat IDs, read in primary key order straight into the index (no intermediate set)"""
+    conn = reader()
+    try:
+        cur = conn.cursor()
+        cur.execute('''SELECT chat_id FROM Chats ORDER BY chat_id;''')
+        index = ChatIdIndex()
+        while True:
+            rows = cur.fetchmany(10000)
+            if not rows:
+                return index
+            index.extend_sorted(chat_id for chat_id, in rows)
+    except sqlite3.Error as e:
+        logger.error(f"Error in get_known_chat_index: {e}")
+        return ChatIdIndex()
+
+
+def get_countdown_events() -> List[Tuple[int, str]]:
+    """(chat_id, datetime) of open events with a date/time still ahead: their posts show a countdown"""
+    conn = reader()
+    try:
+        cur = conn.cursor()
+        cur.execute('''SELECT chat_id, datetime FROM Events WHERE status = 'Open' AND datetime > ?;''', (str(datetime.datetime.now()),))
+        return [(int(chat_id), dtm) for chat_id, dtm in cur.fetchall()]
+    except (ValueError, sqlite3.Error) as e:
+        logger.error(f"Error in get_countdown_events: {e}")
+        return []
 
 
 @logger.catch
-def register_new_chat_id(chat_id: int, lang: str):
-    """Register new chat ID with proper SQL parameterization"""
+def register_new_chat_id(chat_id: int, lang: str) -> bool:
+    """Register chat ID with its language unless it is registered already (e.g. by another process). True if it is new."""
     if not isinstance(chat_id, int):
         raise ValueError("chat_id must be an integer")
         
     language_code = lang if lang else ''  # Telegram API language_code. Example: 'en'
-    conn = reconnect()
     try:
-        with conn:
-            conn.execute('''
+        with writer() as conn:
+            # DO NOTHING: the language of a known chat is changed only by set_chat_lang()
+            cur = conn.execute('''
                 INSERT INTO Chats(chat_id, lang) 
                 VALUES (?, ?)
-                ON CONFLICT(chat_id) DO UPDATE 
-                SET lang = excluded.lang;
+                ON CONFLICT(chat_id) DO NOTHING;
             ''', (chat_id, language_code))
+            OPEN_EVENTS.invalidate(chat_id)
+            CHAT_LANGS.invalidate(chat_id)
+            return cur.rowcount > 0
     except sqlite3.Error as e:
         logger.error(f"Error in register_new_chat_id: {e}")
         raise
-    finally:
-        conn.close()
 
 
 @logger.catch
@@ -547,7 +1212,7 @@ def get_only_chat_participants(chat_id: int) -> List[int]:
     if not isinstance(chat_id, int):
         raise ValueError("chat_id must be an integer")
         
-    conn = reconnect()
+    conn = reader()
     try:
         cur = conn.cursor()
         cur.execute('''
@@ -560,34 +1225,34 @@ def get_only_chat_participants(chat_id: int) -> List[int]:
     except (ValueError, sqlite3.Error) as e:
         logger.error(f"Error in get_only_chat_participants: {e}")
         return []
-    finally:
-        conn.close()
 
 
 @logger.catch
 def get_chat_lang(chat_id: int) -> str:
-    """Get chat language with proper SQL parameterization"""
+    """Get chat language: from CHAT_LANGS cache, loaded from database on miss"""
     if not isinstance(chat_id, int):
         raise ValueError("chat_id must be an integer")
-        
-    conn = reconnect()
+    lang = CHAT_LANGS.get(chat_id)
+    if lang is not None:
+        return lang
+
     try:
-        cur = conn.cursor()
-        cur.execute('''
-            SELECT lang 
-            FROM Chats 
-            WHERE chat_id = ?;
-        ''', (chat_id,))
-        row = cur.fetchone()
+        with MANAGER.write_lock:  # see get_chat_state()
+            cur = reader().cursor()
+            cur.execute('''
+                SELECT lang 
+                FROM Chats 
+                WHERE chat_id = ?;
+            ''', (chat_id,))
+            row = cur.fetchone()
+            lang = row[0] if row and row[0] else 'en'
+            CHAT_LANGS.put(chat_id, lang)
         if not row or not row[0]:
             logger.info(f'Can not get LANG for this chat_id: {chat_id}')
-            return 'en'
-        return row[0]
+        return lang
     except sqlite3.Error as e:
         logger.error(f"Error in get_chat_lang: {e}")
         return 'en'
-    finally:
-        conn.close()
 
 
 @logger.catch
@@ -596,134 +1261,161 @@ def set_chat_lang(chat_id: int, lang: str):
     if not isinstance(chat_id, int) or not isinstance(lang, str):
         raise ValueError("Invalid parameter types")
         
-    conn = reconnect()
     try:
-        with conn:
-            conn.execute('''
+        with writer() as conn:
+            cur = conn.execute('''
                 UPDATE Chats 
                 SET lang = ? 
                 WHERE chat_id = ?;
             ''', (lang, chat_id))
+            if cur.rowcount:
+                after_commit(lambda: CHAT_LANGS.put(chat_id, lang))
     except sqlite3.Error as e:
+        CHAT_LANGS.invalidate(chat_id)
         logger.error(f"Error in set_chat_lang: {e}")
         raise
-    finally:
-        conn.close()
 
 
 def get_event_users(chat_id: int) -> List[int]:
-    """Get users for an event with proper SQL parameterization"""
+    """Get users for an event ordered by application time (cached)"""
     if not isinstance(chat_id, int):
         raise ValueError("chat_id must be an integer")
         
-    conn = reconnect()
     try:
-        cur = conn.cursor()
-        cur.execute('''
-            SELECT user_id 
-            FROM Participants 
-            WHERE event_id IN 
-                (SELECT event_id FROM Events WHERE status = 'Open' AND chat_id = ?) 
-            ORDER BY operation_datetime;
-        ''', (chat_id,))
-        return [row[0] for row in cur.fetchall() if row and row[0] is not None]
+        event = get_chat_state(chat_id).event
+        return [user_id for user_id, _ in event.participants] if event else []
     except (ValueError, sqlite3.Error) as e:
         logger.error(f"Error in get_event_users: {e}")
         return []
-    finally:
-        conn.close()
 
 def get_event_revoked_users(chat_id: int) -> List[int]:
-    """Get revoked users for an event with proper SQL parameterization"""
+    """Get revoked users for an event ordered by cancellation time (cached)"""
     if not isinstance(chat_id, int):
         raise ValueError("chat_id must be an integer")
         
-    conn = reconnect()
     try:
-        cur = conn.cursor()
-        cur.execute('''
-            SELECT user_id 
-            FROM Revoked 
-            WHERE event_id IN 
-                (SELECT event_id FROM Events WHERE status = 'Open' AND chat_id = ?) 
-            ORDER BY operation_datetime;
-        ''', (chat_id,))
-        return [row[0] for row in cur.fetchall() if row and row[0] is not None]
+        event = get_chat_state(chat_id).event
+        return [user_id for user_id, _ in event.revoked] if event else []
     except (ValueError, sqlite3.Error) as e:
         logger.error(f"Error in get_event_revoked_users: {e}")
         return []
-    finally:
-        conn.close()
 
 
-def apply_for_participation_in_the_event(chat_id: int, user_id: int):
-    """Apply for participation in an event with proper SQL parameterization"""
+def write_participation(conn: sqlite3.Connection, chat_id: int, user_id: int, dtm: datetime.datetime):
+    """SQL part of apply_for_participation_in_the_event(), runs inside caller's writer transaction"""
+    cur = conn.cursor()
+
+    # Count a registration, unless the user is already in the list (then the row below is only replaced)
+    cur.execute('''
+        INSERT INTO ChatMemberStats(chat_id, user_id, registrations)
+        SELECT e.chat_id, ?, 1
+        FROM Events AS e
+        WHERE e.event_id = (SELECT event_id FROM Events WHERE status = 'Open' AND chat_id = ?)
+        AND NOT EXISTS (SELECT 1 FROM Participants AS p WHERE p.event_id = e.event_id AND p.user_id = ?)
+        ON CONFLICT(chat_id, user_id) DO UPDATE SET registrations = registrations + 1;
+    ''', (user_id, chat_id, user_id))
+
+    # Insert or replace participation
+    cur.execute('''
+        INSERT OR REPLACE INTO Participants (event_id, user_id, operation_datetime)
+        VALUES (
+            (SELECT event_id FROM Events WHERE status = 'Open' AND chat_id = ?), 
+            ?, 
+            ?
+        );
+    ''', (chat_id, user_id, dtm))
+
+    # Remove from revoked if exists
+    cur.execute('''
+        DELETE FROM Revoked
+        WHERE event_id = (SELECT event_id FROM Events WHERE status = 'Open' AND chat_id = ?) 
+        AND user_id = ?;
+    ''', (chat_id, user_id))
+    counters = None
+    if SNAPSHOTS.get(chat_id) is not None:  # the player's new counters, for move_in_snapshot()
+        cur.execute('''
+            SELECT registrations, penalties FROM ChatMemberStats WHERE chat_id = ? AND user_id = ?;
+        ''', (chat_id, user_id))
+        counters = cur.fetchone() or (0, 0)
+
+    def apply_to_caches():
+        before = OPEN_EVENTS.get(chat_id)
+        OPEN_EVENTS.apply(chat_id, user_id, str(dtm))
+        move_in_snapshot(chat_id, user_id, before, True, str(dtm), counters)
+    after_commit(apply_to_caches)
+
+
+def apply_for_participation_in_the_event(chat_id: int, user_id: int, wait: bool = True) -> Optional[Future]:
+    """Apply for participation in an event with proper SQL parameterization.
+
+    With group commit enabled returns a Future that is resolved when the write is committed.
+    With wait=True (default) it is already resolved and errors are raised here.
+    """
     if not all(isinstance(x, int) for x in (chat_id, user_id)):
         raise ValueError("chat_id and user_id must be integers")
         
     logger.info(f"Event - New player request: {user_id}")
-    conn = reconnect()
     try:
-        with conn:
-            cur = conn.cursor()
-            cur.execute("PRAGMA foreign_keys = 1;")
-            dtm = datetime.datetime.now()
-            
-            # Insert or replace participation
-            cur.execute('''
-                INSERT OR REPLACE INTO Participants (event_id, user_id, operation_datetime)
-                VALUES (
-                    (SELECT event_id FROM Events WHERE status = 'Open' AND chat_id = ?), 
-                    ?, 
-                    ?
-                );
-            ''', (chat_id, user_id, dtm))
-            
-            # Remove from revoked if exists
-            cur.execute('''
-                DELETE FROM Revoked
-                WHERE event_id = (SELECT event_id FROM Events WHERE status = 'Open' AND chat_id = ?) 
-                AND user_id = ?;
-            ''', (chat_id, user_id))
+        if GROUP_COMMIT:
+            return GROUP_COMMIT.submit(write_participation, chat_id, user_id, wait)
+        with writer() as conn:
+            write_participation(conn, chat_id, user_id, datetime.datetime.now())
     except sqlite3.Error as e:
+        OPEN_EVENTS.invalidate(chat_id)
         logger.error(f"Error in apply_for_participation_in_the_event: {e}")
         raise
-    finally:
-        conn.close()
+    return None
+
+
+def write_revocation(conn: sqlite3.Connection, chat_id: int, user_id: int, dtm: datetime.datetime):
+    """SQL part of revoke_application_for_the_event(), runs inside caller's writer transaction"""
+    cur = conn.cursor()
+
+    # Add to revoked
+    cur.execute('''
+        INSERT OR REPLACE INTO Revoked (event_id, user_id, operation_datetime)
+        VALUES (
+            (SELECT event_id FROM Events WHERE status = 'Open' AND chat_id = ?), 
+            ?, 
+            ?
+        );
+    ''', (chat_id, user_id, dtm))
+
+    # Remove from participants
+    cur.execute('''
+        DELETE FROM Participants
+        WHERE event_id = (SELECT event_id FROM Events WHERE status = 'Open' AND chat_id = ?) 
+        AND user_id = ?;
+    ''', (chat_id, user_id))
+    if cur.rowcount > 0:
+        cur.execute('''
+            UPDATE ChatMemberStats SET registrations = registrations - ?
+            WHERE chat_id = ? AND user_id = ?;
+        ''', (cur.rowcount, chat_id, user_id))
+
+    def revoke_in_caches():
+        before = OPEN_EVENTS.get(chat_id)
+        OPEN_EVENTS.revoke(chat_id, user_id, str(dtm))
+        move_in_snapshot(chat_id, user_id, before, False, str(dtm), None)
+    after_commit(revoke_in_caches)
 
 
-def revoke_application_for_the_event(chat_id: int, user_id: int):
-    """Revoke application for an event with proper SQL parameterization"""
+def revoke_application_for_the_event(chat_id: int, user_id: int, wait: bool = True) -> Optional[Future]:
+    """Revoke application for an event with proper SQL parameterization. Group commit: see apply_for_participation_in_the_event()"""
     if not all(isinstance(x, int) for x in (chat_id, user_id)):
         raise ValueError("chat_id and user_id must be integers")
         
     logger.info(f"Event - Player canceled request: {user_id}")
-    conn = reconnect()
     try:
-        with conn:
-            cur = conn.cursor()
-            cur.execute("PRAGMA foreign_keys = 1;")
-            dtm = datetime.datetime.now()
-            
-            # Add to revoked
-            cur.execute('''
-                INSERT OR REPLACE INTO Revoked (event_id, user_id, operation_datetime)
-                VALUES (
-                    (SELECT event_id FROM Events WHERE status = 'Open' AND chat_id = ?), 
-                    ?, 
-                    ?
-                );
-            ''', (chat_id, user_id, dtm))
-            
-            # Remove from participants
-            cur.execute('''
-                DELETE FROM Participants
-                WHERE event_id = (SELECT event_id FROM Events WHERE status = 'Open' AND chat_id = ?) 
-                AND user_id = ?;
-            ''', (chat_id, user_id))
+        if GROUP_COMMIT:
+            return GROUP_COMMIT.submit(write_revocation, chat_id, user_id, wait)
+        with writer() as conn:
+            write_revocation(conn, chat_id, user_id, datetime.datetime.now())
     except sqlite3.Error as e:
+        OPEN_EVENTS.invalidate(chat_id)
         logger.error(f"Error in revoke_application_for_the_event: {e}")
         raise
+    return None
 
 
 def get_chat_user_rp(chat_id: int, user_id: int) -> Tuple[int, int]:
@@ -731,34 +1423,21 @@ def get_chat_user_rp(chat_id: int, user_id: int) -> Tuple[int, int]:
     if not all(isinstance(x, int) for x in (chat_id, user_id)):
         raise ValueError("chat_id and user_id must be integers")
         
-    conn = reconnect()
+    conn = reader()
     try:
         cur = conn.cursor()
-        
-        # Get registration count
         cur.execute('''
-            SELECT COUNT(*) 
-            FROM Participants 
-            WHERE event_id IN (SELECT event_id FROM Events WHERE chat_id = ?) 
-            AND user_id = ?;
+            SELECT registrations, penalties
+            FROM ChatMemberStats
+            WHERE chat_id = ? AND user_id = ?;
         ''', (chat_id, user_id))
-        reg_count = cur.fetchone()[0] or 0
-        
-        # Get penalty count
-        cur.execute('''
-            SELECT COUNT(*) 
-            FROM Penalties 
-            WHERE chat_id = ? 
-            AND user_id = ?;
-        ''', (chat_id, user_id))
-        pen_count = cur.fetchone()[0] or 0
+        row = cur.fetchone()
+        reg_count, pen_count = row if row else (0, 0)
         
         return (int(reg_count), int(pen_count))
     except (ValueError, sqlite3.Error) as e:
         logger.error(f"Error in get_chat_user_rp: {e}")
         return (0, 0)
-    finally:
-        conn.close()
 
 
 def get_user_cancellation_datetime(chat_id: int, canceled_user_id: int) -> Optional[datetime.datetime]:
@@ -766,40 +1445,163 @@ def get_user_cancellation_datetime(chat_id: int, canceled_user_id: int) -> Optio
     if not all(isinstance(x, int) for x in (chat_id, canceled_user_id)):
         raise ValueError("chat_id and canceled_user_id must be integers")
         
-    conn = reconnect()
     try:
-        cur = conn.cursor()
-        cur.execute('''
-            SELECT operation_datetime 
-            FROM Revoked
-            WHERE event_id = (SELECT event_id FROM Events WHERE status = 'Open' AND chat_id = ?) 
-            AND user_id = ?;
-        ''', (chat_id, canceled_user_id))
-        row = cur.fetchone()
-        if not row or not row[0]:
+        event = get_chat_state(chat_id).event
+        cancel_datetime = dict(event.revoked).get(canceled_user_id) if event else None
+        if not cancel_datetime:
             logger.info(f'No cancellation found for user {canceled_user_id} in chat {chat_id}')
             return None
-        return row[0]
+        return cancel_datetime
     except sqlite3.Error as e:
         logger.error(f"Error in get_user_cancellation_datetime: {e}")
         return None
-    finally:
-        conn.close()
 
 
-if __name__ == '__main__':
+def check_chat_member_stats(repair: bool = False) -> List[Tuple[int, int, int, int, int, int]]:
+    """Compare ChatMemberStats with counters recomputed from history, optionally rebuild it.
+
+    Returns mismatches as (chat_id, user_id, registrations, penalties, expected_registrations, expected_penalties).
+    """
+    with writer() as conn:
+        cur = conn.cursor()
+        cur.execute('''
+            WITH expected(chat_id, user_id, registrations, penalties) AS (''' + CHAT_MEMBER_STATS_FROM_HISTORY_SQL + ''')
+            SELECT chat_id, user_id, MAX(registrations), MAX(penalties), MAX(expected_registrations), MAX(expected_penalties)
+            FROM (
+                SELECT chat_id, user_id, registrations, penalties, 0 AS expected_registrations, 0 AS expected_penalties
+                FROM ChatMemberStats
+                UNION ALL
+                SELECT chat_id, user_id, 0, 0, registrations, penalties FROM expected
+            )
+            GROUP BY chat_id, user_id
+            HAVING MAX(registrations) != MAX(expected_registrations) OR MAX(penalties) != MAX(expected_penalties);
+        ''')
+        mismatches = cur.fetchall()
+        if mismatches and repair:
+            logger.warning(f"Rebuilding ChatMemberStats, {len(mismatches)} mismatch(es) found")
+            conn.execute('DELETE FROM ChatMemberStats;')
+            conn.execute('INSERT INTO ChatMemberStats(chat_id, user_id, registrations, penalties) ' + CHAT_MEMBER_STATS_FROM_HISTORY_SQL + ';')
+            after_commit(SNAPSHOTS.clear)
+    return mismatches
+
+
+class SnapshotPlayer(NamedTuple):
+    user_id: int
+    full_name: str
+    registrations: int
+    penalties: int
+
+
+class SnapshotRevoked(NamedTuple):
+    user_id: int
+    full_name: str
+    operation_datetime: str
+
+
+class EventSnapshot(NamedTuple):
+    """Everything needed to render the open event of a chat. Cached in SNAPSHOTS: the lists are never changed."""
+    event_id: int
+    description: str
+    datetime: str
+    players_limit: int
+    players: List[SnapshotPlayer]  # ordered by operation_datetime
+    revoked: List[SnapshotRevoked]  # ordered by operation_datetime
+
+
+EMPTY_EVENT_SNAPSHOT = EventSnapshot(0, '', '', 0, [], [])
+
+
+def load_event_snapshot(chat_id: int, event: CachedEvent) -> EventSnapshot:
+    """Build the snapshot of event: names from USERS cache, counters of all participants from one indexed query"""
+    user_ids = list({user_id for user_id, _ in event.participants + event.revoked})
+    names = get_full_names(user_ids)
+    stats = {}
+    if event.participants:
+        cur = reader().cursor()
+        cur.execute(f'''
+            SELECT user_id, registrations, penalties
+            FROM ChatMemberStats
+            WHERE chat_id = ? AND user_id IN ({','.join('?' * len(event.participants))});
+        ''', (chat_id, *(user_id for user_id, _ in event.participants)))
+        stats = {user_id: (registrations, penalties) for user_id, registrations, penalties in cur.fetchall()}
+
+    players = []
+    for user_id, _ in event.participants:
+        registrations, penalties = stats.get(user_id, (0, 0))
+        players.append(SnapshotPlayer(user_id, names[user_id], int(registrations or 0), int(penalties or 0)))
+    revoked = [SnapshotRevoked(user_id, names[user_id], operation_datetime) for user_id, operation_datetime in event.revoked]
+    return EventSnapshot(event.event_id, event.description, event.datetime, event.players_limit, players, revoked)
+
+
+def move_in_snapshot(chat_id: int, user_id: int, before: Optional[CachedChat], applied: bool, operation_datetime: str,
+                     counters: Optional[Tuple[int, int]]):
+    """Apply a click, already applied to OPEN_EVENTS, to the cached snapshot of the chat: the user goes to the end of a list.
+
+    counters - (registrations, penalties) of a user who applied, read in the write transaction (None if not read).
+    A snapshot built from another event than the one before the click (or without the counters) is dropped,
+    the next get_event_snapshot() rebuilds it. Called after the commit, under the write lock.
+    """
+    cached = SNAPSHOTS.get(chat_id)
+    if cached is None:
+        return
+    after = OPEN_EVENTS.get(chat_id)
+    user = USERS.get(user_id)
+    source, snapshot = cached
+    if before is None or source is not before.event or after is None or after.event is None or user is None or applied and counters is None:
+        SNAPSHOTS.invalidate(chat_id)
+        return
+
+    players = [player for player in snapshot.players if player.user_id != user_id]
+    revoked = [canceled for canceled in snapshot.revoked if canceled.user_id != user_id]
+    if applied:
+        registrations, penalties = counters
+        players.append(SnapshotPlayer(user_id, user.full_name, int(registrations or 0), int(penalties or 0)))
+    else:
+        revoked.append(SnapshotRevoked(user_id, user.full_name, operation_datetime))
+    SNAPSHOTS.put(chat_id, (after.event, snapshot._replace(players=players, revoked=revoked)))
+
+
+@logger.catch
+def get_event_snapshot(chat_id: int) -> Optional[EventSnapshot]:
+    """Get open event with its participants (names, registrations, penalties) and revoked users.
+
+    Event and ordered lists come from OPEN_EVENTS cache. The snapshot is cached in SNAPSHOTS with the event it was built from:
+    clicks move one user in it (move_in_snapshot()), new text, date or limit only replace these fields,
+    anything else rebuilds it (load_event_snapshot()). Returns None if there is no open event in the chat.
+    """
+    if not isinstance(chat_id, int):
+        raise ValueError("chat_id must be an integer")
+
     try:
-        print(f'Creating database {DB_FILENAME}...')
-        with open(DB_FILENAME, 'wb') as f:
-            f.close()
-    except Exception as e:
-        print(f'Error: {e}')
-        sys.exit()
-    print(f'Creating tables in database {DB_FILENAME}...')
-    create_table_users()
-    create_table_chats()
-    create_table_events()
-    create_table_participants()
-    create_table_revoked()
-    create_table_chat_penalties()
+        event = get_chat_state(chat_id).event
+        if not event:
+            return None
+
+        cached = SNAPSHOTS.get(chat_id)
+        if cached is not None and cached[0] is event:
+            return cached[1]
+        if cached is not None and (cached[0].event_id, cached[0].participants, cached[0].revoked) == (event.event_id, event.participants, event.revoked):
+            snapshot = cached[1]._replace(description=event.description, datetime=event.datetime, players_limit=event.players_limit)
+        else:
+            snapshot = load_event_snapshot(chat_id, event)
+        SNAPSHOTS.put(chat_id, (event, snapshot))
+        return snapshot
+    except (ValueError, sqlite3.Error) as e:
+        logger.error(f"Error in get_event_snapshot: {e}")
+        return None
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description=f'Create or upgrade database {DB_FILENAME}')
+    arg_parser.add_argument('--check-stats', action='store_true', help='compare ChatMemberStats with counters recomputed from history')
+    arg_parser.add_argument('--repair', action='store_true', help='with --check-stats: rebuild ChatMemberStats if it does not match')
+    args = arg_parser.parse_args()
+
+    print(f'Creating or upgrading database {DB_FILENAME}...')
+    print(f'Schema version: {migrate()}')
+    if args.check_stats:
+        found = check_chat_member_stats(repair=args.repair)
+        for chat_id, user_id, reg, pen, expected_reg, expected_pen in found:
+            print(f'chat_id={chat_id} user_id={user_id}: {reg}/{pen}, expected {expected_reg}/{expected_pen}')
+        print(f'ChatMemberStats mismatches: {len(found)}' + (' (repaired)' if found and args.repair else ''))
     print('Done.')
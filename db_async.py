@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""Asyncio access to db.py (and any other blocking function) for the asyncio engine.
+
+Blocking calls run in a dedicated thread pool, so the event loop keeps serving updates
+while SQLite works. The pool size bounds the number of database connections (one reader per thread).
+
+Usage:
+    from db_async import adb, run
+    text = await adb.get_event_text(chat_id)        # db.get_event_text(chat_id) in DB_EXECUTOR
+    text = await run(core.create_event_full_text, chat_id)
+"""
+
+import asyncio
+import functools
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+from profiling import PROFILER
+import db
+
+
+DB_WORKERS = 4
+DB_EXECUTOR = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix='db')
+
+
+async def run(func: Callable, *args, **kwargs) -> Any:
+    """Run blocking func(*args, **kwargs) in DB_EXECUTOR and await its result"""
+    loop = asyncio.get_running_loop()
+    # in the context of the awaiting handler: db.TRACE_HANDLER and metrics.CURRENT attribute the call to its update.
+    # PROFILER.call: a running /profile session of the event loop covers the executor thread too
+    call = functools.partial(contextvars.copy_context().run, PROFILER.call, func, *args, **kwargs)
+    return await loop.run_in_executor(DB_EXECUTOR, call)
+
+
+class AsyncDB:
+    """Awaitable mirror of db.py public functions: `await adb.some_function(...)`"""
+
+    def __getattr__(self, name: str) -> Callable:
+        func = getattr(db, name)
+        if not callable(func):
+            raise AttributeError(f"db.{name} is not a function")
+
+        @functools.wraps(func)
+        async def call(*args, **kwargs):
+            return await run(func, *args, **kwargs)
+
+        setattr(self, name, call)  # build wrapper once per function
+        return call
+
+
+adb = AsyncDB()
+
+
+def shutdown():
+    """Wait for running DB calls and close connections. Call it after the Application has stopped."""
+    DB_EXECUTOR.shutdown(wait=True)
+    db.close_connections()
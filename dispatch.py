@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""Per-chat ordered, cross-chat parallel processing of updates for the threaded engine (sport_event_bot.py).
+
+python-telegram-bot v13 Dispatcher calls handlers one by one in its own thread. With
+ChatShardedDispatcher.wrap(callback) the Dispatcher thread only puts the update into one of
+`shards` FIFO queues (selected by chat_id) and returns to the next update at once.
+Every queue has its own worker thread, so:
+  - updates of one chat are processed strictly in order of arrival, never concurrently;
+  - different chats are processed in parallel, a slow chat delays only chats of its shard.
+"""
+
+import threading
+import time
+import queue
+from functools import wraps
+from typing import Callable, Dict, List, Optional
+from loguru import logger
+
+
+class ChatShardedDispatcher:
+    """Fixed set of ordered worker queues, update goes to queue number chat_id % shards"""
+
+    def __init__(self, shards: int = 8, warn_depth: int = 100):
+        self.shards = shards
+        self.warn_depth = warn_depth  # log a warning when a queue gets this long
+        self._queues: List['queue.Queue[Optional[tuple]]'] = [queue.Queue() for _ in range(shards)]
+        self._threads = [threading.Thread(target=self._run, args=(shard,), name=f'chat-shard-{shard}', daemon=True)
+                         for shard in range(shards)]
+        self.max_depth = [0] * shards
+        self.processed = [0] * shards
+        self.wait_seconds = [0.0] * shards  # total time updates spent in queue before processing
+        for thread in self._threads:
+            thread.start()
+
+    def shard_of(self, chat_id: int) -> int:
+        return chat_id % self.shards
+
+    def submit(self, chat_id: int, func: Callable, *args):
+        shard = self.shard_of(chat_id)
+        self._queues[shard].put((func, args, time.monotonic()))
+        depth = self._queues[shard].qsize()
+        if depth > self.max_depth[shard]:
+            self.max_depth[shard] = depth
+            if depth == self.warn_depth:
+                logger.warning(f'Chat shard {shard} queue depth reached {depth} (chat_id={chat_id})')
+
+    def wrap(self, callback: Callable) -> Callable:
+        """Handler callback for Dispatcher: process the update in the worker of its chat"""
+        @wraps(callback)
+        def wrapped(update, context):
+            chat = update.effective_chat
+            self.submit(chat.id if chat else 0, callback, update, context)
+        return wrapped
+
+    def depths(self) -> List[int]:
+        """Current number of queued (not yet started) updates per shard"""
+        return [q.qsize() for q in self._queues]
+
+    def stats(self) -> Dict[str, object]:
+        depths = self.depths()
+        processed = sum(self.processed)
+        return {'shards': self.shards, 'depth': sum(depths), 'depths': depths, 'max_depth': max(self.max_depth),
+                'processed': processed, 'avg_wait': sum(self.wait_seconds) / processed if processed else 0.0}
+
+    def stop(self):
+        """Process everything queued so far and stop worker threads"""
+        for q in self._queues:
+            q.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _run(self, shard: int):
+        q = self._queues[shard]
+        while True:
+            item = q.get()
+            if item is None:
+                break
+            func, args, queued_at = item
+            self.wait_seconds[shard] += time.monotonic() - queued_at
+            try:
+                func(*args)
+            except Exception as e:  # worker must survive any handler error
+                logger.exception(e)
+            self.processed[shard] += 1
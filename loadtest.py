@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+"""Synthetic load for the handler pipeline of sport_event_bot.py: no network, no Telegram.
+
+Fake Update/CallbackQuery objects (real python-telegram-bot v13 classes) are sent through ChatShardedDispatcher
+to button, add_player, show_info, fix_squad and show_stat; StubBot records API calls instead of sending them.
+Everything runs against a temporary SQLite database, the working database is not touched.
+
+    python loadtest.py --chats 50 --members 30 --updates 5000 --rate 0 --shards 8
+    python loadtest.py --chats 500 --rate 300 --json > before.json
+
+Reports handler latency percentiles (time in handler, and from arrival including queue wait),
+SQL statements per update and updates per second. Bot API calls are queued by outbound.ChatSender and made in its
+threads, outside the handlers: they are timed separately (from queuing to done, and the call itself),
+and the run ends when all of them are made.
+"""
+
+import sys
+import json
+import time
+import random
+import argparse
+import datetime
+import tempfile
+import threading
+import statistics
+from collections import Counter, defaultdict
+from itertools import count
+from typing import Callable, Dict, List
+from loguru import logger
+from telegram import CallbackQuery, Chat, Message, Update, User
+import db
+
+
+MIX = 'button=75,add=5,info=10,stat=5,fix=5'  # relative weights of generated updates
+
+
+class StubBot:
+    """Stands in for telegram.Bot: records calls, returns fake messages"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._message_ids = count(1000)
+        self.calls: Counter = Counter()
+        self.event_posts: Dict[int, int] = {}  # chat_id -> message_id of the latest post with buttons
+
+    def _record(self, method: str):
+        with self._lock:
+            self.calls[method] += 1
+
+    def send_message(self, chat_id, text, reply_markup=None, **_kwargs):
+        self._record('send_message')
+        message = Message(next(self._message_ids), datetime.datetime.now(), Chat(chat_id, Chat.GROUP), text=text, bot=self)
+        if reply_markup:
+            self.event_posts[chat_id] = message.message_id
+        return message
+
+    def edit_message_text(self, *_args, **_kwargs):
+        self._record('edit_message_text')
+        return True
+
+    def edit_message_reply_markup(self, *_args, **_kwargs):
+        self._record('edit_message_reply_markup')
+        return True
+
+    def answer_callback_query(self, *_args, **_kwargs):
+        self._record('answer_callback_query')
+        return True
+
+
+class StubContext:
+    """The part of CallbackContext used by handlers"""
+
+    def __init__(self, bot: StubBot):
+        self.bot = bot
+
+
+class UpdateFactory:
+    """Fake updates from members of fake chats"""
+
+    def __init__(self, bot: StubBot, chats: int, members: int, lang: str):
+        self.bot = bot
+        self._update_ids = count(1)
+        self._message_ids = count(1)
+        self.chat_ids = [-1000000 - n for n in range(chats)]
+        self.members = {chat_id: [User(chat_n * members + n + 1, f'Player{n}', False, last_name=f'Chat{chat_n}', language_code=lang)
+                                  for n in range(members)]
+                        for chat_n, chat_id in enumerate(self.chat_ids)}
+
+    def command(self, chat_id: int, user: User, text: str) -> Update:
+        message = Message(next(self._message_ids), datetime.datetime.now(), Chat(chat_id, Chat.GROUP), from_user=user, text=text, bot=self.bot)
+        return Update(next(self._update_ids), message=message)
+
+    def click(self, chat_id: int, user: User, data: str) -> Update:
+        post = Message(self.bot.event_posts.get(chat_id, 1), datetime.datetime.now(), Chat(chat_id, Chat.GROUP), bot=self.bot)
+        query = CallbackQuery(str(next(self._update_ids)), user, str(chat_id), message=post, data=data, bot=self.bot)
+        return Update(next(self._update_ids), callback_query=query)
+
+
+class StatementCounter:
+    """Counts SQL statements executed by all db.py connections (sqlite3 trace callback)"""
+
+    def __init__(self):
+        self.statements = 0
+        self._lock = threading.Lock()
+
+    def install(self, manager: db.ConnectionManager):
+        manager.on_connect = lambda conn: conn.set_trace_callback(self._trace)
+
+    def _trace(self, _statement: str):
+        with self._lock:
+            self.statements += 1
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    """p50/p95/p99/max in milliseconds"""
+    if len(samples) < 2:
+        samples = samples * 2 or [0.0, 0.0]
+    cuts = statistics.quantiles(samples, n=100, method='inclusive')
+    return {'count': len(samples), 'p50': cuts[49] * 1000, 'p95': cuts[94] * 1000, 'p99': cuts[98] * 1000, 'max': max(samples) * 1000}
+
+
+def parse_mix(mix: str) -> Dict[str, int]:
+    weights = {}
+    for item in mix.split(','):
+        name, weight = item.split('=')
+        weights[name.strip()] = int(weight)
+    return weights
+
+
+def run(args) -> Dict:
+    # imported after use_database(): db.py connections and caches are switched to the temporary database first
+    import sport_event_bot as bot_module  # pylint: disable=C0415
+    from dispatch import ChatShardedDispatcher  # pylint: disable=C0415
+    from outbound import ChatSender, EditCoalescer, RateLimiter  # pylint: disable=C0415
+    from core import load_language_bundles, with_language  # pylint: disable=C0415
+
+    if not args.telegram_limits:
+        bot_module.LIMITER = RateLimiter(global_rate=1e9, global_burst=1e9, chat_rate=1e9, chat_burst=1e9)
+    bot_module.SENDER = ChatSender(bot_module.LIMITER)
+    if args.group_commit:
+        db.enable_group_commit(args.group_commit)
+
+    load_language_bundles(bot_module.event_keyboard)
+    bot = StubBot()
+    factory = UpdateFactory(bot, args.chats, args.members, args.lang)
+    shards = ChatShardedDispatcher(args.shards)
+    if args.edit_window:
+        bot_module.EDITS = EditCoalescer(args.edit_window, submit=shards.submit)
+    service_times: Dict[str, List[float]] = defaultdict(list)
+    latencies: List[float] = []
+    outbound_times: Dict[str, List[float]] = defaultdict(list)  # from send() to done
+    outbound_calls: Dict[str, List[float]] = defaultdict(list)  # the call itself (rendering, SQL, Bot API)
+    lock = threading.Lock()
+
+    def made(name: str, queued: float, seconds: float):
+        with lock:
+            outbound_times[name].append(queued + seconds)
+            outbound_calls[name].append(seconds)
+
+    def timed(name: str, handler: Callable) -> Callable:
+        traced = db.traced_handler(with_language(handler))
+
+        def process(update, arrived: float):
+            started = time.perf_counter()
+            traced(update, StubContext(bot))  # one context per update, as in python-telegram-bot
+            finished = time.perf_counter()
+            with lock:
+                service_times[name].append(finished - started)
+                latencies.append(finished - arrived)
+        return process
+
+    handlers = {name: timed(name, handler) for name, handler in (
+        ('button', bot_module.button), ('add', bot_module.add_player), ('info', bot_module.show_info),
+        ('stat', bot_module.show_stat), ('fix', bot_module.fix_squad), ('event_add', bot_module.create_new_event))}
+
+    def send(name: str, chat_id: int, update: Update):
+        shards.submit(chat_id, handlers[name], update, time.perf_counter())
+
+    def new_event(chat_id: int):
+        send('event_add', chat_id, factory.command(chat_id, factory.members[chat_id][0], '/event_add Futsal tomorrow 19:00 max 12'))
+
+    for chat_id in factory.chat_ids:  # setup, not measured
+        new_event(chat_id)
+    shards.stop()
+    bot_module.SENDER.stop(timeout=None)  # setup posts are sent
+    bot_module.SENDER = ChatSender(bot_module.LIMITER)
+    bot_module.SENDER.on_made = made
+    shards = ChatShardedDispatcher(args.shards)
+    if bot_module.EDITS:
+        bot_module.EDITS.submit = shards.submit
+    service_times.clear()
+    latencies.clear()
+
+    rng = random.Random(args.seed)
+    weights = parse_mix(args.mix)
+    names, cum_weights = list(weights), list(weights.values())
+    statements = StatementCounter()
+    statements.install(db.MANAGER)
+    tracer = db.enable_tracing(args.trace_sql, slow_log='') if args.trace_sql else None  # slow queries go to stderr only
+    db.MANAGER.close_all()  # reopen connections with the trace callback
+
+    started = time.perf_counter()
+    for n in range(args.updates):
+        if args.rate:
+            delay = started + n / args.rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        chat_id = rng.choice(factory.chat_ids)
+        user = rng.choice(factory.members[chat_id])
+        name = rng.choices(names, cum_weights)[0]
+        if name == 'button':
+            send(name, chat_id, factory.click(chat_id, user, rng.choice(('ADD', 'ADD', 'REMOVE'))))
+        elif name == 'add':
+            send(name, chat_id, factory.command(chat_id, user, '/add'))
+        elif name == 'fix':
+            send(name, chat_id, factory.command(chat_id, user, '/fix'))
+            new_event(chat_id)  # next event of this chat
+        else:
+            send(name, chat_id, factory.command(chat_id, user, f'/{name}'))
+    if bot_module.EDITS:
+        bot_module.EDITS.stop()
+    shards.stop()
+    bot_module.SENDER.stop(timeout=None)  # all queued calls are made
+    elapsed = time.perf_counter() - started
+    outbound = bot_module.SENDER.stats()
+    db.disable_group_commit()
+    sql_trace = tracer.stats() if tracer else None
+    db.disable_tracing()
+
+    processed = len(latencies)
+    return {
+        'chats': args.chats, 'members': args.members, 'shards': args.shards, 'rate': args.rate, 'edit_window': args.edit_window,
+        'group_commit': args.group_commit, 'updates': processed, 'seconds': elapsed, 'updates_per_second': processed / elapsed,
+        'statements_per_update': statements.statements / processed if processed else 0.0,
+        'latency_ms': percentiles(latencies),
+        'handlers_ms': {name: percentiles(samples) for name, samples in sorted(service_times.items())},
+        'outbound_ms': {name: percentiles(samples) for name, samples in sorted(outbound_times.items())},
+        'outbound_call_ms': {name: percentiles(samples) for name, samples in sorted(outbound_calls.items())},
+        'bot_calls': dict(bot.calls), 'outbound': outbound, 'rate_limiter': bot_module.LIMITER.stats(), 'dispatcher': shards.stats(),
+        'sql_trace': sql_trace,
+    }
+
+
+def print_report(result: Dict):
+    print(f"{result['updates']} updates in {result['seconds']:.2f}s: {result['updates_per_second']:.1f} updates/s, "
+          f"{result['statements_per_update']:.1f} SQL statements/update")
+    print(f"{'':<12}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    rows = [('latency', result['latency_ms'])] + list(result['handlers_ms'].items())
+    for name, p in rows:
+        print(f"{name:<12}{p['count']:>8}{p['p50']:>10.2f}{p['p95']:>10.2f}{p['p99']:>10.2f}{p['max']:>10.2f}")
+    print(f"{'outbound':<24}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}{'call p50':>10}{'call p99':>10}")
+    for name, p in result['outbound_ms'].items():  # from queuing to done; call: rendering, SQL and the Bot API call
+        call = result['outbound_call_ms'][name]
+        print(f"{name:<24}{p['count']:>8}{p['p50']:>10.2f}{p['p95']:>10.2f}{p['p99']:>10.2f}{p['max']:>10.2f}{call['p50']:>10.2f}{call['p99']:>10.2f}")
+    print(f"Bot API calls: {result['bot_calls']}")
+    print(f"Outbound: {result['outbound']}")
+    if result['sql_trace']:
+        print(f"{'SQL by function':<36}{'count':>8}{'total ms':>12}{'avg ms':>10}{'max ms':>10}")
+        functions = sorted(result['sql_trace']['functions'].items(), key=lambda item: item[1]['total_ms'], reverse=True)
+        for name, h in functions[:15]:
+            print(f"{name:<36}{h['count']:>8}{h['total_ms']:>12.1f}{h['total_ms'] / h['count']:>10.3f}{h['max_ms']:>10.2f}")
+        handlers = [f"{name} {h['total_ms']:.0f} ms" for name, h in result['sql_trace']['handlers'].items()]
+        print(f"SQL by handler: {', '.join(handlers)}")
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Synthetic load test of bot handlers against a temporary database')
+    arg_parser.add_argument('--chats', type=int, default=50, help='number of group chats')
+    arg_parser.add_argument('--members', type=int, default=30, help='members per chat')
+    arg_parser.add_argument('--updates', type=int, default=5000, help='updates to send after setup')
+    arg_parser.add_argument('--rate', type=float, default=0, help='updates per second, 0 - as fast as possible')
+    arg_parser.add_argument('--mix', default=MIX, help=f'relative weights of updates (default: {MIX})')
+    arg_parser.add_argument('--shards', type=int, default=8, help='dispatcher worker threads')
+    arg_parser.add_argument('--edit-window', type=float, default=0, help='coalesce event post edits (seconds), 0 - edit at every click')
+    arg_parser.add_argument('--group-commit', type=float, default=0, help='group commit window (seconds), 0 - off')
+    arg_parser.add_argument('--telegram-limits', action='store_true', help='keep Telegram rate limits of outbound calls')
+    arg_parser.add_argument('--trace-sql', type=float, default=0, metavar='SLOW_MS',
+                            help='time SQL statements per db.py function (db.enable_tracing), log slower than SLOW_MS; 0 - off')
+    arg_parser.add_argument('--lang', default='en', help='language_code of fake users')
+    arg_parser.add_argument('--seed', type=int, default=1)
+    arg_parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = arg_parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level='WARNING')
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db.use_database(f'{tmp_dir}/loadtest.sqlite3')
+        db.migrate()
+        result = run(args)
+        db.close_connections()
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print_report(result)
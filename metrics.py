@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+"""Per-handler metrics of both engines in Prometheus text format.
+
+Every update processed by an instrumented handler (METRICS.instrument) is measured:
+wall time, time spent in db.py functions, number of db.py calls, number of Bot API calls, errors
+(exceptions and ERROR records logged while the update is processed, e.g. by @logger.catch).
+Waits of outbound calls for rate limiter tokens (outbound.RateLimiter) are exported per priority.
+Bot API calls queued by outbound.ChatSender run after the handler returned: their time in the queue and their own time
+(rendering, db.py and the Bot API call itself, with its then() callback) are histograms per call, not part of the handler's update.
+
+    python sport_event_bot.py --metrics-port 9101          # curl http://127.0.0.1:9101/metrics
+    python sport_event_bot.py --metrics-file logs/metrics.prom
+    kill -USR1 <pid>                                        # writes --metrics-file
+"""
+
+import os
+import time
+import signal
+import inspect
+import argparse
+import threading
+from contextvars import ContextVar
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Tuple
+from loguru import logger
+from outbound import PRIORITY_NAMES
+
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # seconds, last bucket is +Inf
+QUEUE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)  # seconds in outbound.ChatSender queues, rate limits
+
+# db.py functions called by handlers and core.py; time spent in them is the DB time of the update
+DB_FUNCTIONS = (
+    'add_or_update_user', 'apply_for_participation_in_the_event', 'check_chat_member_stats', 'close_all_open_events_for_chat',
+    'compose_full_name', 'event_add', 'fix_event', 'get_all_chat_ids', 'get_all_userids', 'get_chat_lang', 'get_chat_user_rp',
+    'get_event_datetime', 'get_event_limit', 'get_event_revoked_users', 'get_event_snapshot', 'get_event_text', 'get_event_users',
+    'get_full_names', 'get_known_chat_index', 'get_latest_bot_message_id', 'get_latest_bot_message_text', 'get_only_chat_participants',
+    'get_user_cancellation_datetime', 'penalty_for_user_in_chat', 'register_new_chat_id', 'revoke_application_for_the_event',
+    'save_latest_bot_message', 'set_chat_lang', 'set_event_datetime', 'set_players_limit', 'update_event_text',
+)
+
+
+class UpdateStats:
+    """Counters of the update being processed (CURRENT)"""
+    __slots__ = ('db_calls', 'db_seconds', 'db_depth', 'bot_calls', 'errors', 'finished')
+
+    def __init__(self):
+        self.db_calls = 0
+        self.db_seconds = 0.0
+        self.db_depth = 0  # db.py functions calling each other are counted once
+        self.bot_calls = 0
+        self.errors = 0
+        self.finished = False
+
+
+CURRENT: ContextVar[Optional[UpdateStats]] = ContextVar('CURRENT', default=None)
+
+
+class Histogram:
+    """Prometheus histogram: cumulative on output"""
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.bounds = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name: str, labels: str) -> List[str]:
+        result = []
+        cumulative = 0
+        for bound, count in zip([str(bound) for bound in self.bounds] + ['+Inf'], self.counts):
+            cumulative += count
+            result.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        result.append(f'{name}_sum{{{labels}}} {self.sum}')
+        result.append(f'{name}_count{{{labels}}} {self.count}')
+        return result
+
+
+class HandlerTotals:
+    """Metrics of one handler"""
+
+    def __init__(self):
+        self.duration = Histogram()
+        self.db_duration = Histogram()
+        self.db_calls = 0
+        self.bot_calls = 0
+        self.errors = 0
+
+
+class OutboundTotals:
+    """Metrics of one Bot API call (function name) queued by outbound.ChatSender"""
+
+    def __init__(self):
+        self.queued = Histogram(QUEUE_BUCKETS)
+        self.duration = Histogram()
+
+
+class HandlerMetrics:
+    """Metrics of instrumented handlers, rendered in Prometheus text exposition format"""
+
+    def __init__(self):
+        self.handlers: Dict[str, HandlerTotals] = {}
+        self.outbound: Dict[str, OutboundTotals] = {}
+        self.gauges: Dict[str, Tuple[str, Callable[[], float]]] = {}  # name -> (help, current value)
+        self.enabled = False  # set by install(), instrumented handlers are plain calls until then
+        self.limiter = None  # outbound.RateLimiter, set by install()
+        self._lock = threading.Lock()
+        self._error_sink: Optional[int] = None
+
+    def install(self, db_module, limiter=None, sender=None):
+        """Measure DB_FUNCTIONS of db_module, Bot API calls made through limiter (outbound.RateLimiter),
+        calls queued by sender (outbound.ChatSender) and logged errors"""
+        for name in DB_FUNCTIONS:
+            setattr(db_module, name, self.db_call(getattr(db_module, name)))
+        if limiter is not None:
+            limiter.on_call = bot_call
+            self.limiter = limiter
+        if sender is not None:
+            sender.on_made = self.outbound_made
+        self._error_sink = logger.add(self._log_error, level='ERROR', format='{message}')
+        self.enabled = True
+
+    def add_gauge(self, name: str, help_text: str, value: Callable[[], float]):
+        self.gauges[name] = (help_text, value)
+
+    def instrument(self, func: Callable) -> Callable:
+        """Handler decorator (sync or async): one measured update per call, nested handlers count into the outer update"""
+        name = func.__name__
+        if inspect.iscoroutinefunction(func):
+            @wraps(func)
+            async def wrapped_async(*args, **kwargs):
+                current = CURRENT.get()
+                if not self.enabled or current is not None and not current.finished:
+                    return await func(*args, **kwargs)
+                stats = UpdateStats()
+                token = CURRENT.set(stats)
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                except Exception:
+                    stats.errors += 1
+                    raise
+                finally:
+                    CURRENT.reset(token)
+                    self._record(name, stats, time.perf_counter() - started)
+            return wrapped_async
+
+        @wraps(func)
+        def wrapped(*args, **kwargs):
+            current = CURRENT.get()
+            if not self.enabled or current is not None and not current.finished:
+                return func(*args, **kwargs)
+            stats = UpdateStats()
+            token = CURRENT.set(stats)
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                stats.errors += 1
+                raise
+            finally:
+                CURRENT.reset(token)
+                self._record(name, stats, time.perf_counter() - started)
+        return wrapped
+
+    @staticmethod
+    def db_call(func: Callable) -> Callable:
+        """Wrapper of a db.py function adding its time to the current update"""
+        @wraps(func)
+        def wrapped(*args, **kwargs):
+            stats = CURRENT.get()
+            if stats is None or stats.db_depth:
+                return func(*args, **kwargs)
+            stats.db_depth += 1
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stats.db_seconds += time.perf_counter() - started
+                stats.db_calls += 1
+                stats.db_depth -= 1
+        return wrapped
+
+    def render(self) -> str:
+        """All metrics in Prometheus text format"""
+        lines = ['# HELP bot_handler_duration_seconds Wall time of processing one update by a handler',
+                 '# TYPE bot_handler_duration_seconds histogram']
+        with self._lock:
+            handlers = sorted(self.handlers.items())
+            for name, totals in handlers:
+                lines += totals.duration.lines('bot_handler_duration_seconds', f'handler="{name}"')
+            lines += ['# HELP bot_handler_db_duration_seconds Time spent in db.py functions per update',
+                      '# TYPE bot_handler_db_duration_seconds histogram']
+            for name, totals in handlers:
+                lines += totals.db_duration.lines('bot_handler_db_duration_seconds', f'handler="{name}"')
+            for metric, help_text, attribute in (
+                    ('bot_handler_db_calls_total', 'Calls of db.py functions', 'db_calls'),
+                    ('bot_handler_bot_api_calls_total', 'Bot API calls (sends, edits, callback answers)', 'bot_calls'),
+                    ('bot_handler_errors_total', 'Updates with an exception or a logged error', 'errors')):
+                lines += [f'# HELP {metric} {help_text}', f'# TYPE {metric} counter']
+                lines += [f'{metric}{{handler="{name}"}} {getattr(totals, attribute)}' for name, totals in handlers]
+            outbound = sorted(self.outbound.items())
+            if outbound:
+                for metric, help_text, attribute in (
+                        ('bot_outbound_queue_seconds', 'Time a queued Bot API call waited for earlier calls of its chat and rate limits', 'queued'),
+                        ('bot_outbound_call_seconds', 'Time of a queued Bot API call run after its handler returned (rendering, db.py, API)',
+                         'duration')):
+                    lines += [f'# HELP {metric} {help_text}', f'# TYPE {metric} histogram']
+                    for name, totals in outbound:
+                        lines += getattr(totals, attribute).lines(metric, f'call="{name}"')
+        if self.limiter is not None:
+            lines += self._limiter_lines(self.limiter.stats())
+        for name, (help_text, value) in sorted(self.gauges.items()):
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} gauge', f'{name} {value()}']
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _limiter_lines(stats: Dict) -> List[str]:
+        """outbound.RateLimiter.stats() in Prometheus text format"""
+        lines = []
+        for metric, metric_type, help_text, key in (
+                ('bot_outbound_calls_total', 'counter', 'Bot API calls that got rate limiter tokens', 'calls'),
+                ('bot_outbound_wait_seconds_total', 'counter', 'Time Bot API calls waited for rate limiter tokens', 'total_wait'),
+                ('bot_outbound_wait_seconds_max', 'gauge', 'Longest wait of one Bot API call for rate limiter tokens', 'max_wait')):
+            lines += [f'# HELP {metric} {help_text}', f'# TYPE {metric} {metric_type}']
+            lines += [f'{metric}{{priority="{name}"}} {stats[name][key]}' for name in PRIORITY_NAMES]
+        lines += ['# HELP bot_outbound_waiting Bot API calls waiting for rate limiter tokens now', '# TYPE bot_outbound_waiting gauge',
+                  f"bot_outbound_waiting {stats['waiting']}"]
+        return lines
+
+    def dump(self, filename: str):
+        """Write render() to filename atomically (rename of a temporary file)"""
+        try:
+            with open(f'{filename}.tmp', 'w', encoding='utf-8') as f:
+                f.write(self.render())
+            os.replace(f'{filename}.tmp', filename)
+            logger.info(f'Metrics written to {filename}')
+        except OSError as e:
+            logger.warning(f'Can not write metrics to {filename}: {e}')
+
+    def dump_on_signal(self, filename: str, signum: int = signal.SIGUSR1):
+        """dump(filename) when the process gets signum (in a new thread: the signal may interrupt a metrics update)"""
+        signal.signal(signum, lambda _signum, _frame: threading.Thread(target=self.dump, args=(filename,), name='metrics-dump').start())
+
+    def _record(self, name: str, stats: UpdateStats, seconds: float):
+        stats.finished = True  # tasks created by the handler (e.g. delayed edits) start their own updates
+        with self._lock:
+            totals = self.handlers.get(name)
+            if totals is None:
+                totals = self.handlers[name] = HandlerTotals()
+            totals.duration.observe(seconds)
+            totals.db_duration.observe(stats.db_seconds)
+            totals.db_calls += stats.db_calls
+            totals.bot_calls += stats.bot_calls
+            totals.errors += 1 if stats.errors else 0
+
+    def outbound_made(self, name: str, queued: float, seconds: float):
+        """outbound.ChatSender.on_made: a queued call was made"""
+        with self._lock:
+            totals = self.outbound.get(name)
+            if totals is None:
+                totals = self.outbound[name] = OutboundTotals()
+            totals.queued.observe(queued)
+            totals.duration.observe(seconds)
+
+    @staticmethod
+    def _log_error(_message):
+        stats = CURRENT.get()
+        if stats is not None:
+            stats.errors += 1
+
+
+METRICS = HandlerMetrics()
+
+
+def bot_call():
+    """Count one Bot API call in the current update (no-op outside of instrumented handlers)"""
+    stats = CURRENT.get()
+    if stats is not None:
+        stats.bot_calls += 1
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """GET /metrics -> server.metrics.render()"""
+    server: 'MetricsServer'
+
+    def do_GET(self):  # pylint: disable=C0103
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = self.server.metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=W0622
+        logger.debug(f'Metrics {self.address_string()}: {format % args}')
+
+
+class MetricsServer(ThreadingHTTPServer):
+    """Local HTTP endpoint for Prometheus scrapes"""
+    daemon_threads = True
+
+    def __init__(self, listen: str, port: int, metrics: HandlerMetrics = METRICS):
+        self.metrics = metrics
+        self._thread: Optional[threading.Thread] = None
+        super().__init__((listen, port), MetricsRequestHandler)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name='metrics', daemon=True)
+        self._thread.start()
+        logger.info(f'Metrics are served on http://{self.server_address[0]}:{self.server_address[1]}/metrics')
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread:
+            self._thread.join()
+
+
+def add_metrics_arguments(arg_parser: argparse.ArgumentParser):
+    """Command line options of metrics, shared by both engines"""
+    group = arg_parser.add_argument_group('metrics')
+    group.add_argument('--metrics-port', type=int, default=0, help='serve Prometheus metrics on this port, 0 - off')
+    group.add_argument('--metrics-listen', default='127.0.0.1', help='address of the metrics listener')
+    group.add_argument('--metrics-file', default='', help='write metrics to this file on SIGUSR1 and on exit')
+
+
+def start_metrics(args, db_module, limiter, sender=None) -> Optional[MetricsServer]:
+    """Instrument db.py and outbound calls, start the listener and/or the SIGUSR1 dump as configured by add_metrics_arguments()"""
+    if not (args.metrics_port or args.metrics_file):
+        return None
+    METRICS.install(db_module, limiter, sender)
+    if args.metrics_file:
+        METRICS.dump_on_signal(args.metrics_file)
+    if not args.metrics_port:
+        return None
+    server = MetricsServer(args.metrics_listen, args.metrics_port)
+    server.start()
+    return server
@@ -0,0 +1,560 @@
+# -*- coding: utf-8 -*-
+"""Outbound Telegram API calls: rate limiting and coalescing of event post edits.
+
+RateLimiter keeps the bot under Telegram limits proactively (instead of eating 429 backoffs):
+a global token bucket (~30 messages per second) and a bucket per chat (~20 messages per minute in a group).
+Every send/edit waits for a token of both; waiting calls get tokens by priority (edits of the live
+event post first, bulk texts like /stat last), then by arrival. Time spent waiting is measured per priority.
+
+The threaded engine never waits for tokens in a handler: ChatSender queues its calls per chat (in order)
+and makes them when RateLimiter allows, so a chat over its limit delays only its own calls.
+The asyncio engine awaits RateLimiter.call_async(), which does not block other updates either.
+
+Every click on the event post changes its text. Instead of one edit_message_text per click,
+EditCoalescer (threads, sport_event_bot.py) and AsyncEditCoalescer (asyncio, sport_event_bot_async.py)
+keep only the latest pending edit per (chat_id, message_id) and send at most one edit per `window` seconds:
+the first click after a quiet period is edited at once, clicks during the window are merged into one edit.
+Edit functions render the post at flush time, so the latest state is always the one sent.
+
+Telegram flood limits (429, RetryAfter) postpone the edit of that message by retry_after seconds
+(ChatSender in the threaded engine, AsyncEditCoalescer in the asyncio one), newer clicks are still merged into it
+and the edit is retried until it is made, so the final state is never lost.
+Works with python-telegram-bot v13 and v20: errors are recognized by their `retry_after` attribute.
+"""
+
+import asyncio
+import bisect
+import contextvars
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, Hashable, List, NamedTuple, Optional, Set, Tuple
+from loguru import logger
+
+
+EditKey = Tuple[int, int]  # (chat_id, message_id)
+
+PRIORITY_EDIT = 0  # edits of the live event post: clicks, removing buttons
+PRIORITY_POST = 1  # event posts and short replies to commands
+PRIORITY_BULK = 2  # /stat, /help and other long texts, countdown refreshes
+PRIORITY_NAMES = ('edit', 'post', 'bulk')
+
+
+def retry_after_seconds(error: Exception) -> Optional[float]:
+    """Seconds to wait from telegram.error.RetryAfter (int or timedelta), None for other errors"""
+    retry_after = getattr(error, 'retry_after', None)
+    if retry_after is None:
+        return None
+    if hasattr(retry_after, 'total_seconds'):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+class TokenBucket:
+    """`capacity` tokens at most, refilled with `rate` tokens per second"""
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self) -> float:
+        """Seconds until one token is available (after refill)"""
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """Global and per-chat token buckets with priorities, shared by all threads (or by one event loop).
+
+    limiter.call(chat_id, PRIORITY_POST, bot.send_message, chat_id, text)         # threads, blocks while waiting
+    await limiter.call_async(chat_id, PRIORITY_POST, bot.send_message, chat_id, text)  # asyncio
+    """
+
+    MAX_IDLE_CHATS = 10000  # full (idle) chat buckets are dropped above this number
+
+    def __init__(self, global_rate: float = 30.0, global_burst: float = 30.0, chat_rate: float = 20 / 60, chat_burst: float = 3.0):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._cond = threading.Condition()
+        self._global = TokenBucket(global_rate, global_burst, time.monotonic())
+        self._chats: Dict[int, TokenBucket] = {}
+        self._waiters: List[Tuple[int, int, int]] = []  # sorted (priority, seq, chat_id)
+        self._seq = itertools.count()
+        self.calls = [0] * len(PRIORITY_NAMES)
+        self.wait_total = [0.0] * len(PRIORITY_NAMES)
+        self.wait_max = [0.0] * len(PRIORITY_NAMES)
+        self.on_call: Optional[Callable[[], None]] = None  # called before every call()/call_async() request (metrics)
+
+    def acquire(self, chat_id: int, priority: int = PRIORITY_POST) -> float:
+        """Block until the call may be sent, return seconds waited"""
+        with self._cond:
+            started = time.monotonic()
+            ticket = self._enqueue(chat_id, priority)
+            try:
+                while True:
+                    delay = self._try_take(ticket, time.monotonic())
+                    if not delay:
+                        break
+                    self._cond.wait(delay)
+            finally:
+                self._dequeue(ticket)
+            return self._record(priority, started)
+
+    async def acquire_async(self, chat_id: int, priority: int = PRIORITY_POST) -> float:
+        """Wait (without blocking the event loop) until the call may be sent, return seconds waited"""
+        with self._cond:
+            started = time.monotonic()
+            ticket = self._enqueue(chat_id, priority)
+        try:
+            while True:
+                with self._cond:
+                    delay = self._try_take(ticket, time.monotonic())
+                if not delay:
+                    break
+                await asyncio.sleep(delay)
+        finally:
+            with self._cond:
+                self._dequeue(ticket)
+        with self._cond:
+            return self._record(priority, started)
+
+    def reserve(self, chat_id: int, priority: int = PRIORITY_POST) -> Tuple[int, int, int]:
+        """Join the waiters without blocking, tokens are taken by try_take() (ChatSender)"""
+        with self._cond:
+            return self._enqueue(chat_id, priority)
+
+    def try_take(self, ticket: Tuple[int, int, int], started: float) -> float:
+        """Take tokens for a reserve()d ticket: 0 - taken (wait since `started` is recorded), otherwise seconds before the next try"""
+        with self._cond:
+            delay = self._try_take(ticket, time.monotonic())
+            if not delay:
+                self._dequeue(ticket)
+                self._record(ticket[0], started)
+            return delay
+
+    def cancel(self, ticket: Tuple[int, int, int]):
+        """Leave the waiters without taking tokens"""
+        with self._cond:
+            self._dequeue(ticket)
+
+    def call(self, chat_id: int, priority: int, func: Callable, *args, **kwargs) -> Any:
+        """func(*args, **kwargs) when allowed by the limits; RetryAfter from Telegram pauses the chat and is raised"""
+        self.acquire(chat_id, priority)
+        if self.on_call:
+            self.on_call()
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            self._pause_on_retry_after(chat_id, e)
+            raise
+
+    async def call_async(self, chat_id: int, priority: int, func: Callable, *args, **kwargs) -> Any:
+        """await func(*args, **kwargs) when allowed by the limits; RetryAfter from Telegram pauses the chat and is raised"""
+        await self.acquire_async(chat_id, priority)
+        if self.on_call:
+            self.on_call()
+        try:
+            return await func(*args, **kwargs)
+        except Exception as e:
+            self._pause_on_retry_after(chat_id, e)
+            raise
+
+    def pause(self, chat_id: int, seconds: float):
+        """No calls to chat_id for `seconds` (e.g. after 429 Too Many Requests)"""
+        with self._cond:
+            bucket = self._chat_bucket(chat_id, time.monotonic())
+            bucket.tokens = min(bucket.tokens, 1 - seconds * bucket.rate)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            result: Dict[str, Any] = {'waiting': len(self._waiters), 'chats': len(self._chats)}
+            for priority, name in enumerate(PRIORITY_NAMES):
+                calls = self.calls[priority]
+                result[name] = {'calls': calls, 'avg_wait': self.wait_total[priority] / calls if calls else 0.0,
+                                'max_wait': self.wait_max[priority], 'total_wait': self.wait_total[priority]}
+            return result
+
+    def _pause_on_retry_after(self, chat_id: int, error: Exception):
+        delay = retry_after_seconds(error)
+        if delay:
+            self.pause(chat_id, delay)
+
+    def _enqueue(self, chat_id: int, priority: int) -> Tuple[int, int, int]:
+        ticket = (priority, next(self._seq), chat_id)
+        bisect.insort(self._waiters, ticket)
+        return ticket
+
+    def _dequeue(self, ticket: Tuple[int, int, int]):
+        index = bisect.bisect_left(self._waiters, ticket)
+        if index < len(self._waiters) and self._waiters[index] == ticket:
+            del self._waiters[index]
+            self._cond.notify_all()  # next waiter may go now
+
+    def _record(self, priority: int, started: float) -> float:
+        waited = time.monotonic() - started
+        self.calls[priority] += 1
+        self.wait_total[priority] += waited
+        self.wait_max[priority] = max(self.wait_max[priority], waited)
+        return waited
+
+    def _chat_bucket(self, chat_id: int, now: float) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self.MAX_IDLE_CHATS:
+                self._drop_idle_chats(now)
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst, now)
+        bucket.refill(now)
+        return bucket
+
+    def _drop_idle_chats(self, now: float):
+        waiting = {ticket[2] for ticket in self._waiters}
+        for chat_id, bucket in list(self._chats.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.capacity and chat_id not in waiting:
+                del self._chats[chat_id]
+
+    def _try_take(self, ticket: Tuple[int, int, int], now: float) -> float:
+        """Take tokens for ticket if it is the first waiter (by priority) whose chat has a token.
+        Return 0 on success, otherwise seconds to wait before the next try."""
+        self._global.refill(now)
+        own_bucket = self._chat_bucket(ticket[2], now)
+        if own_bucket.tokens < 1:
+            return max(own_bucket.wait_time(), self._global.wait_time())
+        if self._global.tokens < 1:
+            return self._global.wait_time()
+        for waiter in self._waiters:
+            if waiter == ticket:
+                own_bucket.tokens -= 1
+                self._global.tokens -= 1
+                return 0.0
+            if self._chat_bucket(waiter[2], now).tokens >= 1:
+                break  # a waiter before this ticket may go first
+        return 1 / self._global.rate
+
+
+class OutboundCall(NamedTuple):
+    """A call queued by ChatSender.send()"""
+    priority: int
+    key: Optional[Hashable]
+    func: Callable
+    args: tuple
+    kwargs: Dict[str, Any]
+    then: Optional[Callable[[Any], None]]
+    future: Future
+    context: contextvars.Context  # of the handler: SQL tracing and metrics of then()
+    queued: float  # time.monotonic() of the first send()
+    attempts: int = 0
+
+
+class ChatSender:
+    """Outbound calls of the threaded engine queued per chat, handlers never wait for rate limits.
+
+    sender.send(chat_id, PRIORITY_POST, bot.send_message, chat_id, text, then=save_message_id)  # Future, at once
+
+    Calls of one chat are made one by one in order of submission: the next one starts after the previous one
+    and its then(result) finished, so e.g. a new post's message_id is saved before the next call of the chat reads it.
+    The first queued call of every chat waits for RateLimiter tokens in the sender thread (by priority across chats),
+    then runs in one of `workers` threads. A queued call with the same `key` is replaced instead of queueing another one.
+    RetryAfter pauses the chat and the call is made again, up to `retries` times. Keyed calls (edits of a post,
+rendered when they are made) are retried until they succeed: there is one per key, and the last one carries the final text.
+    on_made(name, queued, seconds) is called after every call made: seconds from send() to the start of the call
+    (rate limits, earlier calls of the chat) and seconds of the call with its then().
+    """
+
+    def __init__(self, limiter: RateLimiter, workers: int = 8, retries: int = 3):
+        self.limiter = limiter
+        self.retries = retries
+        self._queues: Dict[int, Deque[OutboundCall]] = {}  # chat_id -> calls not started yet
+        self._tickets: Dict[int, Tuple[int, int, int]] = {}  # chat_id -> limiter ticket of its first queued call
+        self._busy: Set[int] = set()  # chats with a call running in a worker
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._abandon = False
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix='outbound')
+        self.sent = 0
+        self.replaced = 0
+        self.retried = 0
+        self.failed = 0
+        self.on_made: Optional[Callable[[str, float, float], None]] = None  # metrics, loadtest.py
+        self._thread = threading.Thread(target=self._run, name='outbound', daemon=True)
+        self._thread.start()
+
+    def send(self, chat_id: int, priority: int, func: Callable, *args, then: Optional[Callable[[Any], None]] = None,
+             key: Optional[Hashable] = None, **kwargs) -> Future:
+        """Queue func(*args, **kwargs) for chat_id, then(result) after it succeeded. The Future gets the result or the error."""
+        if self.limiter.on_call:
+            self.limiter.on_call()
+        with self._cond:
+            chat_queue = self._queues.setdefault(chat_id, deque())
+            if key is not None:
+                for index, queued in enumerate(chat_queue):
+                    if queued.key == key:
+                        chat_queue[index] = queued._replace(priority=min(priority, queued.priority), func=func, args=args, kwargs=kwargs,
+                                                            then=then, context=contextvars.copy_context())
+                        self.replaced += 1
+                        if index == 0 and priority < queued.priority and chat_id in self._tickets:
+                            self.limiter.cancel(self._tickets.pop(chat_id))  # wait with the new priority
+                            self._next(chat_id)
+                        return queued.future
+            future: Future = Future()
+            chat_queue.append(OutboundCall(priority, key, func, args, kwargs, then, future, contextvars.copy_context(), time.monotonic()))
+            self._next(chat_id)
+            return future
+
+    def stats(self) -> Dict[str, int]:
+        with self._cond:
+            return {'queued': sum(len(chat_queue) for chat_queue in self._queues.values()), 'chats': len(self._queues),
+                    'sent': self.sent, 'replaced': self.replaced, 'retried': self.retried, 'failed': self.failed}
+
+    def stop(self, timeout: Optional[float] = 10.0):
+        """Make the queued calls (at most `timeout` seconds, None - all of them; the rest fail) and stop the threads"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            with self._cond:
+                self._abandon = True
+                self._cond.notify()
+            self._thread.join()
+        self._executor.shutdown()
+
+    def _next(self, chat_id: int):
+        """Under _cond: the first queued call of an idle chat starts waiting for tokens"""
+        chat_queue = self._queues.get(chat_id)
+        if not chat_queue:
+            self._queues.pop(chat_id, None)
+        elif chat_id not in self._busy and chat_id not in self._tickets:
+            self._tickets[chat_id] = self.limiter.reserve(chat_id, chat_queue[0].priority)
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._abandon:
+                        self._fail_queued()
+                        return
+                    if self._stopping and not self._tickets and not self._busy:
+                        return  # every queued call was made
+                    ready, delay = [], None
+                    for chat_id, ticket in sorted(self._tickets.items(), key=lambda item: item[1]):  # by priority, then arrival
+                        wait = self.limiter.try_take(ticket, self._queues[chat_id][0].queued)
+                        if not wait:
+                            ready.append(chat_id)
+                        elif delay is None or wait < delay:
+                            delay = wait
+                    if ready:
+                        break
+                    self._cond.wait(delay)
+                for chat_id in ready:
+                    del self._tickets[chat_id]
+                    self._busy.add(chat_id)
+                    self._executor.submit(self._call, chat_id, self._queues[chat_id].popleft())
+
+    def _call(self, chat_id: int, call: OutboundCall):
+        try:
+            call.context.run(self._make, chat_id, call)
+        finally:
+            with self._cond:
+                self._busy.discard(chat_id)
+                self._next(chat_id)
+                self._cond.notify()
+
+    def _make(self, chat_id: int, call: OutboundCall):
+        name = getattr(call.func, '__name__', 'call')
+        started = time.monotonic()
+        try:
+            result = call.func(*call.args, **call.kwargs)
+        except Exception as e:  # pylint: disable=W0703  # errors go to the Future
+            delay = retry_after_seconds(e)
+            if delay:
+                self.limiter.pause(chat_id, delay)
+                if (call.key is not None or call.attempts < self.retries) and not self._abandon:
+                    logger.warning(f'{name} to chat {chat_id} postponed for {delay}s: {e}')
+                    with self._cond:
+                        self.retried += 1
+                        self._queues.setdefault(chat_id, deque()).appendleft(call._replace(attempts=call.attempts + 1))
+                    return
+            logger.warning(f'{name} to chat {chat_id} failed: {e}')
+            with self._cond:
+                self.failed += 1
+            self._made(name, call, started)
+            call.future.set_exception(e)
+            return
+        if call.then:
+            try:
+                call.then(result)
+            except Exception as e:  # pylint: disable=W0703
+                logger.exception(e)
+        with self._cond:
+            self.sent += 1
+        self._made(name, call, started)
+        call.future.set_result(result)
+
+    def _made(self, name: str, call: OutboundCall, started: float):
+        on_made = self.on_made
+        if on_made:
+            on_made(name, started - call.queued, time.monotonic() - started)
+
+    def _fail_queued(self):
+        """Under _cond, at stop(): queued calls are not made (calls already running finish)"""
+        for ticket in self._tickets.values():
+            self.limiter.cancel(ticket)
+        self._tickets.clear()
+        dropped = 0
+        for chat_queue in self._queues.values():
+            while chat_queue:
+                chat_queue.popleft().future.set_exception(RuntimeError('bot stopped before the call was made'))
+                dropped += 1
+        self.failed += dropped
+        logger.warning(f'{dropped} outbound call(s) not made: the bot is stopping')
+
+
+class EditCoalescer:
+    """Debounced edits for the threaded engine.
+
+    Due edits are handed to submit(chat_id, func, *args) (e.g. ChatShardedDispatcher.submit, so the edit is
+    ordered with other updates of the chat), by default they run in the coalescer thread.
+    func only queues the Bot API call (ChatSender.send with the post as key): ChatSender retries it, not the coalescer.
+    """
+
+    def __init__(self, window: float = 1.0, submit: Optional[Callable] = None):
+        self.window = window
+        self.submit = submit or (lambda _chat_id, func, *args: func(*args))
+        self._pending: Dict[Hashable, Tuple[Callable, tuple]] = {}  # key -> latest (func, args)
+        self._due: Dict[Hashable, float] = {}  # key -> time of next flush (pending) or end of cooldown
+        self._heap: List[Tuple[float, Hashable]] = []  # (due, key), entries not matching _due are stale
+        self._cond = threading.Condition()
+        self._stopping = False
+        self.scheduled = 0
+        self.coalesced = 0
+        self.flushed = 0
+        self._thread = threading.Thread(target=self._run, name='edit-coalescer', daemon=True)
+        self._thread.start()
+
+    def schedule(self, key: EditKey, func: Callable, *args):
+        """Call func(*args) for key soon; replaces a not yet sent call for the same key"""
+        with self._cond:
+            self.scheduled += 1
+            if key in self._pending:
+                self.coalesced += 1
+            self._pending[key] = (func, args)
+            if key not in self._due:  # not in cooldown: flush now
+                self._push(key, time.monotonic())
+
+    def stats(self) -> Dict[str, int]:
+        return {'pending': len(self._pending), 'scheduled': self.scheduled, 'coalesced': self.coalesced, 'flushed': self.flushed}
+
+    def stop(self):
+        """Send all pending edits now (ignoring window) and stop the thread"""
+        with self._cond:
+            self._stopping = True
+            pending, self._pending = self._pending, {}
+            self._cond.notify()
+        self._thread.join()
+        for key, (func, args) in pending.items():
+            self.submit(key[0], self._flush, key, func, args)
+
+    def _push(self, key: Hashable, due: float):
+        self._due[key] = due
+        heapq.heappush(self._heap, (due, key))
+        self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopping:
+                        return
+                    now = time.monotonic()
+                    if self._heap and self._due.get(self._heap[0][1]) != self._heap[0][0]:
+                        heapq.heappop(self._heap)  # stale
+                        continue
+                    if self._heap and self._heap[0][0] <= now:
+                        break
+                    self._cond.wait(self._heap[0][0] - now if self._heap else None)
+                _, key = heapq.heappop(self._heap)
+                if key not in self._pending:  # cooldown is over, nothing new
+                    del self._due[key]
+                    continue
+                func, args = self._pending.pop(key)
+                self._push(key, now + self.window)  # cooldown, clicks during it are merged
+            self.submit(key[0], self._flush, key, func, args)
+
+    def _flush(self, key: Hashable, func: Callable, args: tuple):
+        try:
+            func(*args)
+            self.flushed += 1
+        except Exception as e:  # pylint: disable=W0703
+            logger.warning(f'Edit {key} failed: {e}')
+
+
+class AsyncEditCoalescer:
+    """Debounced edits for the asyncio engine: func is a coroutine function, one flushing task per active key"""
+
+    def __init__(self, window: float = 1.0):
+        self.window = window
+        self._pending: Dict[Hashable, Tuple[Callable, tuple]] = {}
+        self._tasks: Dict[Hashable, asyncio.Task] = {}
+        self.scheduled = 0
+        self.coalesced = 0
+        self.flushed = 0
+        self.retries = 0
+
+    def schedule(self, key: EditKey, func: Callable, *args, replace: bool = True):
+        """Await func(*args) for key soon; replaces a not yet sent call for the same key (replace=False: keeps it)"""
+        self.scheduled += 1
+        if key in self._pending:
+            self.coalesced += 1
+            if not replace:
+                return
+        self._pending[key] = (func, args)
+        if key not in self._tasks:
+            self._tasks[key] = asyncio.create_task(self._flush_loop(key))
+
+    def stats(self) -> Dict[str, int]:
+        return {'pending': len(self._pending), 'scheduled': self.scheduled, 'coalesced': self.coalesced,
+                'flushed': self.flushed, 'retries': self.retries}
+
+    async def stop(self, _application=None):
+        """Send all pending edits now (ignoring window). Can be used as Application post_stop callback."""
+        for task in self._tasks.values():
+            task.cancel()
+        pending, self._pending = self._pending, {}
+        for key, (func, args) in pending.items():
+            await self._flush(key, func, args)
+
+    async def _flush_loop(self, key: Hashable):
+        try:
+            while key in self._pending:
+                func, args = self._pending.pop(key)
+                delay = await self._flush(key, func, args)
+                await asyncio.sleep(delay)  # cooldown, clicks during it are merged
+        finally:
+            del self._tasks[key]
+
+    async def _flush(self, key: Hashable, func: Callable, args: tuple) -> float:
+        """Send the edit, return seconds to wait before the next edit of this key"""
+        try:
+            await func(*args)
+            self.flushed += 1
+        except Exception as e:
+            delay = retry_after_seconds(e)
+            if delay is None:
+                logger.warning(f'Edit {key} failed: {e}')
+                return self.window
+            logger.warning(f'Edit {key} postponed for {delay}s: {e}')
+            self.retries += 1
+            self._pending.setdefault(key, (func, args))
+            return delay
+        return self.window
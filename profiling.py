@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+"""On-demand profiling of live handlers, for operators only (--operators).
+
+    /profile cpu 500 button,show_info   cProfile of the next 500 updates of button and show_info
+    /profile cpu 30s                    cProfile of all handlers for 30 seconds
+    /profile memory 2000                tracemalloc: allocations grown during the next 2000 updates
+    /profile stop                       finish now
+    /profile                            status
+    kill -USR2 <pid>                    start (cpu, all handlers, defaults) or stop
+
+A session ends after N updates or T seconds (PROFILE_UPDATES / PROFILE_SECONDS by default, whichever comes first)
+and writes to --profile-dir:
+    profile-cpu-<time>.pstats (python -m pstats) and profile-cpu-<time>.txt (top functions),
+    profile-memory-<time>.snapshot (tracemalloc.Snapshot.load) and profile-memory-<time>.txt (top allocation sites).
+
+The threaded engine profiles every selected update separately in its worker thread and merges the results.
+The asyncio engine (thread_wide) profiles the event loop thread for the whole session: all handlers
+interleaved on the loop are included, the handler list only selects which updates are counted.
+Rendering and SQL run in db_async executor threads: every call submitted there during the session (Profiler.call)
+is profiled in its thread and merged into the same result.
+When no session is running, Profiler.wrap costs one attribute check per update.
+
+Python 3.12+ (cProfile on sys.monitoring) allows one enabled profile per process, and it sees every thread.
+There an update is profiled only if no other update is (the others run unprofiled and are counted as skipped,
+their time may still show up in the profiled one), and the asyncio engine's thread-wide profile already covers
+the executor threads, so Profiler.call does not profile them again. A profiling tool that is already active
+(debugger, coverage) makes CPU sessions fail to start, or skips the updates.
+"""
+
+import io
+import os
+import sys
+import time
+import signal
+import pstats
+import asyncio
+import inspect
+import cProfile
+import argparse
+import threading
+import tracemalloc
+from functools import wraps
+from typing import Any, Callable, Iterable, List, Optional, Set, Tuple
+from loguru import logger
+
+
+PROFILE_UPDATES = 1000  # default session length, updates
+PROFILE_SECONDS = 60.0  # default session length, seconds
+PROFILE_TOP = 40  # lines in text summaries
+TRACEMALLOC_FRAMES = 10
+ONE_PROFILE_PER_PROCESS = sys.version_info >= (3, 12)  # see module docstring
+PROFILE_SLOT = threading.Lock()  # held while an update is profiled, when ONE_PROFILE_PER_PROCESS
+
+
+class ProfileSession:
+    """One profiling session: cpu (cProfile) or memory (tracemalloc)"""
+
+    def __init__(self, mode: str, handlers: Set[str], updates: int, seconds: float, directory: str):
+        self.mode = mode
+        self.handlers = handlers  # empty - all
+        self.updates_left = updates
+        self.deadline = time.monotonic() + seconds
+        self.basename = os.path.join(directory, f"profile-{mode}-{time.strftime('%Y%m%d-%H%M%S')}")
+        self.updates = 0
+        self.skipped = 0  # cpu updates run unprofiled: another profile was enabled
+        self.stats: Optional[pstats.Stats] = None  # merged per-update profiles
+        self.profile: Optional[cProfile.Profile] = None  # thread-wide profile
+        self.snapshot: Optional[tracemalloc.Snapshot] = None
+        self.started_tracemalloc = False
+        if mode == 'memory':
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(TRACEMALLOC_FRAMES)
+                self.started_tracemalloc = True
+            self.snapshot = tracemalloc.take_snapshot()
+
+    def selected(self, handler: str) -> bool:
+        return not self.handlers or handler in self.handlers
+
+    def add(self, profile: cProfile.Profile):
+        if self.stats is None:
+            self.stats = pstats.Stats(profile)
+        else:
+            self.stats.add(profile)
+
+    def finish(self) -> List[str]:
+        """Write result files, returns their names"""
+        os.makedirs(os.path.dirname(self.basename) or '.', exist_ok=True)
+        if self.mode == 'memory':
+            return self._finish_memory()
+        if self.profile is not None:
+            self.profile.disable()
+            self.add(self.profile)
+        if self.stats is None:
+            return []
+        self.stats.dump_stats(f'{self.basename}.pstats')
+        summary = io.StringIO()
+        summary.write(f'{self.updates} update(s), {self.skipped} not profiled, handlers: {", ".join(sorted(self.handlers)) or "all"}\n')
+        for order in ('cumulative', 'tottime'):
+            self.stats.stream = summary
+            self.stats.sort_stats(order).print_stats(PROFILE_TOP)
+        with open(f'{self.basename}.txt', 'w', encoding='utf-8') as f:
+            f.write(summary.getvalue())
+        return [f'{self.basename}.pstats', f'{self.basename}.txt']
+
+    def _finish_memory(self) -> List[str]:
+        snapshot = tracemalloc.take_snapshot()
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+        snapshot.dump(f'{self.basename}.snapshot')
+        lines = [f'{self.updates} update(s), handlers: {", ".join(sorted(self.handlers)) or "all"}', 'Top allocation growth:']
+        lines += [str(stat) for stat in snapshot.compare_to(self.snapshot, 'lineno')[:PROFILE_TOP]]
+        with open(f'{self.basename}.txt', 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        return [f'{self.basename}.snapshot', f'{self.basename}.txt']
+
+
+def parse_profile_command(arg: str) -> Tuple[str, int, float, Set[str]]:
+    """'cpu 500 button,show_info' -> ('cpu', 500, PROFILE_SECONDS, {'button', 'show_info'}); ValueError if malformed"""
+    words = arg.split()
+    mode = words.pop(0) if words else 'cpu'
+    if mode not in ('cpu', 'memory'):
+        raise ValueError(f'unknown mode {mode}')
+    updates: Optional[int] = None
+    seconds: Optional[float] = None
+    handlers: Set[str] = set()
+    for word in words:
+        if word.endswith('s') and word[:-1].replace('.', '', 1).isdigit():
+            seconds = float(word[:-1])
+        elif word.isdigit():
+            updates = int(word)
+        else:
+            handlers |= {name for name in word.split(',') if name}
+    if updates is None:  # only T seconds given: any number of updates
+        updates = PROFILE_UPDATES if seconds is None else 10 ** 9
+    return mode, updates, PROFILE_SECONDS if seconds is None else seconds, handlers
+
+
+class Profiler:
+    """Runs at most one ProfileSession, see module docstring"""
+
+    def __init__(self, operators: Iterable[int] = (), directory: str = 'logs', thread_wide: bool = False):
+        self.operators: Set[int] = set(operators)
+        self.directory = directory
+        self.thread_wide = thread_wide  # asyncio engine: one profile of the calling (event loop) thread
+        self.session: Optional[ProfileSession] = None
+        self._lock = threading.RLock()  # reentrant: stop() may be called from a signal handler in the main thread
+
+    def start(self, mode: str = 'cpu', updates: int = PROFILE_UPDATES, seconds: float = PROFILE_SECONDS,
+              handlers: Set[str] = frozenset()) -> ProfileSession:
+        """Start a session; in thread_wide mode call it from the running event loop"""
+        with self._lock:
+            if self.session:
+                raise RuntimeError(f'{self.session.mode} profiling is already running')
+            session = ProfileSession(mode, set(handlers), updates, seconds, self.directory)
+            if mode == 'cpu' and self.thread_wide:
+                session.profile = cProfile.Profile()
+                try:
+                    session.profile.enable()
+                except ValueError as e:  # Python 3.12+: another profiling tool is already active
+                    raise RuntimeError(f'cpu profiling can not start: {e}') from None
+            self.session = session
+        if self.thread_wide:  # the profile can only be disabled in the profiled (event loop) thread
+            asyncio.get_running_loop().call_later(seconds, self.stop, session)
+        else:
+            timer = threading.Timer(seconds, self.stop, args=(session,))
+            timer.daemon = True
+            timer.start()
+        logger.warning(f'Profiling started: {mode}, {updates} update(s) or {seconds}s, handlers: {", ".join(sorted(handlers)) or "all"}')
+        return session
+
+    def stop(self, session: Optional[ProfileSession] = None) -> List[str]:
+        """Finish the running session (only if it is `session`, when given) and write its files"""
+        with self._lock:
+            if self.session is None or session is not None and self.session is not session:
+                return []
+            session, self.session = self.session, None
+            files = session.finish()
+        logger.warning(f'Profiling finished: {session.updates} update(s), {session.skipped} not profiled, files: {", ".join(files) or "none"}')
+        return files
+
+    def toggle(self):
+        """Signal handler: start cpu profiling of all handlers with defaults, or stop the running session"""
+        if self.session:
+            self.stop()
+        else:
+            try:
+                self.start()
+            except RuntimeError as e:
+                logger.error(e)
+
+    def command(self, user_id: int, arg: str) -> Optional[str]:
+        """/profile from user_id: reply text, None for non-operators (command is ignored)"""
+        if user_id not in self.operators:
+            logger.warning(f'/profile from user_id={user_id} who is not an operator, ignored')
+            return None
+        if arg.strip() == 'stop':
+            files = self.stop()
+            return f'Profiling finished: {", ".join(files)}' if files else 'No profiling session'
+        if not arg.strip() and self.session:
+            session = self.session
+            return f'{session.mode} profiling: {session.updates} update(s) so far, results will be written to {session.basename}.*'
+        try:
+            session = self.start(*parse_profile_command(arg))
+        except (ValueError, RuntimeError) as e:
+            return f'{e}. Usage: /profile [cpu|memory] [N updates] [Ts] [handler,...] | /profile stop'
+        return f'{session.mode} profiling started, results will be written to {session.basename}.*'
+
+    def wrap(self, func: Callable) -> Callable:
+        """Handler decorator (sync or async): profile the update while a session selecting this handler is running"""
+        name = func.__name__
+        if inspect.iscoroutinefunction(func):
+            @wraps(func)
+            async def wrapped_async(*args, **kwargs):
+                session = self.session
+                if session is None or not session.selected(name):
+                    return await func(*args, **kwargs)
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    self._count(session)
+            return wrapped_async
+
+        @wraps(func)
+        def wrapped(*args, **kwargs):
+            session = self.session
+            if session is None or not session.selected(name):
+                return func(*args, **kwargs)
+            if session.mode != 'cpu' or session.profile is not None:
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self._count(session)
+            try:
+                return self._profiled(session, func, *args, **kwargs)
+            finally:
+                self._count(session)
+        return wrapped
+
+    def call(self, func: Callable, *args, **kwargs) -> Any:
+        """func(*args, **kwargs) in an executor thread of the asyncio engine, profiled while a thread_wide cpu session runs"""
+        session = self.session
+        if session is None or session.profile is None or ONE_PROFILE_PER_PROCESS:  # 3.12+: the session profile sees this thread
+            return func(*args, **kwargs)
+        return self._profiled(session, func, *args, **kwargs)
+
+    def _profiled(self, session: ProfileSession, func: Callable, *args, **kwargs) -> Any:
+        """func(*args, **kwargs) under its own cProfile.Profile added to session; unprofiled if another profile is enabled"""
+        slot = PROFILE_SLOT if ONE_PROFILE_PER_PROCESS else None
+        if slot is not None and not slot.acquire(blocking=False):
+            self._skip(session)
+            return func(*args, **kwargs)
+        try:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:  # another profiling tool is active
+                self._skip(session)
+                return func(*args, **kwargs)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profile.disable()
+                with self._lock:
+                    if self.session is session:
+                        session.add(profile)
+        finally:
+            if slot is not None:
+                slot.release()
+
+    def _skip(self, session: ProfileSession):
+        with self._lock:
+            session.skipped += 1
+
+    def _count(self, session: ProfileSession):
+        with self._lock:
+            session.updates += 1
+            session.updates_left -= 1
+            done = session.updates_left <= 0 or time.monotonic() >= session.deadline
+        if done:
+            self.stop(session)
+
+
+PROFILER = Profiler()
+
+
+def add_profiling_arguments(arg_parser: argparse.ArgumentParser):
+    """Command line options of /profile, shared by both engines"""
+    group = arg_parser.add_argument_group('profiling')
+    group.add_argument('--operators', default='', help='comma separated user_ids allowed to use /profile; empty - /profile is disabled')
+    group.add_argument('--profile-dir', default='logs', help='directory for profiling results')
+
+
+def configure_profiler(args, thread_wide: bool = False) -> Profiler:
+    """Apply add_profiling_arguments() options to PROFILER; SIGUSR2 toggles a default cpu session"""
+    PROFILER.operators = {int(user_id) for user_id in args.operators.split(',') if user_id.strip()}
+    PROFILER.directory = args.profile_dir
+    PROFILER.thread_wide = thread_wide
+    signal.signal(signal.SIGUSR2, lambda _signum, _frame: PROFILER.toggle())
+    return PROFILER
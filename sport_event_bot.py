@@ -10,99 +10,99 @@ To use it on your own you need your own API_TOKEN from BOT_FATHER. Follow his in
 Then create token.txt file in project folder and stat this main file.
 
 Based on python-telegram-bot v13.xx (multithreaded).
-May be it will be rewrited to python-telegram-bot v20.0 with asyncio in future.
+Asyncio engine on python-telegram-bot v20 with the same commands: sport_event_bot_async.py
 
 TODO: priority list of participants?, bot name (any) removing from command
 TODO: /add /remove with event without description
 """
 
 import sys
-from typing import Optional, Callable  #, Union, List, Set
-import gettext
-from functools import wraps
-import datetime
-import re
+import signal
+import argparse
+import threading
+from functools import partial
+from typing import Callable, Optional
+from startup import STARTUP  # before third-party imports: their time is the first phase of the startup report
 from loguru import logger
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackQueryHandler
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ParseMode
-import parsedatetime
-from recurrent.event_parser import RecurringEvent
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ParseMode, Update
 import db
-
-
-def _(text) -> int:
-    """Keep text in English"""
-    return text
-
-
-TRANSLATIONS = {
-    'uk': gettext.translation('ua', localedir='locale', languages=['ua']).gettext,
-    'pt-br': gettext.translation('pt', localedir='locale', languages=['pt']).gettext,
-    'ru': gettext.translation('ru', localedir='locale', languages=['ru']).gettext
-    # 'en': _
-}
-
-
-def make_translatable_user_id_context(func):
-    """Switch language if possible"""
-    @wraps(func)
-    def wrapped(update, context):
-        global _  #pylint: disable=W0603
-        try:
-            lang = update.message.from_user.language_code
-            logger.info(f'lang={lang}')
-        except Exception:
-            lang = 'en'
-        if lang in TRANSLATIONS.keys():
-            _ = TRANSLATIONS[lang]
-        else:
-            def _(text):
-                return text
-        result = func(update, context)
-        return result
-    return wrapped
-
-
-def new_chat_id_memoization(chat_id: int, lang: str, all_known_chat_ids=db.get_all_chat_ids()):  # pylint: disable=W0102
-    """Save every new unique CHAT_ID in database. Create new record in 'Chats'. Also save LANG."""
-    # if not all_known_chat_ids:
-    #     all_known_chat_ids = fbotdb.get_all_chat_ids()
-    if chat_id not in all_known_chat_ids:
-        all_known_chat_ids.add(chat_id)
-        db.register_new_chat_id(chat_id, lang)
-        logger.info(f'New chat_id: {chat_id}. All chat_ids: ')
-        logger.info(all_known_chat_ids)
-
-
-@logger.catch
-def build_message_markup(update, _context):
-    """Build message markup for this chat LANG"""
-    global _  #pylint: disable=W0603
-    try:
-        lang = db.get_chat_lang(update.effective_message.chat_id)
-        if lang in TRANSLATIONS.keys():
-            _ = TRANSLATIONS[lang]
-        else:
-            def _(text):
-                return text
-    except Exception as e:
-        logger.error(e)
-        def _(text):
-            return text
+from core import (build_menu, changed_event_post, create_event_full_text, get_bundle, help_text, load_language_bundles, new_chat_id_memoization,
+                  new_event_text, parse_cmd_arg, parse_datetime, parse_event_limit, refreshed_event_post, save_event_post, squad_text, stat_text,
+                  warm_up_known_chats, with_language)
+from countdown import CountdownRefresher
+from dateparse import DATE_PARSER, add_date_parser_arguments, start_date_parser
+from dispatch import ChatShardedDispatcher
+from metrics import METRICS, add_metrics_arguments, bot_call, start_metrics
+from profiling import PROFILER, add_profiling_arguments, configure_profiler
+from webhook import WebhookServer, add_webhook_arguments, parse_args_with_config, webhook_secret_token
+from outbound import PRIORITY_BULK, PRIORITY_EDIT, PRIORITY_POST, ChatSender, EditCoalescer, RateLimiter
+
+
+GROUP_COMMIT_WINDOW = 0.0  # seconds, > 0 - commit sign-up clicks arriving within this window in one transaction
+DISPATCH_SHARDS = 8  # worker threads; updates of one chat are always processed by the same worker, in order
+EDIT_WINDOW = 1.0  # seconds, at most one edit of the event post per window, clicks during it are merged
+
+EDITS: Optional[EditCoalescer] = None  # set in __main__, None - edit the post at every click
+REFRESHER: Optional[CountdownRefresher] = None  # set in __main__, None - countdowns change at clicks only
+LIMITER = RateLimiter()  # every send/edit goes through it, see outbound.py
+SENDER: Optional[ChatSender] = None  # set in __main__, None - send() waits for LIMITER in the handler thread
+
+def event_keyboard(_: Callable[[str], str]) -> InlineKeyboardMarkup:
+    """Buttons of the event post in one language, built once per language by load_language_bundles()"""
     button_list = [
     InlineKeyboardButton(_('+ Apply for participation'), callback_data='ADD'),
     InlineKeyboardButton(_('- Revoke application'), callback_data='REMOVE'),
     ]
-    markup = InlineKeyboardMarkup(build_menu(button_list, n_cols=1))
-    return markup
+    return InlineKeyboardMarkup(build_menu(button_list, n_cols=1))
+
+
+def chat_keyboard(chat_id: int) -> InlineKeyboardMarkup:
+    """Prebuilt buttons of the event post in the language of the chat"""
+    return get_bundle(db.get_chat_lang(chat_id)).keyboard
+
+
+def send(chat_id: int, priority: int, func: Callable, *args, then: Optional[Callable] = None, key=None, **kwargs):
+    """Rate limited Bot API call, then(result) after it succeeded. Queued by SENDER: the handler does not wait for it."""
+    if SENDER:
+        SENDER.send(chat_id, priority, func, *args, then=then, key=key, **kwargs)
+        return
+    result = LIMITER.call(chat_id, priority, func, *args, **kwargs)
+    if then:
+        then(result)
+
+
+def edit_event_post(edit_message_text: Callable, chat_id: int, message_id: int):
+    """Render the event post when the edit is made and edit it if the text changed. Telegram errors (RetryAfter) are raised."""
+    message_text = changed_event_post(chat_id, message_id)
+    if message_text:
+        edit_message_text(text=message_text, reply_markup=chat_keyboard(chat_id), parse_mode=ParseMode.HTML, disable_web_page_preview=True)
+        save_event_post(chat_id, message_id, message_text)
+
+
+def post_event(bot, chat_id: int):
+    """Send the event post rendered when the call is made, it becomes the latest post of the chat"""
+    event_text = create_event_full_text(chat_id)
+    new_message = bot.send_message(chat_id, event_text, reply_markup=chat_keyboard(chat_id), parse_mode=ParseMode.HTML, disable_web_page_preview=True)
+    save_event_post(chat_id, new_message.message_id, event_text)
+
+
+def remove_latest_buttons(bot, chat_id: int):
+    """Remove buttons of the latest post of the chat, as saved when the call is made (after earlier posts of the chat were sent).
+    Then the chat has no live post: queued edits of this post are dropped (see core.changed_event_post)"""
+    latest_bot_message_id = db.get_latest_bot_message_id(chat_id)
+    if latest_bot_message_id:
+        bot.edit_message_reply_markup(chat_id, latest_bot_message_id)
+        db.save_latest_bot_message(chat_id, 0, '')
 
 
 @logger.catch
-@make_translatable_user_id_context
 def button(update, context):
     """Process clicking buttons for EVENT (register/unregister player)"""
     this_chat_id = update.effective_message.chat_id
     query = update.callback_query
+    query.answer()  # at once, the post itself is edited by EDITS. https://core.telegram.org/bots/api#callbackquery.
+    bot_call()  # not rate limited, so not counted by LIMITER
     user_id = query.from_user.id
     db.add_or_update_user(user_id, query.from_user.first_name, query.from_user.last_name, query.from_user.username)
     if query.data == "ADD":
@@ -111,51 +111,36 @@ def button(update, context):
         db.revoke_application_for_the_event(this_chat_id, user_id)
     else:  # for future --- in case of additional buttons
         pass
-    message_text = create_event_full_text(this_chat_id)
-    if message_text != db.get_latest_bot_message_text(this_chat_id):
-        query.edit_message_text(text = message_text, reply_markup=build_message_markup(update, context), parse_mode=ParseMode.HTML, disable_web_page_preview=True)
-        db.save_latest_bot_message(this_chat_id, update.effective_message.message_id, message_text)
-    update.callback_query.answer() # https://core.telegram.org/bots/api#callbackquery.
-
-
-@logger.catch
-def parse_datetime(str_datetime_in_free_form: str) -> Optional[datetime.datetime]:
-    """Parse text for DATETIME in free form with RECURRENT library. """
-    try:
-        consts = parsedatetime.Constants(localeID=_('en_US'), usePyICU=False)
-        consts.use24 = True
-        r_event = RecurringEvent(parse_constants=consts)
-        found_date = r_event.parse(str_datetime_in_free_form)
-        if not found_date:
-            # logger.debug("Date in event name not found")
-            return None
-        # logger.debug(f"found date: {found_date}")
-        # Drop any suspicious results
-        delta = found_date - datetime.datetime.now()
-        if delta.days < 0:
-            logger.info(f"Time DELTA.days < 0 !!!  {delta.days}. ??? skipping...")
-            return None
-        if delta.days > 31:
-            logger.info(f"Time DELTA.days = {delta.days}. Suspicious, skipping...")
-            return None
-        logger.info(f"Delta: {delta.days}, {delta.seconds}")
-        return found_date
-    except Exception as e:
-        logger.exception(e)
-    return None
+    if EDITS:
+        EDITS.schedule((this_chat_id, update.effective_message.message_id), edit_event_message, update, context)
+    else:
+        edit_event_message(update, context)
 
 
-@logger.catch
-def parse_cmd_arg(update, _context) -> str:
-    """Parse command with argument and return argument only"""
-    user_input = update.message.text
-    space_index = user_input.find(' ')
-    cmd_arg = user_input[space_index+1:].strip()
-    if space_index < 0 or not cmd_arg:
-        # show_help(update, _context)  # to show help or not?
-        return ''
-    cmd_arg = cmd_arg.replace('@zp_futsal_bot', '')
-    return cmd_arg
+@PROFILER.wrap
+@METRICS.instrument
+@db.traced_handler
+def edit_event_message(update, context):
+    """Edit the clicked event post to the current state of the event (a queued edit of the post is replaced)"""
+    this_chat_id = update.effective_message.chat_id
+    message_id = update.effective_message.message_id
+    if changed_event_post(this_chat_id, message_id):
+        send(this_chat_id, PRIORITY_EDIT, edit_event_post, update.callback_query.edit_message_text, this_chat_id, message_id,
+             key=(this_chat_id, message_id))
+
+
+@PROFILER.wrap
+@METRICS.instrument
+@db.traced_handler
+def refresh_event_post(bot, chat_id: int):
+    """REFRESHER.due: edit the latest event post of the chat when its countdown changed.
+    Runs in the refresher thread, not in the shards: the edit is queued by SENDER at the lowest priority,
+    merged with a queued click edit of the same post"""
+    post = refreshed_event_post(chat_id)
+    if post:
+        message_id, _message_text = post
+        send(chat_id, PRIORITY_BULK, edit_event_post, partial(bot.edit_message_text, chat_id=chat_id, message_id=message_id), chat_id, message_id,
+             key=(chat_id, message_id))
 
 
 @logger.catch
@@ -164,18 +149,18 @@ def remove_all_chat_events(update, context):
     this_chat_id = update.message.chat_id
     new_chat_id_memoization(this_chat_id, update.message.from_user.language_code)
     try:
-        latest_bot_message_id = db.get_latest_bot_message_id(this_chat_id)
-        if latest_bot_message_id:
-            context.bot.edit_message_reply_markup(this_chat_id, latest_bot_message_id)
+        send(this_chat_id, PRIORITY_EDIT, remove_latest_buttons, context.bot, this_chat_id)
     except Exception as e:
         logger.warning(e)
     db.close_all_open_events_for_chat(this_chat_id)
+    if REFRESHER:
+        REFRESHER.forget(this_chat_id)
 
 
 @logger.catch
-@make_translatable_user_id_context
 def create_new_event(update, context):
     """CommandHandler_______________________________________________________________________________________________"""
+    _ = context.lang.gettext
     # Create new event for chat, try to find DATETIME and LIMIT in text
     remove_all_chat_events(update, context)
     this_chat_id = update.message.chat_id
@@ -183,21 +168,16 @@ def create_new_event(update, context):
     if lang:
         db.set_chat_lang(this_chat_id, lang)
     event_text = parse_cmd_arg(update, context)
-    # this is our personal use-case, can be deleted or updated for real regex parsing LIMIT value (for fun?):
-    txt = event_text.lower()
-    limit_markers = ['maximum', 'max', 'limit', 'максимум', 'максимальн', 'макс', 'лимит', 'ограничени']
-    event_limit = 12
-    for marker in limit_markers:
-        if marker in txt:
-            try:
-                number = re.search(marker + r'[\s\S]*?(\d+)', txt).group(1)
-                event_limit = int(number)
-            except:
-                continue
-    event_datetime = parse_datetime(event_text)
-    message_text = _("New event created") + ":\n\n⚽️<b> " + event_text + " </b>⚽️"
-    new_message = context.bot.send_message(this_chat_id, message_text, reply_markup=build_message_markup(update, context),  parse_mode=ParseMode.HTML)
-    db.event_add(this_chat_id, event_text, event_datetime, event_limit, new_message.message_id, message_text)
+    event_limit = parse_event_limit(event_text)
+    event_datetime = parse_datetime(event_text, context.lang.locale_id)
+    message_text = new_event_text(event_text, _)
+    # the event exists at once for the next updates of the chat, its post id is saved when the post is sent;
+    # until then the previous post stays the latest one: its queued removal of buttons needs its id
+    db.event_add(this_chat_id, event_text, event_datetime, event_limit, None, message_text)
+    send(this_chat_id, PRIORITY_POST, context.bot.send_message, this_chat_id, message_text, reply_markup=chat_keyboard(this_chat_id),
+         parse_mode=ParseMode.HTML, then=lambda new_message: db.save_latest_bot_message(this_chat_id, new_message.message_id, message_text))
+    if REFRESHER:
+        REFRESHER.track(this_chat_id, event_datetime)
 
 
 @logger.catch
@@ -214,9 +194,11 @@ def set_event_datetime(update, context):
     """CommandHandler_______________________________________________________________________________________________"""
     new_chat_id_memoization(update.message.chat_id, update.message.from_user.language_code)
     str_datetime_in_free_form = parse_cmd_arg(update, context)
-    event_datetime = parse_datetime(str_datetime_in_free_form)
+    event_datetime = parse_datetime(str_datetime_in_free_form, context.lang.locale_id)
     if event_datetime:
         db.set_event_datetime(update.message.chat_id, event_datetime)
+        if REFRESHER:
+            REFRESHER.track(update.message.chat_id, db.get_event_datetime(update.message.chat_id))
     show_info(update, context)
 
 
@@ -232,114 +214,23 @@ def set_players_limit(update, context):
 
 
 @logger.catch
-def create_event_full_text(this_chat_id: int):
-    """Compose full text for telegram message for the event. Using LANG from chat_id (set by event creator)"""
-
-    lang = db.get_chat_lang(this_chat_id)
-    if lang in TRANSLATIONS.keys():
-        _ = TRANSLATIONS[lang]
-    else:
-        def _(text):
-            return text
-
-    def player_name_with_cards(games_registered, penalties: int, full_name: str, translator: Callable) -> str:
-        """Add warning card to players names if needed"""
-        printable_name = full_name
-        games_played = games_registered - penalties
-        if games_registered < 5:
-            return printable_name
-        if not penalties:
-            return printable_name
-        printable_name_with_cards = printable_name
-        _ = translator
-        txt_played = _('Played')
-        txt_from = _('from')
-        if games_registered and penalties and games_played/games_registered < 0.9:
-            printable_name_with_cards = f'{printable_name}🟨 ({txt_played} {games_played} {txt_from} {games_registered})'
-        if games_registered and penalties and games_played/games_registered < 0.8:
-            printable_name_with_cards = f'{printable_name}🟨🟨 ({txt_played} {games_played} {txt_from} {games_registered})'
-        if games_registered and penalties and games_played/games_registered < 0.7:
-            printable_name_with_cards = f'{printable_name}🟨🟨🟨({txt_played} {games_played} {txt_from} {games_registered})'  # 🟥
-        return printable_name_with_cards
-
-
-    text = '⚽️"<b>' + db.get_event_text(this_chat_id) + '</b>"⚽️\n'
-
-    players_limit = db.get_event_limit(this_chat_id)
-
-    if players_limit:
-        text = text + _('Players limit') + f': {players_limit}\n'
-
-    str_datetime_iso_8601 = db.get_event_datetime(this_chat_id)
-    if str_datetime_iso_8601:
-        event_datetime = datetime.datetime.fromisoformat(str_datetime_iso_8601)
-        text = text + '📅  ' + _('Event date and time') + f": {event_datetime.strftime('%Y-%m-%d, %H:%M')}\n"
-        if event_datetime < datetime.datetime.now():
-            text = text + '⏳ ' + _('Event time out') + '.\n'
-        else:
-            delta = event_datetime - datetime.datetime.now()
-            text = text + '⏳ ' + _('Time left') + f': {delta.days} ' + _('days') + ' ' + _('and') + f' {round(delta.seconds / 60 / 60)} ' + _('hours') + '\n'
-
-    text = text + _('Players list') + ':\n'
-    text_players = ''
-
-    players = db.get_event_users(this_chat_id)
-
-
-    for n, user_id in enumerate(players, start=1):
-        if players_limit and n == players_limit + 1:
-            text_players = text_players + '\t\t\n' + _('Reserve') + ':\n'
-        in_squad = '👟'
-        if players_limit and n >= players_limit + 1:
-            in_squad = '      '
-        printable_name = db.compose_full_name(user_id)
-        games_registered, penalties = db.get_chat_user_rp(this_chat_id, user_id)
-        text_players = text_players + in_squad + f'{n}. {player_name_with_cards(games_registered, penalties, printable_name, _)}\n'
-
-    text = text + '\n' + text_players
-    text_players = ''
-
-    canceled_players = db.get_event_revoked_users(this_chat_id)
-    if canceled_players:
-        text = text + '\n' + _('Revoked applications') + ':'
-        for canceled_user_id in canceled_players:
-            cancel_datetime = db.get_user_cancellation_datetime(this_chat_id, canceled_user_id)
-            # ~ 2022-06-04 02:11:54.377618 -> 2022-06-04 02:11
-            cancel_datetime = cancel_datetime[:cancel_datetime.rfind(':', 2)]
-
-            printable_name = db.compose_full_name(canceled_user_id)
-            text_players = text_players + f'      <s>{printable_name} - {cancel_datetime}</s>\n'
-
-    if not players and not canceled_players:
-        text_players = _('No applications yet')
-
-    text = text + '\n' + text_players
-    return text
-
-
-@logger.catch
-@make_translatable_user_id_context
 def show_info(update, context):
     """CommandHandler_______________________________________________________________________________________________"""
+    _ = context.lang.gettext
     new_chat_id_memoization(update.message.chat_id, update.message.from_user.language_code)
     this_chat_id = update.message.chat_id
     if not db.get_event_text(this_chat_id):
-        update.message.reply_text(_('No events'))
+        send(this_chat_id, PRIORITY_POST, update.message.reply_text, _('No events'))
         return
-    event_text = create_event_full_text(this_chat_id)
     # removing buttons from latest bot message
     try:
-        latest_bot_message_id = db.get_latest_bot_message_id(this_chat_id)
-        if latest_bot_message_id:
-            context.bot.edit_message_reply_markup(this_chat_id, latest_bot_message_id)
+        send(this_chat_id, PRIORITY_EDIT, remove_latest_buttons, context.bot, this_chat_id)
     except Exception as e:
         logger.exception(e)
-    new_message = context.bot.send_message(this_chat_id, event_text, reply_markup=build_message_markup(update, context), parse_mode=ParseMode.HTML, disable_web_page_preview=True)
-    db.save_latest_bot_message(this_chat_id, new_message.message_id, event_text)
+    send(this_chat_id, PRIORITY_POST, post_event, context.bot, this_chat_id)
 
 
 @logger.catch
-@make_translatable_user_id_context
 def add_player(update, context):
     """CommandHandler_______________________________________________________________________________________________"""
     new_chat_id_memoization(update.message.chat_id, update.message.from_user.language_code)
@@ -352,7 +243,6 @@ def add_player(update, context):
 
 
 @logger.catch
-@make_translatable_user_id_context
 def remove_player(update, context):
     """CommandHandler_______________________________________________________________________________________________"""
     new_chat_id_memoization(update.message.chat_id, update.message.from_user.language_code)
@@ -364,120 +254,60 @@ def remove_player(update, context):
 
 
 @logger.catch
-@make_translatable_user_id_context
 def penalty_player(update, context):
     """CommandHandler_______________________________________________________________________________________________"""
     new_chat_id_memoization(update.message.chat_id, update.message.from_user.language_code)
     user_id = parse_cmd_arg(update, context)
+    operator = update.message.from_user
     try:
-        db.penalty_for_user_in_chat(chat_id=update.message.chat_id, user_id=user_id, operator_id=update.message.from_user.user_id)
+        db.add_or_update_user(operator.id, operator.first_name, operator.last_name, operator.username)  # operator_id is a foreign key
+        db.penalty_for_user_in_chat(chat_id=update.message.chat_id, user_id=int(user_id), operator_id=update.message.from_user.id)
     except Exception as e:
         logger.exception(e)
 
 
 @logger.catch
-@make_translatable_user_id_context
 def fix_squad(update, context):
     """CommandHandler_______________________________________________________________________________________________"""
+    _ = context.lang.gettext
     new_chat_id_memoization(update.message.chat_id, update.message.from_user.language_code)
     this_chat_id = update.message.chat_id
     if not db.get_event_text(this_chat_id):
-        update.message.reply_text(_('No events to fix stat for'))
+        send(this_chat_id, PRIORITY_POST, update.message.reply_text, _('No events to fix stat for'))
         return
-    text = _('Current statistics for this chat room members:') +'\n<code>'
-    squad = []
-    players_limit = db.get_event_limit(this_chat_id)
-    for position, userid in enumerate(db.get_event_users(this_chat_id), start=1):
-        if not players_limit or position <= players_limit:
-            try:
-                squad.append(userid)
-                full_name = db.compose_full_name(userid)
-                games, penalties = db.get_chat_user_rp(this_chat_id, userid)
-                games = games + 1
-                text = text + f"{full_name} {games}/{penalties}\n"
-
-            except Exception as e:
-                logger.exception(e)
-    text = text + "</code>"
+    text = squad_text(this_chat_id, _)
     # удаление кнопок из последнего сообщения
     try:
-        latest_bot_message_id = db.get_latest_bot_message_id(this_chat_id)
-        if latest_bot_message_id:
-            context.bot.edit_message_reply_markup(this_chat_id, latest_bot_message_id)
+        send(this_chat_id, PRIORITY_EDIT, remove_latest_buttons, context.bot, this_chat_id)
     except Exception as e:
         logger.exception(e)
-    context.bot.send_message(this_chat_id, text, parse_mode=ParseMode.HTML, disable_web_page_preview=True)
+    send(this_chat_id, PRIORITY_POST, context.bot.send_message, this_chat_id, text, parse_mode=ParseMode.HTML, disable_web_page_preview=True)
     db.fix_event(this_chat_id)  # fix only after get_event_users() for OPEN event
+    if REFRESHER:
+        REFRESHER.forget(this_chat_id)
 
 
 @logger.catch
-@make_translatable_user_id_context
 def show_stat(update, context):
     """CommandHandler_______________________________________________________________________________________________"""
+    _ = context.lang.gettext
     new_chat_id_memoization(update.message.chat_id, update.message.from_user.language_code)
-    all_userids = db.get_only_chat_participants(update.message.chat_id)
-    if not all_userids:
+    text = stat_text(update.message.chat_id, _)
+    if not text:
         return
-    text = _('Current statistics for this chat room members:') + '\n'
-    text = text + '<tg-spoiler>' + _('Registrations / Penalties') + '</tg-spoiler>\n'
-    text = text + '<code>'
-    # all_userids = fbotdb.get_all_userids()  # global stats, not used
-    for userid in all_userids:
-        printable_name = db.compose_full_name(userid)
-        registered, penalties = db.get_chat_user_rp(update.message.chat_id, userid)
-        text = text + "ID:{}, {:>2}/{}, Full Name: {}\n".format(userid, registered, penalties, printable_name)
-    text = text + '</code>'
-    context.bot.send_message(update.message.chat_id, text, parse_mode=ParseMode.HTML, disable_web_page_preview=True)
+    send(update.message.chat_id, PRIORITY_BULK, context.bot.send_message, update.message.chat_id, text, parse_mode=ParseMode.HTML,
+         disable_web_page_preview=True)
 
 
 @logger.catch
-@make_translatable_user_id_context
 def show_help(update, context):
     """CommandHandler_______________________________________________________________________________________________"""
+    _ = context.lang.gettext
     new_chat_id_memoization(update.message.chat_id, update.message.from_user.language_code)
-    event_text = _("""
-Available BOT commands:
-
-/event_add TEXT
-Register new event
-
-/event_remove
-Remove open event
-
-/event_update TEXT
-Change event description
-
-/limit XX
-Set players limit
-
-/event_datetime DATE TIME
-Set event date and time in any format. It will parsed automatically.
-Example 1: 2023-01-30, 18:00
-Example2: tomorrow, 14:30
-
-/info
-Show event details
-
-/add
-Register yourself to the event
-
-/remove
-Revoke your application
-
-/fix
-Fix event statistics (increment participants counters)
-
-/penalty USERID
-Increase someone's PENALTY counter for  unreasonable skipping of the event without notification others.
-You can find USERID by command /stat
-
-/stat
-This group members statistics (registrations and penalties)
-""")
-    context.bot.send_message(update.message.chat_id, event_text, parse_mode=ParseMode.HTML)
+    event_text = help_text(_)
+    send(update.message.chat_id, PRIORITY_BULK, context.bot.send_message, update.message.chat_id, event_text, parse_mode=ParseMode.HTML)
 
 @logger.catch
-@make_translatable_user_id_context
 def unknown_command_handler(update, context):
     """CommandHandler_______________________________________________________________________________________________"""
     if not update.message:
@@ -496,15 +326,62 @@ def unknown_command_handler(update, context):
     logger.info(f'Chat ID: {update.message.chat_id}')
 
 
-def build_menu(buttons, n_cols, header_buttons=None, footer_buttons=None):
-    """Build menu from buttons for telegram message"""
-    menu = [buttons[i:i + n_cols] for i in range(0, len(buttons), n_cols)]
-    if header_buttons:
-        menu.insert(0, [header_buttons])
-    if footer_buttons:
-        menu.append([footer_buttons])
-    return menu
 
+@logger.catch
+def profile_command(update, context):
+    """Operators only: /profile [cpu|memory] [N] [Ts] [handler,...] | /profile stop, see profiling.py"""
+    reply = PROFILER.command(update.effective_user.id, parse_cmd_arg(update, context))
+    if reply:
+        send(update.message.chat_id, PRIORITY_POST, update.message.reply_text, reply)
+
+
+def add_handlers(dispatcher, wrap: Callable = lambda callback: callback):
+    """Register all bot handlers; wrap(callback) is applied to every callback (e.g. ChatShardedDispatcher.wrap)"""
+    def handler(callback: Callable) -> Callable:
+        return wrap(PROFILER.wrap(METRICS.instrument(db.traced_handler(with_language(callback)))))
+
+    dispatcher.add_handler(CommandHandler('add', handler(add_player)))
+    dispatcher.add_handler(CommandHandler('remove', handler(remove_player)))
+    dispatcher.add_handler(CommandHandler('info', handler(show_info)))
+    dispatcher.add_handler(CommandHandler('help', handler(show_help)))
+    dispatcher.add_handler(CommandHandler('stat', handler(show_stat)))
+    dispatcher.add_handler(CommandHandler('fix', handler(fix_squad)))
+
+    dispatcher.add_handler(CommandHandler('event_add', handler(create_new_event)))
+    dispatcher.add_handler(CommandHandler('event_remove', handler(remove_all_chat_events)))
+    dispatcher.add_handler(CommandHandler('event_update', handler(update_event)))
+    dispatcher.add_handler(CommandHandler('limit', handler(set_players_limit)))
+    dispatcher.add_handler(CommandHandler('penalty', handler(penalty_player)))
+    dispatcher.add_handler(CommandHandler('event_datetime', handler(set_event_datetime)))
+    dispatcher.add_handler(CommandHandler('profile', wrap(profile_command)))
+
+    dispatcher.add_handler(CallbackQueryHandler(handler(button)))
+    dispatcher.add_handler(MessageHandler(Filters.text | Filters.status_update.new_chat_members, handler(unknown_command_handler)))
+
+
+def serve_webhook(updater, shards: ChatShardedDispatcher, args):
+    """Process updates POSTed to the local listener (see webhook.py) until SIGINT/SIGTERM"""
+    dispatcher = updater.dispatcher
+    secret_token = webhook_secret_token(args, sets_webhook=bool(args.webhook_url))
+    server = WebhookServer(args.listen, args.port, lambda data: dispatcher.update_queue.put(Update.de_json(data, updater.bot)),
+                           url_path=args.url_path, secret_token=secret_token, max_body_size=args.max_body_size, backlog=args.backlog,
+                           pending=lambda: dispatcher.update_queue.qsize() + sum(shards.depths()), max_pending=args.max_pending)
+    dispatcher_thread = threading.Thread(target=dispatcher.start, name='dispatcher', daemon=True)
+    dispatcher_thread.start()
+    server.start()
+    if args.webhook_url:
+        updater.bot.set_webhook(url=args.webhook_url, secret_token=secret_token, max_connections=args.max_connections)
+    stop_requested = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda _signum, _frame: stop_requested.set())
+    STARTUP.mark('webhook listener')
+    logger.info(STARTUP.report())
+    logger.info("Telegram Futsal Bot is waiting for updates (webhook)...")
+    stop_requested.wait()
+    server.stop()
+    dispatcher.stop()
+    dispatcher_thread.join()
+    logger.info(f'Webhook stats: {server.stats()}')
 
 
 # ____________________________________________________________________________________________________________________
@@ -514,54 +391,89 @@ def build_menu(buttons, n_cols, header_buttons=None, footer_buttons=None):
 
 if __name__ == '__main__':
 
+    arg_parser = argparse.ArgumentParser(description='Telegram BOT for organization of events (python-telegram-bot v13)')
+    arg_parser.add_argument('--mode', choices=('polling', 'webhook'), default='polling', help='how to receive updates from Telegram')
+    arg_parser.add_argument('--known-chats', choices=('background', 'lazy', 'eager'), default='background',
+                            help='load registered chat_ids in a background thread, on the first update, or before serving')
+    arg_parser.add_argument('--trace-sql', action='store_true', help='time every SQL statement, log slow ones to logs/slow_queries.log')
+    arg_parser.add_argument('--slow-query-ms', type=float, default=50.0, help='with --trace-sql: slow query threshold')
+    add_date_parser_arguments(arg_parser)
+    add_metrics_arguments(arg_parser)
+    add_profiling_arguments(arg_parser)
+    add_webhook_arguments(arg_parser)
+    args = parse_args_with_config(arg_parser)
+
     logger.remove()
     logger.add("logs/logs.log", level="INFO")
     logger.add(sys.stderr, level="WARNING")
 
     try:
         with open('token.txt', encoding='utf-8') as f:
-            api_token = f.readline()
+            api_token = f.readline().strip()
     except Exception as err:
         logger.exception(err)
         print("Can not read api_token from token.txt")
         sys.exit()
 
-    updater = Updater(api_token, use_context=True, workers=1)  # default workers = 4 but пофиг
-    dispatcher = updater.dispatcher
-
-    dispatcher.add_handler(CommandHandler('add', add_player))
-    dispatcher.add_handler(CommandHandler('remove', remove_player))
-    dispatcher.add_handler(CommandHandler('info', show_info))
-    dispatcher.add_handler(CommandHandler('help', show_help))
-    dispatcher.add_handler(CommandHandler('stat', show_stat))
-    dispatcher.add_handler(CommandHandler('fix', fix_squad))
-
-    dispatcher.add_handler(CommandHandler('event_add', create_new_event))
-    dispatcher.add_handler(CommandHandler('event_remove', remove_all_chat_events))
-    dispatcher.add_handler(CommandHandler('event_update', update_event))
-    dispatcher.add_handler(CommandHandler('limit', set_players_limit))
-    dispatcher.add_handler(CommandHandler('penalty', penalty_player))
-    dispatcher.add_handler(CommandHandler('event_datetime', set_event_datetime))
-
-    dispatcher.add_handler(CallbackQueryHandler(button))
-    dispatcher.add_handler(MessageHandler(Filters.text | Filters.status_update.new_chat_members, unknown_command_handler))
-
-    updater.start_polling()
-    logger.info("Telegram Futsal Bot is waiting for commands...")
-    updater.idle()
-
-
-# Library 'python-telegram-bot' v13.xx is multithreaded.
-# This is not thread-safe wraps. There is a little possibility that some new user message
-# will be arrived just in the middle of processing another message in a different thread
-# and the LANG will be wrong for that user (if LANGs are different).
-# So, this wrapper can be replaced by func-space commands like this:
-
-# lang = update.message.from_user.language_code
-# if lang == "ru":
-#     _ = lang_ru.gettext
-# else:
-#     def _(text):
-#         return text
-# inside every function
-# But I want to left this as is for now. :)
+    STARTUP.mark('imports')
+    if args.trace_sql:
+        db.enable_tracing(args.slow_query_ms)
+    db.migrate()
+    if GROUP_COMMIT_WINDOW:
+        db.enable_group_commit(GROUP_COMMIT_WINDOW)
+    STARTUP.mark('database')
+    start_date_parser(args)  # workers import the parsers in the background
+    if args.known_chats == 'eager':
+        warm_up_known_chats()
+        STARTUP.mark('known chats')
+    elif args.known_chats == 'background':
+        threading.Thread(target=warm_up_known_chats, name='known-chats', daemon=True).start()
+
+    updater = Updater(api_token, use_context=True, workers=1)  # workers = run_async pool, not used: see DISPATCH_SHARDS
+    shards = ChatShardedDispatcher(DISPATCH_SHARDS)
+    EDITS = EditCoalescer(EDIT_WINDOW, submit=shards.submit)  # edits are ordered with other updates of the chat
+    SENDER = ChatSender(LIMITER)
+    REFRESHER = CountdownRefresher(due=lambda chat_id: refresh_event_post(updater.bot, chat_id))
+    load_language_bundles(event_keyboard)
+    add_handlers(updater.dispatcher, shards.wrap)
+    metrics_server = start_metrics(args, db, LIMITER, SENDER)
+    configure_profiler(args)
+    METRICS.add_gauge('bot_dispatch_queue_depth', 'Updates waiting in chat shard queues', lambda: sum(shards.depths()))
+    METRICS.add_gauge('bot_startup_seconds', 'Time from process start to serving updates', lambda: STARTUP.total)
+    METRICS.add_gauge('bot_date_parse_cache_hits', 'Date parses served from cache', lambda: DATE_PARSER.hits)
+    METRICS.add_gauge('bot_date_parse_cache_misses', 'Date parses not found in cache', lambda: DATE_PARSER.misses)
+    METRICS.add_gauge('bot_date_parse_timeouts', 'Date parses stopped by --date-timeout', lambda: DATE_PARSER.timeouts)
+    METRICS.add_gauge('bot_outbound_queued', 'Bot API calls queued per chat, not made yet', lambda: SENDER.stats()['queued'])
+    METRICS.add_gauge('bot_countdown_posts', 'Event posts with a countdown kept current', lambda: REFRESHER.stats()['tracked'])
+    REFRESHER.start(db.get_countdown_events)
+    STARTUP.mark('handlers')
+
+    if args.mode == 'webhook':
+        serve_webhook(updater, shards, args)
+    else:
+        updater.start_polling()
+        STARTUP.mark('polling')
+        logger.info(STARTUP.report())
+        logger.info("Telegram Futsal Bot is waiting for commands...")
+        updater.idle()
+    REFRESHER.stop()
+    EDITS.stop()
+    shards.stop()
+    SENDER.stop()
+    logger.info(f'Dispatcher stats: {shards.stats()}, edits: {EDITS.stats()}, sender: {SENDER.stats()}, rate limiter: {LIMITER.stats()}')
+    if db.TRACER:
+        for line in db.TRACER.summary():
+            logger.info(f'SQL trace: {line}')
+    DATE_PARSER.stop()
+    logger.info(f'Date parser: {DATE_PARSER.stats()}, countdown refresher: {REFRESHER.stats()}')
+    PROFILER.stop()
+    if metrics_server:
+        metrics_server.stop()
+    if args.metrics_file:
+        METRICS.dump(args.metrics_file)
+    db.close_connections()
+
+
+# Library 'python-telegram-bot' v13.xx is multithreaded, and so is ChatShardedDispatcher.
+# Language is never global: every update carries its own (context.lang, set by with_language), the event post
+# keyboard is taken from the bundle of the chat language, so updates of different languages can be processed in parallel.
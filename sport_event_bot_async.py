@@ -0,0 +1,439 @@
+# -*- coding: utf-8 -*-
+"""Asyncio engine of the Telegram BOT, based on python-telegram-bot v20+.
+
+Same commands and behaviour as sport_event_bot.py (python-telegram-bot v13, multithreaded), which is kept for compatibility.
+Both PTB versions can not be installed together, so install this one into its own environment:
+
+    pip install -r requirements-async.txt
+    python sport_event_bot_async.py
+
+Updates are processed concurrently (hundreds in flight without a thread per update).
+All database access and other blocking work goes through db_async (dedicated thread pool),
+updates of the same chat are serialized by a per-chat asyncio.Lock.
+"""
+
+import sys
+import asyncio
+import argparse
+import weakref
+from functools import partial, wraps
+from startup import STARTUP  # before third-party imports: their time is the first phase of the startup report
+from loguru import logger
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.constants import ParseMode
+from telegram.ext import Application, CallbackQueryHandler, CommandHandler, MessageHandler, filters
+import db
+import db_async
+from countdown import CountdownRefresher
+from dateparse import DATE_PARSER, add_date_parser_arguments, start_date_parser
+from db_async import adb, run
+from metrics import METRICS, add_metrics_arguments, bot_call, start_metrics
+from profiling import PROFILER, add_profiling_arguments, configure_profiler
+from webhook import add_webhook_arguments, parse_args_with_config, webhook_secret_token
+from outbound import PRIORITY_BULK, PRIORITY_EDIT, PRIORITY_POST, AsyncEditCoalescer, RateLimiter
+from core import (build_menu, changed_event_post, create_event_full_text, get_bundle, help_text, load_language_bundles, new_chat_id_memoization,
+                  new_event_text, parse_cmd_arg, parse_datetime, parse_event_limit, refreshed_event_post, save_event_post, squad_text, stat_text,
+                  warm_up_known_chats, with_language)
+
+
+CONCURRENT_UPDATES = 256  # max updates processed at the same time
+GROUP_COMMIT_WINDOW = 0.0  # seconds, > 0 - commit sign-up clicks arriving within this window in one transaction
+EDIT_WINDOW = 1.0  # seconds, at most one edit of the event post per window, clicks during it are merged
+
+EDITS = AsyncEditCoalescer(EDIT_WINDOW)
+REFRESHER = CountdownRefresher(due=lambda chat_id: None)  # due and the thread are set by start_background()
+LIMITER = RateLimiter()  # every send/edit goes through it, see outbound.py
+
+CHAT_LOCKS: 'weakref.WeakValueDictionary[int, asyncio.Lock]' = weakref.WeakValueDictionary()
+
+
+def chat_lock(chat_id: int) -> asyncio.Lock:
+    """Lock serializing updates of one chat. Forgotten when no update of the chat is in flight."""
+    lock = CHAT_LOCKS.get(chat_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        CHAT_LOCKS[chat_id] = lock
+    return lock
+
+
+def chat_serialized(func):
+    """Process updates of the same chat one by one, in order of arrival"""
+    @wraps(func)
+    async def wrapped(update, context):
+        if not update.effective_chat:
+            return await func(update, context)
+        async with chat_lock(update.effective_chat.id):
+            return await func(update, context)
+    return wrapped
+
+
+async def register_chat(update):
+    await run(new_chat_id_memoization, update.message.chat_id, update.message.from_user.language_code)
+
+
+def event_keyboard(_) -> InlineKeyboardMarkup:
+    """Buttons of the event post in one language, built once per language by load_language_bundles()"""
+    button_list = [
+    InlineKeyboardButton(_('+ Apply for participation'), callback_data='ADD'),
+    InlineKeyboardButton(_('- Revoke application'), callback_data='REMOVE'),
+    ]
+    return InlineKeyboardMarkup(build_menu(button_list, n_cols=1))
+
+
+async def chat_keyboard(chat_id: int) -> InlineKeyboardMarkup:
+    """Prebuilt buttons of the event post in the language of the chat"""
+    return get_bundle(await adb.get_chat_lang(chat_id)).keyboard
+
+
+async def remove_buttons_from_latest_message(context, chat_id: int):
+    try:
+        latest_bot_message_id = await adb.get_latest_bot_message_id(chat_id)
+        if latest_bot_message_id:
+            await LIMITER.call_async(chat_id, PRIORITY_EDIT, context.bot.edit_message_reply_markup, chat_id, latest_bot_message_id)
+            await adb.save_latest_bot_message(chat_id, 0, '')  # no live post: pending edits of it are dropped
+    except Exception as e:
+        logger.warning(e)
+
+
+@logger.catch
+@chat_serialized
+async def button(update, context):
+    """Process clicking buttons for EVENT (register/unregister player)"""
+    this_chat_id = update.effective_message.chat_id
+    query = update.callback_query
+    await query.answer()  # at once, the post itself is edited by EDITS. https://core.telegram.org/bots/api#callbackquery.
+    bot_call()  # not rate limited, so not counted by LIMITER
+    user_id = query.from_user.id
+    await adb.add_or_update_user(user_id, query.from_user.first_name, query.from_user.last_name, query.from_user.username)
+    if query.data == "ADD":
+        await adb.apply_for_participation_in_the_event(this_chat_id, user_id)
+    elif query.data == "REMOVE":
+        await adb.revoke_application_for_the_event(this_chat_id, user_id)
+    EDITS.schedule((this_chat_id, update.effective_message.message_id), edit_event_message, update)
+
+
+@PROFILER.wrap
+@METRICS.instrument
+@db.traced_handler
+async def edit_event_message(update):
+    """Edit the clicked event post to the current state of the event. Telegram errors (RetryAfter) are raised."""
+    this_chat_id = update.effective_message.chat_id
+    async with chat_lock(this_chat_id):
+        message_id = update.effective_message.message_id
+        message_text = await run(changed_event_post, this_chat_id, message_id)
+        if message_text:
+            await LIMITER.call_async(this_chat_id, PRIORITY_EDIT, update.callback_query.edit_message_text, text=message_text,
+                                     reply_markup=await chat_keyboard(this_chat_id), parse_mode=ParseMode.HTML, disable_web_page_preview=True)
+            await run(save_event_post, this_chat_id, message_id, message_text)
+
+
+@PROFILER.wrap
+@METRICS.instrument
+@db.traced_handler
+async def refresh_event_post(bot, chat_id: int, message_id: int):
+    """Edit the event post when its countdown changed (REFRESHER). Telegram errors (RetryAfter) are raised."""
+    async with chat_lock(chat_id):
+        message_text = await run(changed_event_post, chat_id, message_id)
+        if message_text:
+            # background edits yield to clicks and replies
+            await LIMITER.call_async(chat_id, PRIORITY_BULK, bot.edit_message_text, message_text, chat_id, message_id,
+                                     reply_markup=await chat_keyboard(chat_id), parse_mode=ParseMode.HTML, disable_web_page_preview=True)
+            await run(save_event_post, chat_id, message_id, message_text)
+
+
+def schedule_refresh(loop, bot, chat_id: int):
+    """REFRESHER.due, in the refresher thread: schedule an edit of the latest post if its countdown changed.
+    A pending click edit of the same post is kept, it renders the countdown too."""
+    post = refreshed_event_post(chat_id)
+    if post:
+        message_id, _message_text = post
+        loop.call_soon_threadsafe(partial(EDITS.schedule, (chat_id, message_id), refresh_event_post, bot, chat_id, message_id, replace=False))
+
+
+async def close_chat_events(update, context):
+    this_chat_id = update.message.chat_id
+    await register_chat(update)
+    await remove_buttons_from_latest_message(context, this_chat_id)
+    await adb.close_all_open_events_for_chat(this_chat_id)
+    REFRESHER.forget(this_chat_id)
+
+
+@logger.catch
+@chat_serialized
+async def remove_all_chat_events(update, context):
+    """Change event status from Open to Closed"""
+    await close_chat_events(update, context)
+
+
+@logger.catch
+@chat_serialized
+async def create_new_event(update, context):
+    """Create new event for chat, try to find DATETIME and LIMIT in text"""
+    _ = context.lang.gettext
+    await close_chat_events(update, context)
+    this_chat_id = update.message.chat_id
+    lang = update.message.from_user.language_code
+    if lang:
+        await adb.set_chat_lang(this_chat_id, lang)
+    event_text = parse_cmd_arg(update, context)
+    event_limit = parse_event_limit(event_text)
+    event_datetime = await run(parse_datetime, event_text, context.lang.locale_id)
+    message_text = new_event_text(event_text, _)
+    new_message = await LIMITER.call_async(this_chat_id, PRIORITY_POST, context.bot.send_message, this_chat_id, message_text,
+                                           reply_markup=await chat_keyboard(this_chat_id), parse_mode=ParseMode.HTML)
+    await adb.event_add(this_chat_id, event_text, event_datetime, event_limit, new_message.message_id, message_text)
+    REFRESHER.track(this_chat_id, event_datetime)
+
+
+@logger.catch
+@chat_serialized
+async def update_event(update, context):
+    await register_chat(update)
+    await adb.update_event_text(update.message.chat_id, parse_cmd_arg(update, context))
+    await send_event_info(update, context)
+
+
+@logger.catch
+@chat_serialized
+async def set_event_datetime(update, context):
+    await register_chat(update)
+    event_datetime = await run(parse_datetime, parse_cmd_arg(update, context), context.lang.locale_id)
+    if event_datetime:
+        await adb.set_event_datetime(update.message.chat_id, event_datetime)
+        REFRESHER.track(update.message.chat_id, await adb.get_event_datetime(update.message.chat_id))
+    await send_event_info(update, context)
+
+
+@logger.catch
+@chat_serialized
+async def set_players_limit(update, context):
+    await register_chat(update)
+    try:
+        await adb.set_players_limit(update.message.chat_id, int(parse_cmd_arg(update, context)))
+    except Exception as e:
+        logger.exception(e)
+
+
+async def send_event_info(update, context):
+    """Send current event as a new message with buttons (removing buttons from the previous one)"""
+    _ = context.lang.gettext
+    await register_chat(update)
+    this_chat_id = update.message.chat_id
+    if not await adb.get_event_text(this_chat_id):
+        await LIMITER.call_async(this_chat_id, PRIORITY_POST, update.message.reply_text, _('No events'))
+        return
+    event_text = await run(create_event_full_text, this_chat_id)
+    await remove_buttons_from_latest_message(context, this_chat_id)
+    new_message = await LIMITER.call_async(this_chat_id, PRIORITY_POST, context.bot.send_message, this_chat_id, event_text,
+                                           reply_markup=await chat_keyboard(this_chat_id), parse_mode=ParseMode.HTML, disable_web_page_preview=True)
+    await run(save_event_post, this_chat_id, new_message.message_id, event_text)
+
+
+@logger.catch
+@chat_serialized
+async def show_info(update, context):
+    await send_event_info(update, context)
+
+
+@logger.catch
+@chat_serialized
+async def add_player(update, context):
+    await register_chat(update)
+    user = update.message.from_user
+    if await adb.get_event_text(update.message.chat_id):  # if found OPEN event:
+        await adb.add_or_update_user(user.id, user.first_name, user.last_name, user.username)
+        await adb.apply_for_participation_in_the_event(update.message.chat_id, user.id)
+    await send_event_info(update, context)
+
+
+@logger.catch
+@chat_serialized
+async def remove_player(update, context):
+    await register_chat(update)
+    user = update.message.from_user
+    if await adb.get_event_text(update.message.chat_id):  # if found OPEN event:
+        await adb.add_or_update_user(user.id, user.first_name, user.last_name, user.username)
+        await adb.revoke_application_for_the_event(update.message.chat_id, user.id)
+    await send_event_info(update, context)
+
+
+@logger.catch
+@chat_serialized
+async def penalty_player(update, context):
+    await register_chat(update)
+    operator = update.message.from_user
+    try:
+        await adb.add_or_update_user(operator.id, operator.first_name, operator.last_name, operator.username)  # operator_id is a foreign key
+        await adb.penalty_for_user_in_chat(chat_id=update.message.chat_id, user_id=int(parse_cmd_arg(update, context)),
+                                           operator_id=update.message.from_user.id)
+    except Exception as e:
+        logger.exception(e)
+
+
+@logger.catch
+@chat_serialized
+async def fix_squad(update, context):
+    _ = context.lang.gettext
+    await register_chat(update)
+    this_chat_id = update.message.chat_id
+    if not await adb.get_event_text(this_chat_id):
+        await LIMITER.call_async(this_chat_id, PRIORITY_POST, update.message.reply_text, _('No events to fix stat for'))
+        return
+    text = await run(squad_text, this_chat_id, _)
+    await remove_buttons_from_latest_message(context, this_chat_id)
+    await LIMITER.call_async(this_chat_id, PRIORITY_POST, context.bot.send_message, this_chat_id, text, parse_mode=ParseMode.HTML, disable_web_page_preview=True)
+    await adb.fix_event(this_chat_id)  # fix only after get_event_users() for OPEN event
+    REFRESHER.forget(this_chat_id)
+
+
+@logger.catch
+@chat_serialized
+async def show_stat(update, context):
+    _ = context.lang.gettext
+    await register_chat(update)
+    text = await run(stat_text, update.message.chat_id, _)
+    if text:
+        await LIMITER.call_async(update.message.chat_id, PRIORITY_BULK, context.bot.send_message, update.message.chat_id, text, parse_mode=ParseMode.HTML,
+                                 disable_web_page_preview=True)
+
+
+@logger.catch
+@chat_serialized
+async def show_help(update, context):
+    await register_chat(update)
+    await LIMITER.call_async(update.message.chat_id, PRIORITY_BULK, context.bot.send_message, update.message.chat_id, help_text(context.lang.gettext),
+                             parse_mode=ParseMode.HTML)
+
+
+@logger.catch
+@chat_serialized
+async def unknown_command_handler(update, context):
+    if not update.message:
+        logger.warning("No message in update handler. Full info:")
+        logger.warning(update)
+        return
+    if update.message.new_chat_members:
+        await send_event_info(update, context)  # Wellcome new member by sending current event info
+    if not update.message.text:
+        return
+    await register_chat(update)
+    logger.info(f'Unknown command typed: {update.message.text}')
+    logger.info(f'Chat ID: {update.message.chat_id}')
+
+
+@logger.catch
+async def profile_command(update, context):
+    """Operators only: /profile [cpu|memory] [N] [Ts] [handler,...] | /profile stop, see profiling.py"""
+    reply = PROFILER.command(update.effective_user.id, parse_cmd_arg(update, context))
+    if reply:
+        await LIMITER.call_async(update.message.chat_id, PRIORITY_POST, update.message.reply_text, reply)
+
+
+async def start_background(application):
+    """post_init: the bot is initialized (getMe), updates are fetched next"""
+    loop = asyncio.get_running_loop()
+    REFRESHER.due = partial(schedule_refresh, loop, application.bot)
+    REFRESHER.start(db.get_countdown_events)
+    STARTUP.mark('application')
+    logger.info(STARTUP.report())
+
+
+async def stop_background(application):
+    """post_stop: no more countdown refreshes, pending edits are sent"""
+    REFRESHER.stop()
+    await EDITS.stop(application)
+
+
+def build_application(api_token: str) -> Application:
+    application = (Application.builder().token(api_token).concurrent_updates(CONCURRENT_UPDATES)
+                   .post_init(start_background).post_stop(stop_background).build())
+
+    def handler(callback):
+        return PROFILER.wrap(METRICS.instrument(db.traced_handler(with_language(callback))))
+
+    application.add_handler(CommandHandler('add', handler(add_player)))
+    application.add_handler(CommandHandler('remove', handler(remove_player)))
+    application.add_handler(CommandHandler('info', handler(show_info)))
+    application.add_handler(CommandHandler('help', handler(show_help)))
+    application.add_handler(CommandHandler('stat', handler(show_stat)))
+    application.add_handler(CommandHandler('fix', handler(fix_squad)))
+
+    application.add_handler(CommandHandler('event_add', handler(create_new_event)))
+    application.add_handler(CommandHandler('event_remove', handler(remove_all_chat_events)))
+    application.add_handler(CommandHandler('event_update', handler(update_event)))
+    application.add_handler(CommandHandler('limit', handler(set_players_limit)))
+    application.add_handler(CommandHandler('penalty', handler(penalty_player)))
+    application.add_handler(CommandHandler('event_datetime', handler(set_event_datetime)))
+    application.add_handler(CommandHandler('profile', profile_command))
+
+    application.add_handler(CallbackQueryHandler(handler(button)))
+    application.add_handler(MessageHandler(filters.TEXT | filters.StatusUpdate.NEW_CHAT_MEMBERS, handler(unknown_command_handler)))
+    return application
+
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser(description='Telegram BOT for organization of events (python-telegram-bot v20, asyncio)')
+    arg_parser.add_argument('--mode', choices=('polling', 'webhook'), default='polling', help='how to receive updates from Telegram')
+    arg_parser.add_argument('--known-chats', choices=('background', 'lazy', 'eager'), default='background',
+                            help='load registered chat_ids in a background thread, on the first update, or before serving')
+    arg_parser.add_argument('--trace-sql', action='store_true', help='time every SQL statement, log slow ones to logs/slow_queries.log')
+    arg_parser.add_argument('--slow-query-ms', type=float, default=50.0, help='with --trace-sql: slow query threshold')
+    add_date_parser_arguments(arg_parser)
+    add_metrics_arguments(arg_parser)
+    add_profiling_arguments(arg_parser)
+    add_webhook_arguments(arg_parser)  # --max-body-size, --backlog, --max-pending apply to the threaded engine only
+    args = parse_args_with_config(arg_parser)
+
+    logger.remove()
+    logger.add("logs/logs.log", level="INFO")
+    logger.add(sys.stderr, level="WARNING")
+
+    try:
+        with open('token.txt', encoding='utf-8') as f:
+            api_token = f.readline().strip()
+    except Exception as err:
+        logger.exception(err)
+        print("Can not read api_token from token.txt")
+        sys.exit()
+
+    STARTUP.mark('imports')
+    if args.trace_sql:
+        db.enable_tracing(args.slow_query_ms)
+    db.migrate()
+    if GROUP_COMMIT_WINDOW:
+        db.enable_group_commit(GROUP_COMMIT_WINDOW)
+    STARTUP.mark('database')
+    start_date_parser(args)  # workers import the parsers in the background
+    if args.known_chats == 'eager':
+        warm_up_known_chats()
+        STARTUP.mark('known chats')
+    elif args.known_chats == 'background':
+        db_async.DB_EXECUTOR.submit(warm_up_known_chats)
+
+    load_language_bundles(event_keyboard)
+    metrics_server = start_metrics(args, db, LIMITER)
+    configure_profiler(args, thread_wide=True)
+    METRICS.add_gauge('bot_startup_seconds', 'Time from process start to serving updates', lambda: STARTUP.total)
+    METRICS.add_gauge('bot_date_parse_cache_hits', 'Date parses served from cache', lambda: DATE_PARSER.hits)
+    METRICS.add_gauge('bot_date_parse_cache_misses', 'Date parses not found in cache', lambda: DATE_PARSER.misses)
+    METRICS.add_gauge('bot_date_parse_timeouts', 'Date parses stopped by --date-timeout', lambda: DATE_PARSER.timeouts)
+    METRICS.add_gauge('bot_countdown_posts', 'Event posts with a countdown kept current', lambda: REFRESHER.stats()['tracked'])
+    logger.info("Telegram Futsal Bot (asyncio) is waiting for commands...")
+    if args.mode == 'webhook':  # python-telegram-bot own listener (tornado), always calls setWebhook
+        build_application(api_token).run_webhook(listen=args.listen, port=args.port, url_path=args.url_path, webhook_url=args.webhook_url or None,
+                                                 secret_token=webhook_secret_token(args, sets_webhook=True), max_connections=args.max_connections)
+    else:
+        build_application(api_token).run_polling()
+    logger.info(f'Edits: {EDITS.stats()}, rate limiter: {LIMITER.stats()}')
+    if db.TRACER:
+        for line in db.TRACER.summary():
+            logger.info(f'SQL trace: {line}')
+    DATE_PARSER.stop()
+    logger.info(f'Date parser: {DATE_PARSER.stats()}, countdown refresher: {REFRESHER.stats()}')
+    PROFILER.stop()
+    if metrics_server:
+        metrics_server.stop()
+    if args.metrics_file:
+        METRICS.dump(args.metrics_file)
+    db_async.shutdown()
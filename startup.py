@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""Startup time breakdown of the bot process. Imported by the engines before their third-party imports,
+so the first phase includes the import of python-telegram-bot, loguru and the bot modules.
+"""
+
+import time
+from typing import List, Tuple
+
+
+class StartupTimer:
+    """Wall time of consecutive startup phases, counted from the creation of the timer"""
+
+    def __init__(self):
+        self.started = self._last = time.perf_counter()
+        self.phases: List[Tuple[str, float]] = []
+
+    def mark(self, phase: str):
+        """End of `phase`: the time since the previous mark is attributed to it"""
+        now = time.perf_counter()
+        self.phases.append((phase, now - self._last))
+        self._last = now
+
+    @property
+    def total(self) -> float:
+        return self._last - self.started
+
+    def report(self) -> str:
+        return f'Startup {self.total * 1000:.0f} ms: ' + ', '.join(f'{phase} {seconds * 1000:.0f} ms' for phase, seconds in self.phases)
+
+
+STARTUP = StartupTimer()
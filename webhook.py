@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""Webhook mode: receive updates on a local HTTP port instead of long polling (python sport_event_bot.py --mode webhook).
+
+Telegram POSTs every update as JSON to --webhook-url; a reverse proxy terminating TLS forwards it to --listen:--port.
+WebhookServer (stdlib ThreadingHTTPServer, HTTP/1.1 keep-alive, one thread per Telegram connection):
+  - X-Telegram-Bot-Api-Secret-Token must match --secret-token (sent to Telegram with setWebhook), otherwise 403.
+    With --webhook-url and no --secret-token a random one is generated at startup (webhook_secret_token());
+  - bodies larger than --max-body-size are refused with 413 without reading them;
+  - when more than --max-pending updates wait for processing, 503 (Telegram delivers the update again later);
+  - --backlog is the listen() queue of connections not accepted yet.
+An update is acknowledged with 200 as soon as it is queued, handlers process it exactly as with polling.
+
+Local test with a recorded update (no --webhook-url: setWebhook is not called):
+    python sport_event_bot.py --mode webhook --port 8443 --secret-token s3cret
+    curl -H 'X-Telegram-Bot-Api-Secret-Token: s3cret' -d @update.json http://127.0.0.1:8443/telegram
+"""
+
+import hmac
+import json
+import secrets
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Optional
+from loguru import logger
+
+
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+def add_webhook_arguments(arg_parser: argparse.ArgumentParser):
+    """Command line options of webhook mode, shared by both engines"""
+    group = arg_parser.add_argument_group('webhook mode')
+    group.add_argument('--webhook-url', default='', help='public HTTPS URL for setWebhook; empty - do not call setWebhook (local tests)')
+    group.add_argument('--listen', default='127.0.0.1', help='address of the local HTTP listener')
+    group.add_argument('--port', type=int, default=8443, help='port of the local HTTP listener')
+    group.add_argument('--url-path', default='/telegram', help='path updates are POSTed to')
+    group.add_argument('--secret-token', default='', help='value of X-Telegram-Bot-Api-Secret-Token header, 1-256 of A-Z a-z 0-9 _ -; '
+                                                          'generated when empty and setWebhook is called')
+    group.add_argument('--max-body-size', type=int, default=1 << 20, help='bytes, larger requests are refused (413)')
+    group.add_argument('--backlog', type=int, default=128, help='listen() queue of not yet accepted connections')
+    group.add_argument('--max-connections', type=int, default=40, help='max simultaneous HTTPS connections from Telegram (setWebhook, 1-100)')
+    group.add_argument('--max-pending', type=int, default=10000, help='updates waiting for processing, above it requests get 503')
+
+
+def parse_args_with_config(arg_parser: argparse.ArgumentParser, argv=None) -> argparse.Namespace:
+    """Parse command line; --config FILE.json sets defaults (keys are option names: "port", "secret_token", ...)"""
+    arg_parser.add_argument('--config', default='', help='JSON file with options, command line flags override it')
+    args = arg_parser.parse_args(argv)
+    if args.config:
+        with open(args.config, encoding='utf-8') as f:
+            config: Dict = json.load(f)
+        unknown = set(config) - set(vars(args))
+        if unknown:
+            arg_parser.error(f'unknown options in {args.config}: {", ".join(sorted(unknown))}')
+        arg_parser.set_defaults(**config)
+        args = arg_parser.parse_args(argv)
+    return args
+
+
+def webhook_secret_token(args: argparse.Namespace, sets_webhook: bool) -> str:
+    """--secret-token; a random one when it is empty and the listener is registered with setWebhook (otherwise any POST is accepted)"""
+    if not args.secret_token:
+        if sets_webhook:
+            args.secret_token = secrets.token_urlsafe(32)  # 43 of A-Z a-z 0-9 _ -
+            logger.info('Webhook secret token generated, no --secret-token given')
+        else:
+            logger.warning('Webhook listener without --secret-token accepts updates from anyone who can reach it')
+    return args.secret_token
+
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    """POST url_path with update JSON -> server.put_update(dict)"""
+    protocol_version = 'HTTP/1.1'  # keep-alive: Telegram reuses its connections
+    server: 'WebhookServer'
+
+    def do_POST(self):  # pylint: disable=C0103
+        server = self.server
+        if self.path.split('?', 1)[0] != server.url_path:
+            return self._reply(404, close=True)
+        if server.secret_token and not hmac.compare_digest(self.headers.get(SECRET_TOKEN_HEADER, '').encode(), server.secret_token.encode()):
+            server.rejected += 1
+            return self._reply(403, close=True)
+        try:
+            length = int(self.headers['Content-Length'])
+        except (TypeError, ValueError):
+            return self._reply(411, close=True)
+        if length > server.max_body_size:
+            server.rejected += 1
+            return self._reply(413, close=True)
+        if server.pending and server.pending() >= server.max_pending:
+            server.overloaded += 1
+            return self._reply(503, close=True)
+        body = self.rfile.read(length)
+        try:
+            server.put_update(json.loads(body))
+        except ValueError:
+            return self._reply(400)
+        except Exception as e:
+            logger.exception(e)
+            return self._reply(500)
+        server.received += 1
+        return self._reply(200)
+
+    def _reply(self, code: int, close: bool = False):
+        """Empty response; close=True when the request body was not read (connection can not be reused)"""
+        self.send_response(code)
+        self.send_header('Content-Length', '0')
+        if close:
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        self.end_headers()
+
+    def log_message(self, format, *args):  # pylint: disable=W0622
+        logger.debug(f'Webhook {self.address_string()}: {format % args}')
+
+
+class WebhookServer(ThreadingHTTPServer):
+    """HTTP listener for Telegram webhook updates, see module docstring"""
+    daemon_threads = True
+
+    def __init__(self, listen: str, port: int, put_update: Callable[[Dict], None], url_path: str = '/telegram', secret_token: str = '',
+                 max_body_size: int = 1 << 20, backlog: int = 128, pending: Optional[Callable[[], int]] = None, max_pending: int = 10000):
+        self.request_queue_size = backlog  # used by listen() in server_activate()
+        self.put_update = put_update
+        self.url_path = url_path
+        self.secret_token = secret_token
+        self.max_body_size = max_body_size
+        self.pending = pending
+        self.max_pending = max_pending
+        self.received = 0
+        self.rejected = 0
+        self.overloaded = 0
+        self._thread: Optional[threading.Thread] = None
+        super().__init__((listen, port), WebhookRequestHandler)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name='webhook', daemon=True)
+        self._thread.start()
+        logger.info(f'Webhook is listening on {self.server_address[0]}:{self.server_address[1]}{self.url_path}')
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread:
+            self._thread.join()
+
+    def stats(self) -> Dict[str, int]:
+        return {'received': self.received, 'rejected': self.rejected, 'overloaded': self.overloaded}